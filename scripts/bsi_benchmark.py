@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bsi_benchmark.py
+    Times the BSI reconciliation scripts end to end against the local BSI
+    stand-in (bsi_standin.py) at several study sizes.
+
+    For each size a synthetic fixture is served on a free local port.  Each
+    script runs in its own scratch directory with generated vendor input
+    files, BSI_URL pointing at the stand-in and a throwaway credentials
+    file, and answers 'y' to any prompt.  Wall time, exit status and the
+    BSI request summary printed by the script are collected into a table.
+
+    hla_table.py reads its IDs from a masterkey file rather than BSI, so it
+    is not benchmarked here.
+
+    Usage:
+        bsi_benchmark.py [-n 100,1000,10000,100000] [-s script,...] [-r repeats] [-o results.tsv]
+
+    Example:
+        bsi_benchmark.py -n 100,1000 -s generate_seqr_ped,csi_to_gris_hg38 --latency 0.1
+"""
+
+__author__ = 'Susan Huse'
+__version__ = '1.0.0'
+__copyright__ = 'none'
+
+import sys
+import os
+import re
+import time
+import shutil
+import tempfile
+import subprocess
+import argparse
+from argparse import RawTextHelpFormatter
+import pandas as pd
+from ncbr_huse import send_update, err_out
+from bsi_standin import make_fixture, load_fixture, start_standin
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Batch every script is run for, batch 1 holds the first STANDIN_BATCH_SIZE samples
+BENCH_BATCH = 1
+
+####################################
+#
+# Vendor input files for each script
+#
+####################################
+# Orders released in the benchmark batch
+def released(fixture, batch):
+    batch_name = 'BATCH{:02d}'.format(batch)
+    return(fixture[(fixture['sample.field_324'] == batch_name) & (fixture['sample.field_337'] != '')])
+
+# CIDR Subject Sample Mapping, Master Sample Key and Pedigree csv files
+#   with the control (NA12878) and one sequencing duplicate, as CIDR sends them
+def write_cidr_inputs(ws, fixture, batch, dupe=True):
+    df = released(fixture, batch)
+    orders = df['sample.field_274'].tolist()
+    exomes = df['sample.field_337'].tolist()
+    lims = ['{:06d}'.format(i + 1) for i in range(len(orders))]
+
+    subjects = orders + ['NA12878']
+    exome_ids = exomes + ['NA12878_CTRL']
+    lims_ids = lims + ['999999']
+    if dupe:
+        subjects.append(orders[0] + '_D')
+        exome_ids.append(exomes[0] + '_D')
+        lims_ids.append('999998')
+
+    info = os.path.join(ws, 'rawdata')
+    os.makedirs(info)
+    tag = 'Holland_BATCH{:02d}'.format(batch)
+    pd.DataFrame({'SUBJECT_ID': subjects,
+                  'EXOME_ID': exome_ids,
+                  'SAMPLE_SOURCE': 'Blood',
+                  'SOURCE_SAMPLE_ID': lims_ids}).to_csv(os.path.join(info, tag + '_SubjectSampleMappingFile.csv'), index=False)
+    pd.DataFrame({'Subject_ID': subjects,
+                  'LIMS_SampleId': lims_ids}).to_csv(os.path.join(info, tag + '_MasterSampleKey.csv'), index=False)
+
+    peds = pd.DataFrame({'Subject_ID': subjects[:-1] if dupe else subjects,
+                         'Investigator Column 1': '',
+                         'Investigator Column 3': 'BATCH{:02d}_CIDR'.format(batch)})
+    peds = peds[peds['Subject_ID'] != 'NA12878']
+    if dupe:
+        peds = pd.concat([peds, pd.DataFrame({'Subject_ID': [subjects[-1]],
+                                              'Investigator Column 1': ['Duplicate of ' + orders[0]],
+                                              'Investigator Column 3': ['BATCH{:02d}_CIDR'.format(batch)]})])
+    peds.to_csv(os.path.join(info, tag + '_Pedigree.csv'), index=False)
+    return(info)
+
+# HGSC sample key spreadsheet and an empty raw data directory
+def write_hgsc_inputs(ws, fixture, batch):
+    df = released(fixture, batch)
+    key = pd.DataFrame({'INDEX ID': df['sample.field_337'].tolist() + ['NA12878_CTRL'],
+                        'COLLABORATOR SAMPLE ID': df['sample.field_336'].tolist() + ['NA12878'],
+                        'FLOWCELL ID': 'HFLOWCELL',
+                        'LANE NUM': 1})
+    fname = os.path.join(ws, 'HGSC_SampleKey_BATCH{:02d}.xlsx'.format(batch))
+    key.to_excel(fname, index=False)
+    os.makedirs(os.path.join(ws, 'raw'))
+    return(fname)
+
+# Command line for each benchmarked script, after writing its inputs into ws
+def setup_csi_to_gris(ws, fixture, batch):
+    info = write_cidr_inputs(ws, fixture, batch)
+    return(['csi_to_gris.py', '-b', str(batch), '-d', info])
+
+def setup_csi_to_gris_hg38(ws, fixture, batch):
+    info = write_cidr_inputs(ws, fixture, batch, dupe=False)
+    return(['csi_to_gris_hg38.py', '-b', str(batch), '-d', info])
+
+def setup_csi_to_gris_hgsc(ws, fixture, batch):
+    fname = write_hgsc_inputs(ws, fixture, batch)
+    return(['csi_to_gris_hgsc.py', '-b', str(batch), '-d', os.path.join(ws, 'raw'), '-s', fname, '-u'])
+
+def setup_generate_seqr_ped(ws, fixture, batch):
+    return(['generate_seqr_ped.py', '-b', str(batch), '-g', '-c'])
+
+BENCH_SCRIPTS = {'csi_to_gris': setup_csi_to_gris,
+                 'csi_to_gris_hg38': setup_csi_to_gris_hg38,
+                 'csi_to_gris_hgsc': setup_csi_to_gris_hgsc,
+                 'generate_seqr_ped': setup_generate_seqr_ped}
+
+####################################
+#
+# Running and timing
+#
+####################################
+# Run one script in its scratch directory against the stand-in, return one result row
+def run_script(name, ws, fixture, base_url, extra_args):
+    os.makedirs(ws)
+    try:
+        cmd = BENCH_SCRIPTS[name](ws, fixture, BENCH_BATCH)
+    except ImportError as e:
+        return({'status': 'skipped: {}'.format(e)})
+    cmd = [sys.executable, os.path.join(SCRIPT_DIR, cmd[0])] + cmd[1:] + extra_args
+
+    cnf = os.path.join(ws, '.my.cnf.bsi')
+    with open(cnf, 'w') as f:
+        f.write("benchmark\nbenchmark\n")
+    env = dict(os.environ)
+    env['BSI_URL'] = base_url
+    env['BSI_CNF'] = cnf
+    env.pop('BSI_SESSION_CACHE', None)
+
+    start = time.time()
+    with open(os.path.join(ws, 'stdout.txt'), 'w') as out, open(os.path.join(ws, 'stderr.txt'), 'w') as err:
+        proc = subprocess.run(cmd, cwd=ws, env=env, input='y\n' * 20, stdout=out, stderr=err, universal_newlines=True)
+    seconds = time.time() - start
+
+    result = {'status': 'ok' if proc.returncode == 0 else 'exit {}'.format(proc.returncode),
+              'seconds': round(seconds, 3)}
+
+    # BSI request summary printed by report_bsi_stats
+    with open(os.path.join(ws, 'stdout.txt'), 'r') as f:
+        m = re.search(r'BSI requests: (\d+), ([\d.]+) s, ([\d,]+) bytes', f.read())
+    if m is not None:
+        result['bsi_requests'] = int(m.group(1))
+        result['bsi_seconds'] = float(m.group(2))
+        result['bsi_bytes'] = int(m.group(3).replace(',', ''))
+    return(result)
+
+def main():
+    #
+    # Usage statement
+    #
+    parseStr = 'Times the BSI reconciliation scripts against the local BSI stand-in\n\
+    at several study sizes.\n\n\
+    Usage:\n\
+        bsi_benchmark.py [-n sizes] [-s scripts] [-r repeats] [-o results.tsv]\n\n\
+    Example:\n\
+        bsi_benchmark.py -n 100,1000,10000,100000\n\
+        bsi_benchmark.py -n 1000 -s generate_seqr_ped --latency 0.2 --expire-rate 0.05\n'
+
+    parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-n', '--sizes', required=False, type=str, default='100,1000,10000,100000',
+                        help='Comma separated study sizes in samples (default: 100,1000,10000,100000)')
+    parser.add_argument('-f', '--fixture', required=False, type=str, default=None,
+                        help='Serve this fixture file instead of synthetic ones, -n is ignored')
+    parser.add_argument('-s', '--scripts', required=False, type=str, default=','.join(BENCH_SCRIPTS.keys()),
+                        help='Comma separated scripts to run (default: {})'.format(','.join(BENCH_SCRIPTS.keys())))
+    parser.add_argument('-r', '--repeats', required=False, type=int, default=1, help='Runs of each script per size (default: 1)')
+    parser.add_argument('-o', '--output', required=False, type=str, default=None, help='Write the results table to this file')
+    parser.add_argument('-w', '--workdir', required=False, type=str, default=None,
+                        help='Keep the scratch directories here (default: a temporary directory, removed afterwards)')
+    parser.add_argument('--cache', required=False, action='store_true', default=False,
+                        help='Let the scripts use the BSI query cache (default: run with --no-cache)')
+    parser.add_argument('--latency', required=False, type=float, default=0.0, help='Stand-in seconds added per request')
+    parser.add_argument('--jitter', required=False, type=float, default=0.0, help='Stand-in random +/- seconds on the latency')
+    parser.add_argument('--error-rate', required=False, type=float, default=0.0, help='Stand-in fraction of HTTP 503 responses')
+    parser.add_argument('--expire-rate', required=False, type=float, default=0.0, help='Stand-in fraction of expired sessions')
+
+    args = parser.parse_args()
+
+    scripts = args.scripts.split(',')
+    unknown = [s for s in scripts if s not in BENCH_SCRIPTS]
+    if len(unknown) > 0:
+        err_out("Error: no benchmark setup for {}, choose from {}".format(unknown, list(BENCH_SCRIPTS.keys())))
+
+    if args.fixture is not None:
+        fixtures = [('fixture', load_fixture(args.fixture))]
+    else:
+        fixtures = [(int(n), None) for n in args.sizes.split(',')]
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='bsi_benchmark_')
+    extra_args = [] if args.cache else ['--no-cache']
+
+    results = []
+    for size, fixture in fixtures:
+        if fixture is None:
+            send_update("Building a synthetic fixture of {} samples...".format(size))
+            fixture = make_fixture(size)
+        server = start_standin(fixture, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, expire_rate=args.expire_rate)
+
+        for name in scripts:
+            for rep in range(args.repeats):
+                ws = os.path.join(workdir, str(size), name, str(rep + 1))
+                result = run_script(name, ws, fixture, server.base_url(), extra_args)
+                result.update({'samples': fixture.shape[0], 'script': name, 'repeat': rep + 1})
+                send_update("{:>8} samples  {:<20} run {}: {} {}".format(fixture.shape[0], name, rep + 1,
+                            result['status'], '' if 'seconds' not in result else '{:.2f} s'.format(result['seconds'])))
+                results.append(result)
+
+        server.shutdown()
+        server.server_close()
+
+    columns = ['samples', 'script', 'repeat', 'status', 'seconds', 'bsi_requests', 'bsi_seconds', 'bsi_bytes']
+    table = pd.DataFrame(results).reindex(columns=columns)
+    print("\n" + table.to_string(index=False))
+    if args.output is not None:
+        table.to_csv(args.output, sep='\t', index=False)
+
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        send_update("Script outputs are in " + workdir)
+
+if __name__ == '__main__':
+    main()
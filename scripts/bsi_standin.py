@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bsi_standin.py
+    Local stand-in for the two BSI REST endpoints used by ncbr_bsi.py,
+    common/logon and reports/list, answering from a fixture table instead
+    of the live study.  Used to profile and regression-test the
+    reconciliation scripts without BSI credentials.
+
+    Fixtures are synthetic (generated from a seed, any size) or an
+    anonymized export saved as a tab-delimited file whose header is either
+    BSI field codes (sample.field_274) or ncbr_bsi display names
+    (CRIS Order #).
+
+    Usage:
+        bsi_standin.py fixture -n samples -o fixture.tsv.gz
+        bsi_standin.py serve [-n samples | -f fixture.tsv.gz] [-p port]
+                             [--latency s] [--jitter s] [--error-rate f] [--expire-rate f]
+                             [--page-cap rows | --no-paging]
+
+    Example:
+        bsi_standin.py serve -n 10000 -p 8765 --latency 0.2 &
+        BSI_URL=http://127.0.0.1:8765/api/rest/EBMS csi_to_gris_hg38.py -b 1
+
+    Any user name and password are accepted at logon.
+"""
+
+__author__ = 'Susan Huse'
+__version__ = '1.0.0'
+__copyright__ = 'none'
+
+import sys
+import os
+import re
+import time
+import json
+import uuid
+import random
+import threading
+import urllib.parse
+import argparse
+from argparse import RawTextHelpFormatter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+from ncbr_huse import send_update, err_out
+from ncbr_bsi import BSI_FIELDS, BSI_NAMES
+
+####################################
+#
+# Fixture datasets
+#
+####################################
+# Path under the server root, matching the live API
+STANDIN_PATH = '/api/rest/EBMS'
+# Study every fixture row belongs to
+STANDIN_STUDY = 'NIAID Centralized Sequencing'
+# Samples released per batch in synthetic fixtures
+STANDIN_BATCH_SIZE = 400
+
+# Report header BSI sends for a field code, where it differs from the first ncbr_bsi name
+STANDIN_HEADERS = {'sample.field_252': 'PhenotipsId',
+                   'subject_131.field_161': 'Father PhenotipsId',
+                   'subject_131.field_167': 'Mother PhenotipsId',
+                   'subject_131.field_189': 'Active status',
+                   'sample.subject_id': 'Subject ID'}
+
+# Every field code ncbr_bsi can ask for, in schema order
+def standin_codes():
+    return(list(BSI_NAMES.keys()))
+
+# Report header for a field code
+def standin_header(code):
+    if code in STANDIN_HEADERS:
+        return(STANDIN_HEADERS[code])
+    return(BSI_NAMES[code])
+
+# Build a synthetic study of about n_samples orders in families of one to five
+#   family members share a family ID; some relatives are never sequenced,
+#   some orders are canceled or inactive, and unknown mothers appear as '00'
+def make_fixture(n_samples, seed=0, batch_size=STANDIN_BATCH_SIZE):
+    rng = random.Random(seed)
+    rows = []
+    fam = 0
+    start = pd.Timestamp('2018-06-01')
+
+    while len(rows) < n_samples:
+        fam += 1
+        fam_id = 'FAM{:06d}'.format(fam)
+        size = rng.choice([1, 2, 3, 3, 3, 4, 5])
+        batch_num = len(rows) // batch_size + 1
+        members = []
+        for i in range(size):
+            n = len(rows) + len(members) + 1
+            if i == 0:
+                relationship = 'Proband'
+            elif i == 1:
+                relationship = 'Father'
+            elif i == 2:
+                relationship = 'Mother'
+            else:
+                relationship = 'Sibling'
+            members.append({'n': n, 'relationship': relationship})
+
+        father = members[1]['n'] if size > 1 else None
+        mother = members[2]['n'] if size > 2 else None
+        enrolled = start + pd.Timedelta(days=fam // 10)
+
+        for m in members:
+            n = m['n']
+            pid = 'P{:07d}'.format(n)
+            sequenced = m['relationship'] == 'Proband' or rng.random() < 0.85
+            status = 'Specimen Collected'
+            if rng.random() < 0.02:
+                status = 'Canceled'
+            elif rng.random() < 0.01:
+                status = 'Auto Complete'
+
+            row = {'sample.field_274': '002{:06d}'.format(n),
+                   'sample.field_252': pid,
+                   'subject_131.field_173': pid,
+                   'subject_131.field_170': fam_id,
+                   'subject_131.field_254': 'S{:07d}'.format(n),
+                   'sample.field_323': 'BATCH{:02d}'.format(batch_num),
+                   'subject_131.field_194': 'BATCH{:02d}'.format(batch_num),
+                   'sample.field_324': 'BATCH{:02d}'.format(batch_num) if sequenced else '',
+                   'subject_131.field_195': 'BATCH{:02d}'.format(batch_num) if sequenced else '',
+                   'sample.field_306': 'CIDR',
+                   'subject_131.field_188': 'Complete' if size > 2 else 'Incomplete',
+                   'subject_131.field_157': '{:07d}'.format(fam),
+                   'subject_131.field_182': m['relationship'],
+                   'subject_131.field_150': '2' if m['relationship'] == 'Proband' else '1',
+                   'subject_131.field_189': 'Inactive' if rng.random() < 0.02 else 'Active',
+                   'sample.field_337': 'CIDR{:07d}'.format(n) if sequenced else '',
+                   'sample.field_336': 'DLM{:07d}'.format(n),
+                   'sample.field_314': status,
+                   'sample.subject_id': '{:08d}'.format(n),
+                   'subject_131.field_163': 'M' if m['relationship'] == 'Father' else
+                                            'F' if m['relationship'] == 'Mother' else rng.choice(['M', 'F']),
+                   'sample.sex': '',
+                   'sample.field_297': str((enrolled + pd.Timedelta(days=rng.randint(0, 20))).date()),
+                   'subject_131.field_196': str(enrolled.date())}
+            if m['relationship'] in ['Proband', 'Sibling']:
+                row['subject_131.field_161'] = 'P{:07d}'.format(father) if father else '0'
+                row['subject_131.field_167'] = 'P{:07d}'.format(mother) if mother else '00'
+            else:
+                row['subject_131.field_161'] = '0'
+                row['subject_131.field_167'] = '0'
+            rows.append(row)
+
+    df = pd.DataFrame(rows[:n_samples])
+    for code in standin_codes():
+        if code not in df.columns:
+            df[code] = ''
+    df['subject.study_id'] = STANDIN_STUDY
+    return(df[standin_codes() + ['subject.study_id']])
+
+# Read a fixture file, headers may be field codes or ncbr_bsi display names
+def load_fixture(path):
+    if not os.path.isfile(path):
+        err_out("Error: unable to locate fixture file:  " + path)
+    df = pd.read_csv(path, sep='\t', dtype=str, keep_default_na=False)
+    df.columns = [BSI_FIELDS.get(c, c) for c in df.columns]
+    for code in standin_codes():
+        if code not in df.columns:
+            df[code] = ''
+    if 'subject.study_id' not in df.columns:
+        df['subject.study_id'] = STANDIN_STUDY
+    return(df)
+
+# Write a fixture file with field code headers
+def save_fixture(df, path):
+    df.to_csv(path, sep='\t', index=False)
+
+####################################
+#
+# Report criteria
+#
+####################################
+# Split one criteria parameter into field code, operator and values
+#   operators as built by ncbr_bsi.build_report_url: =, !=, =@ (like), !=@ (not like)
+def parse_criterion(criterion):
+    m = re.match(r'^([A-Za-z_0-9.]+?)(!=@|=@|!=|=)(.*)$', criterion)
+    if m is None:
+        raise ValueError("Malformed criteria: {}".format(criterion))
+    return(m.group(1), m.group(2), m.group(3).split(';'))
+
+# Rows of a fixture column matching any of the values, '*' is a wildcard
+#   like matches anywhere in the value and ignores case, as the mirror's LIKE does
+def match_values(col, values, like):
+    pattern = []
+    for v in values:
+        v = re.escape(v).replace(r'\*', '.*')
+        if like:
+            v = '.*' + v + '.*'
+        pattern.append(v)
+    return(col.str.fullmatch('|'.join(pattern), case=not like))
+
+# Apply every criteria parameter (they are ANDed, the values in one are ORed)
+def filter_fixture(df, criteria):
+    keep = pd.Series(True, index=df.index)
+    for criterion in criteria:
+        code, op, values = parse_criterion(criterion)
+        if code not in df.columns:
+            raise ValueError("Unknown field in criteria: {}".format(code))
+        hit = match_values(df[code], values, op.endswith('@'))
+        if op.startswith('!'):
+            hit = ~hit
+        keep = keep & hit
+    return(df[keep])
+
+####################################
+#
+# HTTP server
+#
+####################################
+class StandinHandler(BaseHTTPRequestHandler):
+    """Answers common/logon and reports/list from the server's fixture."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_text(self, status, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Sleep for the configured latency, then maybe fail the request on purpose
+    def delay_and_inject(self):
+        server = self.server
+        time.sleep(max(0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        if random.random() < server.error_rate:
+            self.send_text(503, 'Service temporarily unavailable (injected error)')
+            return(True)
+        return(False)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        if self.path != STANDIN_PATH + '/common/logon':
+            self.send_text(404, 'Not found')
+            return
+        if self.delay_and_inject():
+            return
+        if form.get('user_name', [''])[0] == '' or form.get('password', [''])[0] == '':
+            self.send_text(200, 'Logon failed: The username, password, and database combination is incorrect')
+            return
+        self.send_text(200, self.server.new_session())
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != STANDIN_PATH + '/reports/list':
+            self.send_text(404, 'Not found')
+            return
+        if self.delay_and_inject():
+            return
+        if not self.server.check_session(self.headers.get('BSI-SESSION-ID')):
+            self.send_text(401, 'Session is invalid or has expired')
+            return
+
+        params = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        fixture = self.server.fixture
+        try:
+            fields = params.get('display_fields', [])
+            missing = [f for f in fields if f not in fixture.columns]
+            if len(fields) == 0 or len(missing) > 0:
+                raise ValueError("Unknown display fields: {}".format(missing))
+            df = filter_fixture(fixture, params.get('criteria', []))
+        except ValueError as e:
+            self.send_text(200, json.dumps({'message': 'Error running report: {}'.format(e)}), 'application/json')
+            return
+
+        df = df[fields]
+        if 'limit' in params and self.server.paging:
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params['limit'][0])
+            if self.server.page_cap is not None:
+                limit = min(limit, self.server.page_cap)
+            df = df.iloc[offset:offset + limit]
+
+        self.send_report([standin_header(f) for f in fields], df)
+
+    # Send the report body in pieces, as a large BSI report arrives
+    def send_report(self, headers, df):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write(text):
+            data = text.encode('utf-8')
+            self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+        try:
+            write('{"headers": ' + json.dumps(headers) + ', "rows": [')
+            rows = df.values.tolist()
+            for i in range(0, len(rows), 1000):
+                text = ', '.join([json.dumps(r) for r in rows[i:i + 1000]])
+                write((', ' if i > 0 else '') + text)
+            write('], "message": "Report generated by the BSI stand-in"}')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # the client closed a prefetched page it did not need
+            self.close_connection = True
+
+class StandinServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the fixture, sessions and fault settings."""
+
+    daemon_threads = True
+
+    def __init__(self, address, fixture, latency=0.0, jitter=0.0, error_rate=0.0, expire_rate=0.0, verbose=False,
+                 paging=True, page_cap=None):
+        ThreadingHTTPServer.__init__(self, address, StandinHandler)
+        self.fixture = fixture
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.expire_rate = expire_rate
+        self.verbose = verbose
+        # paging=False ignores limit/offset, page_cap returns at most that many rows per page
+        self.paging = paging
+        self.page_cap = page_cap
+        self.sessions = set()
+        self._lock = threading.Lock()
+
+    def new_session(self):
+        session = uuid.uuid4().hex
+        with self._lock:
+            self.sessions.add(session)
+        return(session)
+
+    # Is the session valid, expiring it at random when expire_rate is set
+    def check_session(self, session):
+        with self._lock:
+            if session not in self.sessions:
+                return(False)
+            if random.random() < self.expire_rate:
+                self.sessions.discard(session)
+                return(False)
+        return(True)
+
+    # Base URL to give ncbr_bsi (BSI_URL or --bsi-url)
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return('http://{}:{}{}'.format(host, port, STANDIN_PATH))
+
+# Start a stand-in server on a background thread, port 0 picks a free port
+def start_standin(fixture, host='127.0.0.1', port=0, **kwargs):
+    server = StandinServer((host, port), fixture, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return(server)
+
+def main():
+    #
+    # Usage statement
+    #
+    parseStr = 'Local stand-in for the BSI REST API, answering from a fixture.\n\n\
+    Usage:\n\
+        bsi_standin.py fixture -n samples -o fixture.tsv.gz\n\
+        bsi_standin.py serve [-n samples | -f fixture.tsv.gz] [-p port]\n\n\
+    Example:\n\
+        bsi_standin.py serve -n 10000 -p 8765 --latency 0.2\n\
+        BSI_URL=http://127.0.0.1:8765/api/rest/EBMS generate_seqr_ped.py -b 1\n'
+
+    parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    fixture_parser = subparsers.add_parser('fixture', help='Write a synthetic fixture file')
+    fixture_parser.add_argument('-n', '--samples', required=True, type=int, help='Number of samples')
+    fixture_parser.add_argument('-o', '--output', required=True, type=str, help='Output file (tab-delimited, .gz to compress)')
+    fixture_parser.add_argument('--seed', required=False, type=int, default=0, help='Random seed (default: 0)')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve a fixture over HTTP')
+    source = serve_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-n', '--samples', type=int, help='Serve a synthetic fixture of this many samples')
+    source.add_argument('-f', '--fixture', type=str, help='Serve this fixture file')
+    serve_parser.add_argument('--seed', required=False, type=int, default=0, help='Random seed for -n (default: 0)')
+    serve_parser.add_argument('--host', required=False, type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('-p', '--port', required=False, type=int, default=8765, help='Port, 0 for any free port (default: 8765)')
+    serve_parser.add_argument('--latency', required=False, type=float, default=0.0, help='Seconds added to every request (default: 0)')
+    serve_parser.add_argument('--jitter', required=False, type=float, default=0.0, help='Random +/- seconds on the latency (default: 0)')
+    serve_parser.add_argument('--error-rate', required=False, type=float, default=0.0,
+                              help='Fraction of requests answered with HTTP 503 (default: 0)')
+    serve_parser.add_argument('--expire-rate', required=False, type=float, default=0.0,
+                              help='Fraction of report requests whose session is expired (default: 0)')
+    paging = serve_parser.add_mutually_exclusive_group()
+    paging.add_argument('--page-cap', required=False, type=int, default=None,
+                        help='Return at most this many rows per page, whatever limit asks for')
+    paging.add_argument('--no-paging', required=False, action='store_true', default=False,
+                        help='Ignore limit and offset, always send the whole report')
+    serve_parser.add_argument('-v', '--verbose', required=False, action='store_true', default=False, help='Log every request')
+
+    args = parser.parse_args()
+
+    if args.command == 'fixture':
+        save_fixture(make_fixture(args.samples, args.seed), args.output)
+        send_update("Wrote {} samples to {}".format(args.samples, args.output))
+
+    elif args.command == 'serve':
+        if args.fixture is not None:
+            fixture = load_fixture(args.fixture)
+        else:
+            fixture = make_fixture(args.samples, args.seed)
+
+        server = StandinServer((args.host, args.port), fixture, args.latency, args.jitter,
+                               args.error_rate, args.expire_rate, args.verbose,
+                               paging=not args.no_paging, page_cap=args.page_cap)
+        # first line of output is the base URL, read by bsi_benchmark.py
+        print(server.base_url(), flush=True)
+        send_update("Serving {} fixture rows, press Ctrl-C to stop".format(fixture.shape[0]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
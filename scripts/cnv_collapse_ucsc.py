@@ -10,6 +10,16 @@ Leidos Biomedical
 cnv_collapse.py
     Collapses multiple CNVs and respective fields from the same gene into one row per gene
 
+    How each field is collapsed is declared once in COLLAPSE_SPEC, and every
+    rule runs over all genes at once: the rows of a gene are one group of a
+    single groupby, and numeric fields are parsed once per column.
+
+    The table is streamed: it is read --chunk-size rows at a time and each
+    gene is collapsed and written once all of its rows are read, so memory
+    does not grow with the table.  The first pass over the file checks that
+    each gene's rows are together, and a table where they are not (e.g.
+    WGS callsets sorted by position) is first sorted by gene on disk.
+
 AnnotSV Manual:
 https://lbgi.fr/AnnotSV/Documentation/README.AnnotSV_latest.pdf
 
@@ -23,344 +33,563 @@ import pandas as pd
 import numpy as np
 import argparse
 import os
+import glob
+import time
+import multiprocessing
+import csv
+import heapq
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from ncbr_huse import test_file, err_out
+from ncbr_cytoband import CYTOBAND_FILES, NO_BAND, load_cytobands
 from argparse import RawTextHelpFormatter
 
-# returns all unique values if there are multiple. If not, returns the first instance of the value
-def get_unique_values(repeat_values, delims, out_delim):
-
-    vals = []
-
-    # Split up the repeated values into individual values from the arrays of values for each gene repeat
-    for value in repeat_values:
-        if pd.isnull(value) == False and value != '-':
-            split_vals = re.split(delims, str(value))
-            vals = vals + split_vals
-            
-    # No values so fill in with placeholder
-    if not vals:
-        return None 
-    
-    # Only keep the unique values, separated by specified output delimiter
-    output = out_delim.join(pd.Series(vals).unique())
-    
+# Batch mode input files and default combined table
+CANDIDATE_SUFFIX = '.candidate.cnvs'
+COMBINED_FNAME = 'cnv_collapsed_batch.txt'
+# Rows of the AnnotSV table read at a time
+CHUNK_ROWS = 50000
+
+# How each AnnotSV field is collapsed into one row per gene: (field, rule, rule arguments...)
+#   first / last      value of the gene's first or last row
+#   sum               sum over the gene's rows
+#   min / max         smallest or largest value, ignoring -1 and '-' (lists like "3,5" are split first)
+#   unique            unique values split on a regex and joined with a delimiter, in order of appearance
+#   gd_keys/gd_values GD_ID and a GD field of the first row, as GD_ID keyed pairs
+#   span              location from the first to the last row when they differ
+#   inheritance       unique, then trimmed of a leading ',' and trailing ', '
+# Fields not listed are left blank, Phenotips ID, MergeCount, CytoBand and AnnotSV ID are made in collapse_cnvs()
+COLLAPSE_SPEC = [('SV type', 'first'),
+                 ('SV chrom', 'first'),
+                 ('SV start', 'first'),
+                 ('SV end', 'last'),
+                 ('SV length', 'sum'),
+                 ('CopyNumber', 'first'),
+                 ('AnnotSV type', 'first'),
+                 ('Gene name', 'first'),
+                 ('NM', 'first'),
+                 ('CDS length', 'sum'),
+                 ('tx length', 'sum'),
+                 ('location', 'span'),
+                 ('intersectStart', 'first'),
+                 ('intersectEnd', 'last'),
+                 ('DGV_GAIN_IDs', 'unique', ',', ', '),
+                 ('DGV_GAIN_n_samples_with_SV', 'min'),
+                 ('DGV_GAIN_n_samples_tested', 'min'),
+                 ('DGV_GAIN_Frequency', 'min'),
+                 ('DGV_LOSS_IDs', 'unique', ',', ', '),
+                 ('DGV_LOSS_n_samples_with_SV', 'min'),
+                 ('DGV_LOSS_n_samples_tested', 'min'),
+                 ('DGV_LOSS_Frequency', 'min'),
+                 ('GD_ID', 'gd_keys', 'GD_AN'),
+                 ('GD_AN', 'gd_values', 'GD_AN'),
+                 ('GD_N_HET', 'gd_values', 'GD_N_HET'),
+                 ('GD_N_HOMALT', 'gd_values', 'GD_N_HOMALT'),
+                 ('GD_AF', 'min'),
+                 ('GD_POPMAX_AF', 'min'),
+                 ('GD_ID_others', 'unique', ';', ', '),
+                 ('DDD_SV', 'unique', ';', ', '),
+                 ('DDD_DUP_n_samples_with_SV', 'max'),
+                 ('DDD_DUP_Frequency', 'max'),
+                 ('DDD_DEL_n_samples_with_SV', 'max'),
+                 ('DDD_DEL_Frequency', 'max'),
+                 ('1000g_event', 'unique', ';', ', '),
+                 ('1000g_AF', 'min'),
+                 ('1000g_max_AF', 'min'),
+                 ('IMH_ID', 'unique', ';', ', '),
+                 ('IMH_AF', 'min'),
+                 ('IMH_ID_others', 'unique', ';', ', '),
+                 ('Mappability', 'first'),
+                 ('NA12878_mode_CN', 'first'),
+                 ('Repeatability_Score', 'min'),
+                 ('promoters', 'unique', ',', ', '),
+                 ('dbVar_event', 'unique', ',', ', '),
+                 ('dbVar_variant', 'unique', ',', ', '),
+                 ('dbVar_status', 'unique', ',', ', '),
+                 ('TADcoordinates', 'unique', ',', ', '),
+                 ('ENCODEexperiments', 'unique', ',', ', '),
+                 ('#hom', 'unique', ',', ', '),
+                 ('#htz', 'unique', ',', ', '),
+                 ('GCcontent_left', 'first'),
+                 ('GCcontent_right', 'last'),
+                 ('Repeats_coord_left', 'first'),
+                 ('Repeats_coord_right', 'last'),
+                 ('Repeats_type_left', 'first'),
+                 ('Repeats_type_right', 'last'),
+                 ('ACMG', 'unique', ',', ', '),
+                 ('HI_CGscore', 'min'),
+                 ('TriS_CGscore', 'unique', ',', ', '),
+                 ('DDD_status', 'unique', '/', '/'),
+                 ('DDD_mode', 'unique', '/', '/'),
+                 ('DDD_consequence', 'unique', '/', ', '),
+                 ('DDD_disease', 'unique', '/', ', '),
+                 ('DDD_pmids', 'unique', '//|;|/', ', '),
+                 ('HI_DDDpercent', 'min'),
+                 ('synZ_ExAC', 'max'),
+                 ('misZ_ExAC', 'max'),
+                 ('pLI_ExAC', 'max'),
+                 ('delZ_ExAC', 'max'),
+                 ('dupZ_ExAC', 'max'),
+                 ('cnvZ_ExAC', 'max'),
+                 ('morbidGenes', 'unique', ',', ', '),
+                 ('morbidGenesCandidates', 'unique', ',', ', '),
+                 ('Mim Number', 'unique', ';', ', '),
+                 ('Phenotypes', 'unique', '/|;', '; '),
+                 ('Inheritance', 'inheritance', ',|//|/|;', ', '),
+                 ('AnnotSV ranking', 'max')]
+
+class GeneGroups(object):
+    """Rows of the AnnotSV table grouped by gene.
+
+    A gene's rows run from its first row to the first row of the next new
+    gene, so the table is expected to list each gene's rows together, as
+    collapse_file() makes sure of.
+    group holds each row's gene number, first and last each gene's first
+    and last row.
+    """
+
+    def __init__(self, genes):
+        new_gene = ~genes.duplicated().to_numpy()
+        self.first = np.flatnonzero(new_gene)
+        self.last = np.append(self.first[1:], len(genes)) - 1
+        self.group = np.cumsum(new_gene) - 1
+        self.size = len(self.first)
+
+    # One value per gene from a per-gene Series, None for genes without one
+    def per_gene(self, values):
+        return values.astype(object).reindex(range(self.size)).where(lambda s: s.notna(), None).to_numpy()
+
+    # Values of a column with each row's gene number as the index
+    def by_gene(self, values):
+        return pd.Series(values.to_numpy(), index=self.group)
+
+    # Joins text values listed in gene order into one string per gene present, as a Series by gene number
+    def join(self, gene_numbers, values, delim):
+        present, starts = np.unique(gene_numbers, return_index=True)
+        ends = np.append(starts[1:], len(values))
+        return pd.Series([delim.join(values[a:b]) for a, b in zip(starts, ends)], index=present, dtype=object)
+
+# Returns the value of the gene's first or last row
+def collapse_first(cnv_tab, field, genes):
+    return cnv_tab[field].to_numpy()[genes.first]
+
+def collapse_last(cnv_tab, field, genes):
+    return cnv_tab[field].to_numpy()[genes.last]
+
+# Returns the sum of the gene's rows, text fields are concatenated as Series.sum() does
+def collapse_sum(cnv_tab, field, genes):
+    values = genes.by_gene(cnv_tab[field])
+    if not pd.api.types.is_numeric_dtype(cnv_tab[field]):
+        return values.groupby(level=0).agg(lambda s: s.sum()).to_numpy()
+    return values.groupby(level=0).sum().to_numpy()
+
+# Values that count towards a min or max, excluding -1 and '-'
+#   text values listing several numbers ("3,5") are split and all kept, other text is compared as text
+def extreme_candidates(cnv_tab, field, genes):
+    values = genes.by_gene(cnv_tab[field])
+    if pd.api.types.is_numeric_dtype(cnv_tab[field]):
+        return values[values > -1.0]
+
+    values = values[values.notna()].astype(str)
+    listed = values.str.contains(',', regex=False)
+    single = values[~listed & (values != '-')]
+    single = single[pd.to_numeric(single, errors='coerce') > -1.0]
+    return pd.concat([values[listed].str.split(',').explode(), single])
+
+# Returns the min or max number of the gene's rows, None if there is none
+#   text is ranked once with a sorted factorize so the groupby stays on integer codes
+def collapse_extreme(cnv_tab, field, genes, how):
+    values = extreme_candidates(cnv_tab, field, genes)
+    if pd.api.types.is_numeric_dtype(values):
+        return genes.per_gene(values.groupby(level=0).agg(how))
+    codes, ranked = pd.factorize(values.to_numpy(dtype=object), sort=True)
+    codes = pd.Series(codes, index=values.index).groupby(level=0).agg(how)
+    return genes.per_gene(pd.Series(ranked.take(codes.to_numpy()), index=codes.index))
+
+def collapse_min(cnv_tab, field, genes):
+    return collapse_extreme(cnv_tab, field, genes, 'min')
+
+def collapse_max(cnv_tab, field, genes):
+    return collapse_extreme(cnv_tab, field, genes, 'max')
+
+# Returns all unique values of the gene's rows split on delims and joined by out_delim, None if there are none
+def collapse_unique(cnv_tab, field, genes, delims, out_delim):
+    values = genes.by_gene(cnv_tab[field])
+    values = values[values.notna() & (values != '-')]
+    pieces = dict([(v, re.split(delims, str(v))) for v in pd.unique(values.to_numpy())])
+
+    # Split up the repeated values into individual values, keeping the first of each within a gene
+    split = values.map(pieces).explode()
+    split = pd.DataFrame({'gene': split.index, 'value': split.to_numpy()}).drop_duplicates()
+    output = genes.join(split['gene'].to_numpy(), split['value'].tolist(), out_delim)
+
     # Cleans up the output if input results in multiple spaces returned or weird commas
-    if output[0] == out_delim:
-        output = output[2:]
-    if output[len(output) - 2:] == out_delim + ' ':
-        output = output[:len(output) - 2]
-            
-    output = re.sub(' +', ' ', str(output))
-    
-    return output
-
-# Returns the max number from values excluding -1 and '-'
-def get_max(values):
-    
-    values = values.tolist()
-    to_max = []
-    
-    # filter out unwanted chars
-    for val in values:
-        if isinstance(val, str) and ',' in val:
-#            print('Its a string!')
-            nums = val.split(',')
-            for num in nums:
-                to_max.append(num)
-        elif val != '-':
-            if float(val) > -1.0:
-#                print(type(val))
-#                print(val)
-                to_max.append(val)
-    if len(to_max) == 0:
-        return None
-    
-    
-    return max(to_max)
-
-# Returns the min number from values excluding -1 and '-'
-def get_min(values):
-
-    values = values.tolist()
-    to_min = []
-    
-    # filter out unwanted chars
-    for val in values:
-        if isinstance(val, str) and ',' in val:
-#            print('Its a string!')
-            nums = val.split(',')
-            for num in nums:
-                to_min.append(num)
-        elif val != '-':
-            if float(val) > -1.0:
-#                print(type(val))
-#                print(val)
-                to_min.append(val)
-    if len(to_min) == 0:
-        return None
-    
-    return min(to_min)
-
-#Deals with all GD fields: list of numbers from gd_field that correspond to each GD_ID
-def get_corresp_number(cnv_tab, gene_ind, next_gene_ind, gd_field):
-
-    #creates the dict to store GD ID as key and number as value
-    keys = str(cnv_tab['GD_ID'][gene_ind]).split(';')
-    vals = str(cnv_tab[gd_field][gene_ind]).split(';')
-    gd_dict = dict(zip(keys, vals))
-    
-    #loads in other IDs and keys as long as they don't repeat
-    for i in range(gene_ind + 1, next_gene_ind):
-        keys = str(cnv_tab['GD_ID'][i]).split(';')
-        vals = str(cnv_tab[gd_field][i]).split(';')
-        key_ind = 0
-        for key in keys:
-            if key not in gd_dict:
-                gd_dict[key] : vals[key_ind]
-            key_ind = key_ind + 1
-            
-    return gd_dict
-     
-def get_keys(gd_dict):
-    key_list = []
-    
-    for key in gd_dict.keys():
-        key_list.append(str(key))
-        
-    return ', '.join(key_list)
-
-def get_vals(gd_dict):
-    val_list = []
-    
-    for val in gd_dict.values():
-        val_list.append(str(val))
-        
-    return ', '.join(val_list)
+    if len(out_delim) == 1:
+        output = output.where(~output.str.startswith(out_delim), output.str[2:])
+        output = output.where(~output.str.endswith(out_delim + ' '), output.str[:-2])
+    output = output.str.replace(' +', ' ', regex=True)
+    return genes.per_gene(output)
+
+# Unique Inheritance values, cleaned up once more; genes without any are written as 'None'
+def collapse_inheritance(cnv_tab, field, genes, delims, out_delim):
+    inher = pd.Series(collapse_unique(cnv_tab, field, genes, delims, out_delim))
+    known = inher.notna()
+    inher[known] = inher[known].where(~inher[known].str.startswith(','), inher[known].str[2:])
+    inher[known] = inher[known].where(~inher[known].str.endswith(', '), inher[known].str[:-2])
+    return inher.where(known, 'None').str.replace(' +', ' ', regex=True).to_numpy()
+
+# Deals with all GD fields: the GD_ID keys, or the gd_field numbers that go with them, of the gene's first row
+def gd_pairs(cnv_tab, gd_field, genes):
+    keys = cnv_tab['GD_ID'].to_numpy()[genes.first]
+    vals = cnv_tab[gd_field].to_numpy()[genes.first]
+    return [dict(zip(str(k).split(';'), str(v).split(';'))) for k, v in zip(keys, vals)]
+
+def collapse_gd_keys(cnv_tab, field, genes, gd_field):
+    return np.array([', '.join([str(key) for key in gd_dict.keys()]) for gd_dict in gd_pairs(cnv_tab, gd_field, genes)], dtype=object)
+
+def collapse_gd_values(cnv_tab, field, genes, gd_field):
+    return np.array([', '.join([str(val) for val in gd_dict.values()]) for gd_dict in gd_pairs(cnv_tab, gd_field, genes)], dtype=object)
+
+# Store first and last locations if there are multiple. If not, take the first instance of the location
+def collapse_span(cnv_tab, field, genes):
+    locations = collapse_first(cnv_tab, field, genes).astype(object)
+    last = collapse_last(cnv_tab, field, genes)
+    several = genes.by_gene(cnv_tab[field]).groupby(level=0).nunique().to_numpy() > 1
+
+    for i in np.flatnonzero(several):
+        loc1 = locations[i]
+        loc2 = last[i]
+        # if the first location is past the last location, switch them when concatenating
+        if re.search(r'\d+', loc1).group() > re.search(r'\d+', loc2).group():
+            locations[i] = loc2[:loc2.find('-')] + loc1[loc1.find('-'):]
+        else:
+            locations[i] = loc1[:loc1.find('-')] + loc2[loc2.find('-'):]
+    return locations
+
+COLLAPSE_RULES = {'first': collapse_first,
+                  'last': collapse_last,
+                  'sum': collapse_sum,
+                  'min': collapse_min,
+                  'max': collapse_max,
+                  'unique': collapse_unique,
+                  'inheritance': collapse_inheritance,
+                  'gd_keys': collapse_gd_keys,
+                  'gd_values': collapse_gd_values,
+                  'span': collapse_span}
+
+# Collapse the CNVs of one AnnotSV table into one row per gene
+#   genes with more than one SV type are left out and written to the log
+def collapse_cnvs(cnv_tab, phen_ID, cytobands, logfile):
+    fields = ['Phenotips ID', 'MergeCount', 'CytoBand'] + cnv_tab.columns.tolist()
+    genes = GeneGroups(cnv_tab['Gene name'])
+
+    # Make sure the CNV type is the same across all gene repeats. If not, exclude gene from final table
+    keep = genes.by_gene(cnv_tab['SV type']).groupby(level=0).nunique().reindex(range(genes.size), fill_value=0).to_numpy() == 1
+    gene_names = collapse_first(cnv_tab, 'Gene name', genes)
+    for name in gene_names[~keep]:
+        logfile.write('Error: DEL and DUP in gene ' + str(name) + '... not including in output file.\n')
+
+    final = dict([(field, np.full(keep.sum(), '', dtype=object)) for field in fields])
+    for spec in COLLAPSE_SPEC:
+        field, rule, rule_args = spec[0], spec[1], spec[2:]
+        if field in final:
+            final[field] = COLLAPSE_RULES[rule](cnv_tab, field, genes, *rule_args)[keep]
+
+    final['Phenotips ID'] = np.full(keep.sum(), phen_ID, dtype=object)
+    final['MergeCount'] = (genes.last - genes.first + 1)[keep]
+
+    # look up the cytoband of each segment start in the cytoband index
+    final['CytoBand'] = cytobands.label(['chr' + str(c) for c in final['SV chrom']], final['SV start'])
+    for i in range(np.sum(final['CytoBand'] == NO_BAND)):
+        print('Warning: Variant not found in CytoBand data!')
+
+    # Concatenate new SV ID from updated SV info
+    final['AnnotSV ID'] = np.array([str(c) + '_' + str(s) + '_' + str(e) + '_' + t for c, s, e, t in
+                                    zip(final['SV chrom'], final['SV start'], final['SV end'], final['SV type'])], dtype=object)
+
+    final_tab = pd.DataFrame(final, columns=fields)
+
+    # Remove blank placeholders
+    return final_tab.replace('-', '')
+
+# Gene of each row as text, '' for rows without one
+def gene_keys(chunk):
+    genes = chunk['Gene name'].astype(object)
+    return genes.where(genes.notna(), '').astype(str).to_numpy(dtype=object)
+
+# dtype kind of a column over the whole table, from the kinds its chunks were read with
+#   int and float chunks widen to float, any other mix is read as text, as one read_csv of the file would do
+def widen_kind(kind, dtype):
+    new_kind = dtype.kind if dtype.kind in 'bf' else ('i' if dtype.kind in 'iu' else 'O')
+    if kind is None or kind == new_kind:
+        return new_kind
+    if set([kind, new_kind]) == set(['i', 'f']):
+        return 'f'
+    return 'O'
+
+# First pass over the AnnotSV table, chunk_rows rows at a time
+#   returns the dtype of each column over the whole file, the order genes first appear in,
+#   and whether each gene's rows are together
+def scan_table(infile, chunk_rows):
+    kinds = dict()
+    ranks = dict()
+    contiguous = True
+    previous = None
+
+    for chunk in pd.read_csv(infile, delimiter = "\t", chunksize = chunk_rows, low_memory = False):
+        for col in chunk.columns:
+            kinds[col] = widen_kind(kinds.get(col), chunk[col].dtype)
+
+        # first row of each run of one gene, a run going on from the previous chunk is not a new one
+        keys = gene_keys(chunk)
+        if len(keys) == 0:
+            continue
+        runs = np.ones(len(keys), dtype=bool)
+        runs[1:] = keys[1:] != keys[:-1]
+        runs[0] = keys[0] != previous
+        for key in keys[runs]:
+            if key in ranks:
+                contiguous = False
+            else:
+                ranks[key] = len(ranks)
+        previous = keys[-1]
+
+    dtypes = dict([(col, {'i': 'int64', 'f': 'float64', 'b': 'bool', 'O': str}[kind]) for col, kind in kinds.items()])
+    return dtypes, ranks, contiguous
+
+# External sort of the table by gene, genes in the order they first appear and each gene's rows in file order
+#   sorted runs of chunk_rows rows are written to workdir and merged into workdir/sorted.txt, which is returned
+def sort_by_gene(infile, ranks, chunk_rows, workdir):
+    runs = []
+    columns = None
+    offset = 0
+    for chunk in pd.read_csv(infile, delimiter = "\t", chunksize = chunk_rows, dtype = str):
+        columns = chunk.columns.tolist()
+        keys = pd.DataFrame({'rank': [ranks[key] for key in gene_keys(chunk)],
+                             'row': np.arange(offset, offset + len(chunk))})
+        offset += len(chunk)
+        order = keys.sort_values(['rank', 'row']).index
+        run = pd.concat([keys.loc[order].reset_index(drop=True), chunk.iloc[order].reset_index(drop=True)], axis=1)
+        runs.append(os.path.join(workdir, 'run{}.txt'.format(len(runs))))
+        run.to_csv(runs[-1], index = False, header = False, sep = '\t')
+
+    sorted_fname = os.path.join(workdir, 'sorted.txt')
+    handles = [open(run, 'r', newline='') for run in runs]
+    try:
+        with open(sorted_fname, 'w', newline='') as out:
+            writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+            if columns is None:
+                columns = pd.read_csv(infile, delimiter = "\t", nrows = 0).columns.tolist()
+            writer.writerow(columns)
+            readers = [csv.reader(f, delimiter='\t') for f in handles]
+            for row in heapq.merge(*readers, key=lambda row: (int(row[0]), int(row[1]))):
+                writer.writerow(row[2:])
+    finally:
+        for f in handles:
+            f.close()
+    return sorted_fname
+
+# Chunks of whole genes: each chunk's last gene is held back until the next chunk shows where it ends
+#   the rows of a gene are expected together, a chunk grows to hold a gene longer than chunk_rows
+def gene_chunks(chunks):
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index = True)
+        if chunk.shape[0] == 0:
+            continue
+        last_gene = GeneGroups(chunk['Gene name']).first[-1]
+        if last_gene > 0:
+            yield chunk.iloc[:last_gene]
+        carry = chunk.iloc[last_gene:]
+    if carry is not None:
+        yield carry
+
+# Collapse one sample's candidate CNV file into outdir/<Phenotips ID>_cnv.txt, with its log
+#   the table is read chunk_rows rows at a time and each gene written as soon as its rows are read,
+#   a table whose genes are not together is first sorted by gene in tmpdir
+#   returns the output file and the number of genes written
+def collapse_file(infile, outdir, cytobands, chunk_rows=CHUNK_ROWS, tmpdir=None):
+    phen_ID = re.search(r'P\d{7}', infile).group()
+
+    logfile = open(outdir + '/cnv_' + phen_ID + '_log.txt', 'w')
+    logfile.write('************ cnv_collapse.py error log: ' + phen_ID + ' ************ \n')
+
+    hom_num = '#hom(' + phen_ID + ')'
+    htz_num = '#htz(' + phen_ID + ')'
+    renames = {hom_num:'#hom', htz_num:'#htz'}
+
+    print('Analysis started:   ' + phen_ID)
+
+    dtypes, ranks, contiguous = scan_table(infile, chunk_rows)
+    workdir = None
+    source = infile
+    if not contiguous:
+        print('Note: rows of the same gene are not together in {}, sorting by gene first'.format(infile))
+        workdir = tempfile.mkdtemp(prefix='cnv_collapse_', dir=tmpdir)
+        source = sort_by_gene(infile, ranks, chunk_rows, workdir)
+
+    # write out each chunk of collapsed genes
+    outfname = outdir + '/' + phen_ID + '_cnv.txt'
+    genes = 0
+    header = True
+    try:
+        with open(outfname, 'w') as out:
+            for cnv_tab in gene_chunks(pd.read_csv(source, delimiter = "\t", chunksize = chunk_rows, dtype = dtypes)):
+                cnv_tab = cnv_tab.rename(columns = renames)
+                final_tab = collapse_cnvs(cnv_tab, phen_ID, cytobands, logfile)
+                final_tab.to_csv(out, index = False, sep = '\t', header = header)
+                genes += final_tab.shape[0]
+                header = False
+            if header:
+                columns = pd.read_csv(infile, delimiter = "\t", nrows = 0).rename(columns = renames).columns.tolist()
+                pd.DataFrame(columns = ['Phenotips ID', 'MergeCount', 'CytoBand'] + columns).to_csv(out, index = False, sep = '\t')
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    print("{} successfully written by cnv_collapse.py".format(outfname))
+    print()
+
+    logfile.close()
+    return outfname, genes
+
+# Candidate CNV files of a batch: listed one per line in a manifest, or found in a directory and its sample subdirectories
+def batch_candidates(indir=None, manifest=None):
+    if manifest is not None:
+        with open(manifest, 'r') as f:
+            return [line.strip() for line in f if line.strip() != '' and not line.startswith('#')]
+    return sorted(glob.glob(os.path.join(indir, '*' + CANDIDATE_SUFFIX)) + glob.glob(os.path.join(indir, '*', '*' + CANDIDATE_SUFFIX)))
+
+# Collapse one sample of a batch in a pool worker, into outdir or next to its input
+#   the cytoband index comes from the parent process, already loaded
+def collapse_batch_sample(infile, outdir, reference, chunk_rows, tmpdir):
+    start = time.time()
+    sample_outdir = outdir if outdir is not None else (os.path.dirname(infile) or '.')
+    try:
+        outfname, genes = collapse_file(infile, sample_outdir, load_cytobands(reference), chunk_rows, tmpdir)
+        status = 'ok'
+    except Exception as e:
+        outfname, genes = None, ''
+        status = 'error: {}'.format(e)
+    return outfname, genes, status, round(time.time() - start, 3)
+
+# Combined table of the samples' collapsed files, copied chunk_rows rows at a time as text
+#   samples with different columns are aligned on all of their columns
+def write_combined(fnames, combined, chunk_rows):
+    columns = []
+    for fname in fnames:
+        columns += [col for col in pd.read_csv(fname, delimiter = "\t", nrows = 0).columns if col not in columns]
+
+    with open(combined, 'w') as out:
+        header = True
+        for fname in fnames:
+            for chunk in pd.read_csv(fname, delimiter = "\t", chunksize = chunk_rows, dtype = str, keep_default_na = False):
+                chunk.reindex(columns = columns).to_csv(out, index = False, sep = '\t', header = header)
+                header = False
+        if header:
+            pd.DataFrame(columns = columns).to_csv(out, index = False, sep = '\t')
+
+# Collapse every candidate file on a process pool, write the combined table and the per-sample timing
+#   returns the number of samples that failed
+def collapse_batch(infiles, outdir, combined, reference, workers, chunk_rows=CHUNK_ROWS, tmpdir=None):
+    # load the reference once here, forked workers share it copy-on-write
+    load_cytobands(reference)
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        jobs = [pool.submit(collapse_batch_sample, infile, outdir, reference, chunk_rows, tmpdir) for infile in infiles]
+        results = [job.result() for job in jobs]
+
+    outputs = []
+    timing = []
+    for infile, (outfname, genes, status, seconds) in zip(infiles, results):
+        phen_ID = re.search(r'P\d{7}', infile)
+        timing.append({'Phenotips ID': phen_ID.group() if phen_ID is not None else '',
+                       'Candidates': infile,
+                       'Genes': genes,
+                       'Seconds': seconds,
+                       'Status': status})
+        if outfname is not None:
+            outputs.append(outfname)
+        print("{:<10} {:>8} genes {:>8.2f} s  {}".format(timing[-1]['Phenotips ID'], genes, seconds, status))
+
+    if len(outputs) > 0:
+        write_combined(outputs, combined, chunk_rows)
+    timing_fname = os.path.splitext(combined)[0] + '_timing.txt'
+    pd.DataFrame(timing).to_csv(timing_fname, index = False, sep = '\t')
+    print("{} samples collapsed into {}, timing in {}".format(len(outputs), combined, timing_fname))
+    return len(infiles) - len(outputs)
 
 def main():
 
     # Usage statement and input
     parseStr = 'Takes in CNV text file and collapses multiple rows for CNVs in the same gene into one row per gene\n\
     with a list of correpsonding CNVs. Related fields are concatenated, max/min, etc. into on row. \n\
-    Output is saved into input directory to PhenotipdsID_cnv.txt\n\n'
+    Output is saved into input directory to PhenotipdsID_cnv.txt\n\n\
+    A whole batch is collapsed on a process pool with -d (a directory holding the candidate files\n\
+    or per-sample directories of them) or -m (a file listing the candidate files), writing each\n\
+    sample next to its input (or into -o), one combined table and the per-sample timing.\n\n\
+    Usage:\n\
+        cnv_collapse_ucsc.py -i P0000001.candidate.cnvs -o outdir\n\
+        cnv_collapse_ucsc.py -d CNV_100/gatk [-s combined.txt] [-w workers]\n\
+        cnv_collapse_ucsc.py -m candidates.txt [-o outdir] [-s combined.txt] [-w workers]\n\n'
 
     parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
-    parser.add_argument('-i', '--infile', required=True, nargs='?', type=str, default=None, 
-                        help='Input text file containing AnnotSV IDs and multiple rows of CNVs per gene to be collapsed.')   
-    parser.add_argument('-o', '--outdir', required=True, action='store', type=str, default=None, 
-                        help='Directory to store the output file in.')
-    
-    
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-i', '--infile', nargs='?', type=str, default=None,
+                        help='Input text file containing AnnotSV IDs and multiple rows of CNVs per gene to be collapsed.')
+    inputs.add_argument('-d', '--indir', type=str, default=None,
+                        help='Batch mode: directory of *{} files, directly or one directory down.'.format(CANDIDATE_SUFFIX))
+    inputs.add_argument('-m', '--manifest', type=str, default=None,
+                        help='Batch mode: file listing the candidate CNV files, one per line.')
+    parser.add_argument('-o', '--outdir', required=False, action='store', type=str, default=None,
+                        help='Directory to store the output file in, required with -i.\n\
+Batch mode writes each sample next to its input by default.')
+    parser.add_argument('-c', '--cytobands', required=False, type=str, default='hg19',
+                        help='Reference ({}) or cytoBand file to take the bands from (default: hg19).'.format(', '.join(CYTOBAND_FILES.keys())))
+    parser.add_argument('-s', '--combined', required=False, type=str, default=None,
+                        help='Batch mode: combined table of all samples (default: {} in -o, or here).'.format(COMBINED_FNAME))
+    parser.add_argument('-k', '--chunk-size', required=False, type=int, default=CHUNK_ROWS,
+                        help='Rows of the input table read at a time (default: {}).'.format(CHUNK_ROWS))
+    parser.add_argument('-T', '--tmpdir', required=False, type=str, default=None,
+                        help='Directory for sorting tables whose genes are not together (default: system temp).')
+    parser.add_argument('-w', '--workers', required=False, type=int, default=min(8, os.cpu_count() or 1),
+                        help='Batch mode: number of worker processes (default: up to 8).')
+
+
     args = parser.parse_args()
     infile = args.infile
     outdir = args.outdir
 
+    if infile is None:
+        if args.indir is not None and not os.path.isdir(args.indir):
+            err_out("Error: unable to locate input directory:  " + args.indir)
+        if args.manifest is not None:
+            test_file(args.manifest)
+        infiles = batch_candidates(args.indir, args.manifest)
+        if len(infiles) == 0:
+            err_out("Error: no candidate CNV files found in " + (args.indir or args.manifest))
+        for fname in infiles:
+            test_file(fname)
+        unnamed = [fname for fname in infiles if re.search(r'P\d{7}', fname) is None]
+        if len(unnamed) > 0:
+            err_out("Error: no Phenotips ID in the name of candidate file(s): {}".format(', '.join(unnamed)))
+        combined = args.combined if args.combined is not None else os.path.join(outdir or '.', COMBINED_FNAME)
+
+        failed = collapse_batch(infiles, outdir, combined, args.cytobands, max(1, args.workers), max(1, args.chunk_size), args.tmpdir)
+        if failed > 0:
+            err_out("Error: {} of {} samples could not be collapsed".format(failed, len(infiles)))
+        return
+
     # Check if file exists first
     if infile:
         test_file(infile)
+    if outdir is None:
+        err_out("Error: -o/--outdir is required with -i")
 
-    phen_ID = re.search(r'P\d{7}', infile).group()
+    collapse_file(infile, outdir, load_cytobands(args.cytobands), max(1, args.chunk_size), args.tmpdir)
 
-#    outdir = infile[:re.search(r'P\d{7}.candidate', infile).span()[0]]
-    logfile = open(outdir + '/cnv_' + phen_ID + '_log.txt', 'w')
-    logfile.write('************ cnv_collapse.py error log: ' + phen_ID + ' ************ \n')
-    cytobands = pd.read_csv('/hpcdata/dir/SCRIPTS/cytoBand.txt', delimiter = '\t', names = ['chrom', 'start', 'end', 'cytoband', 'geistain'])
-    
-    cnv_tab = pd.read_csv(infile, delimiter = "\t")
-    hom_num = '#hom(' + phen_ID + ')'
-    htz_num = '#htz(' + phen_ID + ')'
-    cnv_tab.rename(columns = {hom_num:'#hom', htz_num:'#htz'}, inplace = True)
-    
-    fields = ['Phenotips ID', 'MergeCount', 'CytoBand'] + cnv_tab.columns.tolist()
-#    fields.remove('SV length')
-
-    final_tab = pd.DataFrame(columns = fields)  #table to be output at the end
-  
-    print('Analysis started:   ' + phen_ID) 
-    
-    # Get indeces of the first occurrence of every gene name
-    all_genes = cnv_tab['Gene name'].tolist()   #list of all genes
-    unique_genes = cnv_tab['Gene name'].unique()    #unique list of genes
-        
-    gene_indeces = []   #stores indeces (from cnv table) of the first occurrence of each gene
-    for gene in unique_genes:
-        gene_indeces.append(all_genes.index(gene))  # gets index of gene name in the cnv table
-    
-    gene_indeces.append(len(all_genes))  # allows next loop to run properly and calculate # of gene repeats
-   
-    for i in range(len(gene_indeces) - 1):
-        gene_index = gene_indeces[i]
-        next_gene_index = gene_indeces[i + 1]
-        
-        row = [''] * len(fields)
-    
-#        Make sure the CNV type is the same across all gene repeats. If not, skip iteration and exclude gene from final table 
-        if cnv_tab['SV type'][gene_index:next_gene_index].nunique() == 1:
-            row[fields.index('SV type')] = cnv_tab['SV type'][gene_index]
-        else:
-            logfile.write('Error: DEL and DUP in gene ' + all_genes[gene_index] + '... not including in output file.\n')
-            continue
-    
-        row[fields.index('SV chrom')] = cnv_tab['SV chrom'][gene_index] #set SV chrom the same for all repeats of gene
-        row[fields.index('SV start')] = cnv_tab['SV start'][gene_index] #set SV start and end as last and first repeat gene values
-        row[fields.index('SV end')] = cnv_tab['SV end'][next_gene_index - 1]
-        row[fields.index('SV length')] = cnv_tab['SV length'][gene_index:next_gene_index].sum()
-        row[fields.index('CopyNumber')] = cnv_tab['CopyNumber'][gene_index]
-        
-#row[fields.index('')] = cnv_tab[''][gene_index]
-        
-        row[fields.index('Phenotips ID')] = phen_ID
-        row[fields.index('MergeCount')] = next_gene_index - gene_index
-
-        #query cytoband df to find where chromosome matches and start and end position match up
-        chromosome = 'chr' + str(row[fields.index('SV chrom')])
-        start = row[fields.index('SV start')]
-        end = row[fields.index('SV end')]
-        cyto_query = cytobands.query('chrom == @chromosome & start <= @start').cytoband.values
-        if len(cyto_query) < 1:
-            row[fields.index('CytoBand')] = 'unk'
-            print('Warning: Variant not found in CytoBand data!')
-        else:
-            row[fields.index('CytoBand')] = chromosome + cyto_query[len(cyto_query)-1]
-        
-        
-
-        #Concatenate new SV ID from updated SV info    
-        row[fields.index('AnnotSV ID')] = str(row[fields.index('SV chrom')]) + '_' + str(row[fields.index('SV start')]) + '_' + str(row[fields.index('SV end')]) + '_' +row[fields.index('SV type')]                         
-        row[fields.index('AnnotSV type')] = cnv_tab['AnnotSV type'][gene_index]
-        row[fields.index('Gene name')] = all_genes[gene_index]
-        row[fields.index('NM')] = cnv_tab['NM'][gene_index]
-        row[fields.index('CDS length')] = cnv_tab['CDS length'][gene_index:next_gene_index].sum()
-        row[fields.index('tx length')] = cnv_tab['tx length'][gene_index:next_gene_index].sum()
-        
-        #Store first and last locations if there are multiple. If not, take the first instance of the location
-        if cnv_tab['location'][gene_index:next_gene_index].nunique() > 1:
-            loc1 = cnv_tab['location'][gene_index]
-            loc2 = cnv_tab['location'][next_gene_index - 1]
-            concat_loc = ''
-            
-            #if the first location is past the last location, switch them when concatenating
-            if re.search(r'\d+', loc1).group() > re.search(r'\d+', loc2).group():
-                concat_loc = loc2[:loc2.find('-')] + loc1[loc1.find('-'):]
-            else:
-                concat_loc = loc1[:loc1.find('-')] + loc2[loc2.find('-'):]
-            row[fields.index('location')] = concat_loc
-        else:
-            row[fields.index('location')] = cnv_tab['location'][gene_index]
-                  
-        row[fields.index('intersectStart')] = cnv_tab['intersectStart'][gene_index] #set intersect start and end as last and first repeat gene values
-        row[fields.index('intersectEnd')] = cnv_tab['intersectEnd'][next_gene_index - 1]
-        
-        ###### DGV Gain ID Stuff ######
-        row[fields.index('DGV_GAIN_IDs')] = get_unique_values(cnv_tab['DGV_GAIN_IDs'][gene_index:next_gene_index], ',', ', ')   
-        row[fields.index('DGV_GAIN_n_samples_with_SV')] = get_min(cnv_tab['DGV_GAIN_n_samples_with_SV'][gene_index:next_gene_index])
-        row[fields.index('DGV_GAIN_n_samples_tested')] = get_min(cnv_tab['DGV_GAIN_n_samples_tested'][gene_index:next_gene_index])
-        row[fields.index('DGV_GAIN_Frequency')] = get_min(cnv_tab['DGV_GAIN_Frequency'][gene_index:next_gene_index])
-        
-        ###### DGV Loss ID Stuff ######
-        row[fields.index('DGV_LOSS_IDs')] = get_unique_values(cnv_tab['DGV_LOSS_IDs'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('DGV_LOSS_n_samples_with_SV')] = get_min(cnv_tab['DGV_LOSS_n_samples_with_SV'][gene_index:next_gene_index])
-        row[fields.index('DGV_LOSS_n_samples_tested')] = get_min(cnv_tab['DGV_LOSS_n_samples_tested'][gene_index:next_gene_index])
-        row[fields.index('DGV_LOSS_Frequency')] = get_min(cnv_tab['DGV_LOSS_Frequency'][gene_index:next_gene_index])
-
-        
-        ###### GD Stuff ######
-        gd_an_dict = get_corresp_number(cnv_tab, gene_index, next_gene_index, 'GD_AN')
-        row[fields.index('GD_ID')] = get_keys(gd_an_dict)
-        row[fields.index('GD_AN')] = get_vals(gd_an_dict)
-        row[fields.index('GD_N_HET')] = get_vals(get_corresp_number(cnv_tab, gene_index, next_gene_index, 'GD_N_HET'))
-        row[fields.index('GD_N_HOMALT')] = get_vals(get_corresp_number(cnv_tab, gene_index, next_gene_index, 'GD_N_HOMALT'))
-        row[fields.index('GD_AF')] = get_min(cnv_tab['GD_AF'][gene_index:next_gene_index])
-        row[fields.index('GD_POPMAX_AF')] = get_min(cnv_tab['GD_POPMAX_AF'][gene_index:next_gene_index])
-        row[fields.index('GD_ID_others')] = get_unique_values(cnv_tab['GD_ID_others'][gene_index:next_gene_index], ';', ', ')
-    
-
-        row[fields.index('DDD_SV')] = get_unique_values(cnv_tab['DDD_SV'][gene_index:next_gene_index], ';', ', ')        
-        row[fields.index('DDD_DUP_n_samples_with_SV')] = get_max(cnv_tab['DDD_DUP_n_samples_with_SV'][gene_index:next_gene_index])
-        row[fields.index('DDD_DUP_Frequency')] = get_max(cnv_tab['DDD_DUP_Frequency'][gene_index:next_gene_index])
-        row[fields.index('DDD_DEL_n_samples_with_SV')] = get_max(cnv_tab['DDD_DEL_n_samples_with_SV'][gene_index:next_gene_index])
-        row[fields.index('DDD_DEL_Frequency')] = get_max(cnv_tab['DDD_DEL_Frequency'][gene_index:next_gene_index])
-        
-        row[fields.index('1000g_event')] = get_unique_values(cnv_tab['1000g_event'][gene_index:next_gene_index], ';', ', ')
-        row[fields.index('1000g_AF')] = get_min(cnv_tab['1000g_AF'][gene_index:next_gene_index])
-        row[fields.index('1000g_max_AF')] = get_min(cnv_tab['1000g_max_AF'][gene_index:next_gene_index])
-        
-        row[fields.index('IMH_ID')] = get_unique_values(cnv_tab['IMH_ID'][gene_index:next_gene_index], ';', ', ')
-        row[fields.index('IMH_AF')] = get_min(cnv_tab['IMH_AF'][gene_index:next_gene_index])
-        row[fields.index('IMH_ID_others')] = get_unique_values(cnv_tab['IMH_ID_others'][gene_index:next_gene_index], ';', ', ')
-        row[fields.index('Mappability')] = cnv_tab['Mappability'][gene_index]
-        row[fields.index('NA12878_mode_CN')] = cnv_tab['NA12878_mode_CN'][gene_index]
-        row[fields.index('Repeatability_Score')] = get_min(cnv_tab['Repeatability_Score'][gene_index:next_gene_index])
-        
-#        These fields are mostly blank
-        row[fields.index('promoters')] = get_unique_values(cnv_tab['promoters'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('dbVar_event')] = get_unique_values(cnv_tab['dbVar_event'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('dbVar_variant')] = get_unique_values(cnv_tab['dbVar_variant'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('dbVar_status')] = get_unique_values(cnv_tab['dbVar_status'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('TADcoordinates')] = get_unique_values(cnv_tab['TADcoordinates'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('ENCODEexperiments')] = get_unique_values(cnv_tab['ENCODEexperiments'][gene_index:next_gene_index], ',', ', ')
-
-        row[fields.index('#hom')] = get_unique_values(cnv_tab['#hom'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('#htz')] = get_unique_values(cnv_tab['#htz'][gene_index:next_gene_index], ',', ', ')
-
-        row[fields.index('GCcontent_left')] = cnv_tab['GCcontent_left'][gene_index] #set start and end as last and first repeat gene values
-        row[fields.index('GCcontent_right')] = cnv_tab['GCcontent_right'][next_gene_index - 1]
-        row[fields.index('Repeats_coord_left')] = cnv_tab['Repeats_coord_left'][gene_index] #set start and end as last and first repeat gene values
-        row[fields.index('Repeats_coord_right')] = cnv_tab['Repeats_coord_right'][next_gene_index - 1]
-        row[fields.index('Repeats_type_left')] = cnv_tab['Repeats_type_left'][gene_index] #set start and end as last and first repeat gene values
-        row[fields.index('Repeats_type_right')] = cnv_tab['Repeats_type_right'][next_gene_index - 1]
-
-        row[fields.index('ACMG')] = get_unique_values(cnv_tab['ACMG'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('HI_CGscore')] = get_min(cnv_tab['HI_CGscore'][gene_index:next_gene_index])
-        row[fields.index('TriS_CGscore')] = get_unique_values(cnv_tab['TriS_CGscore'][gene_index:next_gene_index], ',', ', ')
-
-        row[fields.index('DDD_status')] = get_unique_values(cnv_tab['DDD_status'][gene_index:next_gene_index], '/', '/')
-        row[fields.index('DDD_mode')] = get_unique_values(cnv_tab['DDD_mode'][gene_index:next_gene_index], '/', '/')
-        row[fields.index('DDD_consequence')] = get_unique_values(cnv_tab['DDD_consequence'][gene_index:next_gene_index], '/', ', ')
-        row[fields.index('DDD_disease')] = get_unique_values(cnv_tab['DDD_disease'][gene_index:next_gene_index], '/', ', ')
-        ddd_pmids = get_unique_values(cnv_tab['DDD_pmids'][gene_index:next_gene_index], '//|;|/', ', ')
-        row[fields.index('DDD_pmids')] = ddd_pmids
-        row[fields.index('HI_DDDpercent')] = get_min(cnv_tab['HI_DDDpercent'][gene_index:next_gene_index])
-
-        row[fields.index('synZ_ExAC')] = get_max(cnv_tab['synZ_ExAC'][gene_index:next_gene_index])
-        row[fields.index('misZ_ExAC')] = get_max(cnv_tab['misZ_ExAC'][gene_index:next_gene_index])
-        row[fields.index('pLI_ExAC')] = get_max(cnv_tab['pLI_ExAC'][gene_index:next_gene_index])
-        row[fields.index('delZ_ExAC')] = get_max(cnv_tab['delZ_ExAC'][gene_index:next_gene_index])
-        row[fields.index('dupZ_ExAC')] = get_max(cnv_tab['dupZ_ExAC'][gene_index:next_gene_index])
-        row[fields.index('cnvZ_ExAC')] = get_max(cnv_tab['cnvZ_ExAC'][gene_index:next_gene_index])
-        
-        row[fields.index('morbidGenes')] = get_unique_values(cnv_tab['morbidGenes'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('morbidGenesCandidates')] = get_unique_values(cnv_tab['morbidGenesCandidates'][gene_index:next_gene_index], ',', ', ')
-        row[fields.index('Mim Number')] = get_unique_values(cnv_tab['Mim Number'][gene_index:next_gene_index], ';', ', ')
-        row[fields.index('Phenotypes')] = get_unique_values(cnv_tab['Phenotypes'][gene_index:next_gene_index], '/|;', '; ')
-        inher = get_unique_values(cnv_tab['Inheritance'][gene_index:next_gene_index], ',|//|/|;', ', ')
-        
-       
-        # Cleans up the output if input results in multiple spaces returned
-        if isinstance(inher, str):
-            if inher[0] == ',':
-                inher = inher[2:]
-            if inher[len(inher) - 2:] == ', ':
-                inher = inher[:len(inher) - 2]
-                
-        inher = re.sub(' +', ' ', str(inher))
-
-        row[fields.index('Inheritance')] = inher
-        row[fields.index('AnnotSV ranking')] = get_max(cnv_tab['AnnotSV ranking'][gene_index:next_gene_index])
-
-        final_tab = final_tab.append(pd.DataFrame([row], columns = fields))
-        
-        
-    #   Remove blank placeholders and write out the pandas df
-    final_tab = final_tab.replace('-', '')
-    
-    outfname = outdir + '/' + phen_ID + '_cnv.txt'
-    final_tab.to_csv(outfname, index = False, sep = '\t')
-        
-    print("{} successfully written by cnv_collapse.py".format(outfname))
-    print()
-    
-    logfile.close()
-    
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -26,41 +26,20 @@ __version__ = '1.1'
 __copyright__ = 'No copyright protection, can be used freely'
 
 import sys
-import os
-import re
-import datetime
 import pandas as pd
-import numpy as np
 import argparse
 from argparse import RawTextHelpFormatter
-from ncbr_huse import send_update, err_out, pause_for_input
-import subprocess
-import json
-import fnmatch
-from ncbr_bsi import read_conf, send_curl, get_bsi_session, get_bsi_name, bsi_query, return_bsi_info
-from generate_seqr_ped import generate_genrptlinks_ped
+from ncbr_bsi import report_bsi_stats, add_bsi_args, configure_bsi
+from ncbr_gris import batch_name, dropped_orders, load_batch, write_release_tracking, link_bams, \
+    SampleRegistry, read_rawdata, configure_rawdata_cache, tracking_records, write_tracking_records, sample_history, \
+    SAMPLE_HISTORY
 
+# Processed HGSC data on LOCUS, BAMs of family/added samples are linked from here
+LOCUS_DIR = '/hpcdata/dir/CSI_DATA_PROCESSED'
 
-# Python program to illustrate the intersection
-# of two lists in most simple way
-def intersection(lst1, lst2):
-    lst3 = [value for value in lst1 if value in lst2]
-    return lst3
-
-
-def query_bsi(ids, fields, query_field):
-    # Set up the variables, bsi info
-    cnf = os.path.expanduser('~/.my.cnf.bsi')
-    url_session = 'https://rest.bsisystems.com/api/rest/EBMS/common/logon'
-    url_reports = 'https://rest.bsisystems.com/api/rest/EBMS/reports/list'
-    curl_get = "curl -s -X GET --header 'Accept: application/json' --header 'BSI-SESSION-ID: "
-
-    user, pw = read_conf(cnf)
-    session = get_bsi_session(url_session, user, pw)
-
-    bsi = bsi_query(curl_get, url_reports, session, fields, ids, query_field)
-
-    return bsi
+# BSI columns kept for the released samples and their families
+HGSC_COLUMNS = ['Phenotips_ID', 'Batch_Sent', 'Batch_Received', 'DLM_LIS_Number', 'Exome_ID', 'CRIS_Order_Status',
+                'CRIS_Order#', 'Archive', 'Active_Status', 'Phenotips_Family_ID', 'Date of Enrollment', 'Vendor']
 
 
 # batch_num = Batch Number (i.e. 23)
@@ -68,120 +47,27 @@ def query_bsi(ids, fields, query_field):
 # masterkey = masterkey file for one half of the current batch
 # received = all samples pulled straight from the sample key file delivered by HGSC
 # moved_samples = list of sample IDs added to current batch that were moved from previous batches into current
-def make_sample_tracking_file(batch_num, unsequenced_fam, masterkey, received, moved_samples):
-
+def make_sample_tracking_file(model, batch_num, unsequenced_fam, masterkey, received, moved_samples, split):
     masterkey = masterkey[['Phenotips_Family_ID', 'Phenotips_ID', 'Exome_ID', 'DLM_LIS_Number', 'CRIS_Order#', 'Batch_Sent', 'Batch_Received']]
 
-    cnf, url_session, url_reports, curl_get = return_bsi_info()
-    user, pw = read_conf(cnf)
-    session = get_bsi_session(url_session, user, pw)
-
-    batch_name = 'BATCH' + str(batch_num)
-    batch_name_lower = 'Batch ' + str(batch_num)
-
-    f = open('sample_tracking_summary_batch' + str(batch_num) + '.txt', 'w')
-    f.write('******************************************\n*\n* Notes for samples released with Batch ' + str(batch_num) + '\n' +
-            '*\n******************************************\n\n')
-
-    fields = ['Phenotips ID', 'CRIS Order #', 'Batch Sent', 'Batch Received', 'CRIS Order Status', 'Active Status']
-    sent = bsi_query(curl_get, url_reports, session, fields, [batch_name], 'Batch Sent')
-    sent = sent[~sent['CRIS_Order_Status'].str.contains('cancel', case = False, na = False)]
-    sent = sent[~sent['CRIS_Order_Status'].str.match('auto complete', case = False, na = False)]
-    sent = sent[sent['Active status'].str.match('Active')]
-    sent.drop_duplicates(keep = 'first', inplace = True)
-    num_sent = len(sent['CRIS_Order#'].unique())
-
-    f.write('Total number of samples sent to HGSC with Batch ' + str(batch_num) + ': ' + str(num_sent) + '\n')
-    # f.write('** Samples sent together in ' + batch_name_lower + ' were split into two separate batches when received **\n\n')
-
-    num_released_all = received.shape[0]
-    f.write('Total number of new samples in latest HGSC release (before split): ' + str(num_released_all) + '\n\n')
-
-    num_released = masterkey[masterkey['Batch_Received'].str.match(batch_name, na = False)].shape[0]
-    f.write('Number of new samples released from HGSC in ' + batch_name_lower + ': ' + str(num_released) + '\n\n')
-
-    num_in_masterkey = masterkey.shape[0]
-    f.write('Total number of samples in the masterkey file: ' + str(num_in_masterkey) + "\n")
-    f.write("Here's the breakdown: \n")
-    f.write('---------------------------------------------------------------------------------------------\n\n')
-
-    num_released_from_sent = len(intersection(sent['CRIS_Order#'].values.tolist(), masterkey['CRIS_Order#'].values.tolist()))
-    f.write(str(num_released_from_sent) + ' sample(s) sent to HGSC in ' + batch_name_lower + ' were released with ' + batch_name_lower + '.\n\n')
-
-    ##### Special Case: remove samples that are being added/moved from other batches into current batch from previous batches.
-    # We'll make a separate section to outline those samples
-
-    sent_in_other_and_released = masterkey[~masterkey['Batch_Sent'].str.match(batch_name, na = False)]
-    sent_in_other_and_released = sent_in_other_and_released[sent_in_other_and_released['Batch_Received'].str.match(batch_name, na = False)]
-    sent_in_other_and_released = sent_in_other_and_released[~sent_in_other_and_released['Phenotips_ID'].isin(moved_samples)]
-    f.write(str(sent_in_other_and_released.shape[0]) + ' sample(s) sent to HGSC in other batches were released with ' + batch_name_lower + ':\n')
-    f.write(sent_in_other_and_released.to_string(index = False) + '\n\n')
-
-    # This section outlines samples moved to current batch:
-    num_moved = len(moved_samples)
-    if num_moved > 0:
-        f.write(str(num_moved) + ' sample(s) released in previous batches were moved to ' + batch_name_lower + ':\n')
-        f.write(masterkey[masterkey['Phenotips_ID'].isin(moved_samples)].to_string(index = False) + '\n\n')
-
-    # all family members in the masterkey file (they're sequenced and have data on file)
-    fam_members_released = masterkey[~masterkey['Batch_Received'].str.match(batch_name)]
-    fam_members_released = fam_members_released[~fam_members_released['Phenotips_ID'].isin(moved_samples)]
-    # fam_members_released = fam_members_released[['']]
-    if fam_members_released.empty:
-        f.write('0 sample(s) released in previous batches are family members of sample(s) released with ' + batch_name_lower + '.\n\n')
-    else:
-        f.write(str(fam_members_released.shape[0]) + ' sample(s) released in previous batches are family members of sample(s) released in ' + batch_name_lower + ':\n')
-        f.write(fam_members_released.to_string(index = False) + '\n\n')
-
-    f.write('---------------------------------------------------------------------------------------------\n\n')
-
     # get any unsequenced family members that are related to people in this half of the batch
-    fam_members_unreleased = unsequenced_fam[unsequenced_fam['Phenotips_Family_ID'].isin(masterkey['Phenotips_Family_ID'])]
-    if fam_members_unreleased.empty:
-        f.write('There are no unreleased family members of sample(s) released in ' + batch_name_lower + ' on file.\n\n')
-    else:
-        f.write(str(fam_members_unreleased.shape[0]) + ' family members have been consented but not yet released.\n')
-        fam_members_unreleased = fam_members_unreleased[['Phenotips_Family_ID', 'Phenotips_ID']]
-        f.write(fam_members_unreleased.to_string(index = False))
-        f.write('\n\n')
-
-    sent_not_released = sent[~sent['CRIS_Order#'].isin(masterkey['CRIS_Order#'])]
-    if sent_not_released.empty:
-        f.write('All non-canceled samples sent to HGSC in ' + batch_name_lower + ' have been released in ' + batch_name_lower + '\n\n')
-    else:
-        f.write(str(sent_not_released.shape[0]) + ' sample(s) sent to HGSC in ' + batch_name_lower + ' were not released in ' + batch_name_lower + ':\n')
-        f.write(sent_not_released.to_string(index=False) + '\n\n')
+    unreleased = unsequenced_fam[unsequenced_fam['Phenotips_Family_ID'].isin(masterkey['Phenotips_Family_ID'])]
+    unreleased = unreleased[['Phenotips_Family_ID', 'Phenotips_ID']]
 
-    f.close()
+    write_release_tracking(model, 'sample_tracking_summary_batch' + str(batch_num) + '.txt', batch_name(batch_num),
+                           masterkey, received.shape[0], unreleased, moved_samples, split)
 
 
-# Write shell script to symbolically link old bam files to new directory
+# Link old bam files into the new directory, and write them to a shell script
 # masterkey: one of the split masterkeys
-def write_bam_link_script(masterkey, batch_num):
-    batch_name = 'BATCH' + str(batch_num)
-    previous_batches = masterkey[~masterkey['Batch_Received'].str.match(batch_name)]
+# moved_rows: earlier receipts of the samples moved into this batch, their data is linked too
+def link_previous_bams(masterkey, batch_num, moved_rows):
+    previous_batches = masterkey[~masterkey['Batch_Received'].str.match(batch_name(batch_num), na = False)]
+    previous_batches = pd.concat([previous_batches, moved_rows], sort=False)
 
-    # Write script to link bams from previous batches (family/added samples) on LOCUS
-    locus_dir = '/hpcdata/dir/CSI_DATA_PROCESSED'
+    # Link bams from previous batches (family/added samples) on LOCUS
     fname = 'link_previous_bams_' + 'batch' + str(batch_num) + '.sh'
-
-    script = open(fname, "w")
-    script.write("#!/bin/sh\nset -e\n\n")
-
-    for i in previous_batches.index.values.tolist():
-        pbatchdir = previous_batches.loc[i]['Batch_Received']
-        pbatchdir = pbatchdir.replace('BATCH0', 'BATCH')
-        phen_id = previous_batches.loc[i]['Phenotips_ID']
-
-        bamlink = "ln -s {}/{}/BAM/{}.bam {}/{}/BAM/\n".format(locus_dir, pbatchdir, phen_id, locus_dir,
-                                                               'BATCH' + str(batch_num))
-        bailink = "ln -s {}/{}/BAM/{}.bam.bai {}/{}/BAM/\n".format(locus_dir, pbatchdir, phen_id, locus_dir,
-                                                                   'BATCH' + str(batch_num))
-        script.write(bamlink)
-        script.write(bailink)
-        script.write("\n")
-
-    script.close()
+    link_bams(previous_batches, fname, LOCUS_DIR, 'BATCH' + str(batch_num))
 
 
 def write_split_masterkeys(masterkey):
@@ -201,8 +87,7 @@ def write_split_masterkeys(masterkey):
     second_half = masterkey[midpoint:]
 
     # find shared families
-    shared_fams = intersection(first_half.Phenotips_Family_ID.values.tolist(),
-                               second_half.Phenotips_Family_ID.values.tolist())
+    shared_fams = SampleRegistry(first_half).shared('family', SampleRegistry(second_half))
 
     # Remove shared families from first and second halves (we'll redistribute the families later)
     first_half = first_half[~first_half['Phenotips_Family_ID'].isin(shared_fams)]
@@ -253,7 +138,7 @@ def write_split_masterkeys(masterkey):
     second_half.Batch_Received.replace(first_half_name, second_half_name, inplace=True)
 
     # Test if anything is wrong
-    shared_samples = intersection(first_half.Phenotips_Family_ID.values.tolist(), second_half.Phenotips_Family_ID.values.tolist())
+    shared_samples = SampleRegistry(first_half).shared('family', SampleRegistry(second_half))
     if len(shared_samples) == 0:
         print('\nSuccessfully split batches: ')
         print(first_half_name + ": " + str(first_half.shape[0]) + " samples")
@@ -268,14 +153,11 @@ def write_split_masterkeys(masterkey):
     return first_half, second_half
 
 
-# Reads in Sample Key file from HGSC
-# Makes unsequenced_family df: all family members of current batch who have Batch_Received == blank
-# Makes sequenced_family df: all family members of current batch who have Batch_Received filled in
-def write_masterkey(sample_key_path):
+# Reads in Sample Key file from HGSC, returns the released samples without the NA12878 control
+def read_sample_key(sample_key_path):
 
     # read in sample key provided by Baylor and isolate the LIS number and exome ID (INDEX ID)
-    received = pd.read_excel(sample_key_path)
-    received = received[['INDEX ID', 'COLLABORATOR SAMPLE ID', 'FLOWCELL ID', 'LANE NUM']]
+    received = read_rawdata(sample_key_path, 'hgsc_samplekey')
     received.rename(columns={'COLLABORATOR SAMPLE ID': 'DLM_LIS_Number'}, inplace=True)
 
     print('------------------------- Raw Sample Key -------------------------')
@@ -291,54 +173,45 @@ def write_masterkey(sample_key_path):
     received['Sample_ID'] = received['FLOWCELL ID'].astype(str) + '-' + received['LANE NUM'].astype(str) + '-' + received['INDEX ID']
     received = received[['Sample_ID', 'DLM_LIS_Number']]
 
-    # first get all family member IDs
-    family_ids = query_bsi(received['DLM_LIS_Number'], ['Phenotips Family ID'], 'DLM LIS Number')
-    family_ids = family_ids['Phenotips_Family_ID'].unique()
-    # pd.DataFrame(family_ids).to_csv('fam_ids.csv')
+    return received
+
 
-    # Get IDs to merge from BSI
-    bsi_fields = ['Phenotips ID', 'Batch Sent', 'Batch Received', 'DLM LIS Number', 'Exome ID',
-                  'CRIS Order Status', 'CRIS Order #', 'Archive', 'Active Status', 'Phenotips Family ID', 'Date of Enrollment', 'Vendor']
-    received_and_fam = query_bsi(family_ids, bsi_fields, 'Phenotips Family ID')
-    # received_and_fam.to_csv('/Users/kuramvs/Documents/hgsc_scripts/test_files/id_dict.csv')
+# Makes the masterkey from the sample key and the batch model
+# Makes unsequenced_family df: all family members of current batch who have Batch_Received == blank
+# Makes sequenced_family df: all family members of current batch who have Batch_Received filled in
+def write_masterkey(model, received):
+
+    # leaving out canceled and auto complete orders, inactive ones are kept to warn about below
+    received_and_fam = model.family[~dropped_orders(model.family)][HGSC_COLUMNS]
 
     # Clean up BSI data
-    received_and_fam = received_and_fam[~received_and_fam['CRIS_Order_Status'].str.contains('cancel', case = False, na = False)]
-    received_and_fam = received_and_fam[~received_and_fam['CRIS_Order_Status'].str.match('auto complete', case = False, na = False)]
-    inactive = received_and_fam[~received_and_fam['Active status'].str.match('Active', case = False, na = False)]
+    inactive = received_and_fam[~received_and_fam['Active_Status'].str.match('Active', case = False, na = False)]
 
-    received_and_fam.drop_duplicates(keep = 'first', inplace = True)
-    received_and_fam.replace('', np.NaN, inplace = True)
-    received_and_fam.rename(columns={'Exome ID': 'Exome_ID', 'DLM LIS Number': 'DLM_LIS_Number'}, inplace=True)
+    received_and_fam = received_and_fam.drop_duplicates(keep = 'first')
 
     if inactive.shape[0] > 0:
         print('Warning! The following samples are Inactive, but were delivered with the latest CIDR release: ')
         print(inactive)
         print('')
 
-    # print(received_and_fam.columns)
-    # received_and_fam.to_csv('id_dict_cleaned.csv')
-
     # Merge additional BSI fields and rearrange columns
     received = received.merge(received_and_fam, on = 'DLM_LIS_Number', how = 'left')
     received = received[['Sample_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received', 'CRIS_Order#', 'Phenotips_Family_ID', 'Date of Enrollment', 'Vendor']]
     received.rename(columns = {'Sample_ID': 'Exome_ID'}, inplace = True)
     received['Batch_Received'] = "BATCH" + str(batch)
 
-    received_and_fam = received_and_fam[received_and_fam['Active status'].str.match('Active', case = False, na = False)]
-    received_and_fam.drop_duplicates(keep='first', inplace=True)
+    received_and_fam = received_and_fam[received_and_fam['Active_Status'].str.match('Active', case = False, na = False)]
 
     # Get sequenced family members
     all_family = received_and_fam[~received_and_fam['Phenotips_ID'].isin(received['Phenotips_ID'])]
 
-    sequenced_family = all_family[~all_family['Batch_Received'].isna()]
     sequenced_family = all_family[~all_family['Exome_ID'].isna()]
     sequenced_family = sequenced_family[['Exome_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received', 'Phenotips_Family_ID', 'Date of Enrollment', 'Vendor']]
     unsequenced_family = all_family[all_family['Batch_Received'].isna()]
     unsequenced_family = unsequenced_family[~unsequenced_family['Phenotips_ID'].isin(sequenced_family['Phenotips_ID'])]
 
     # add sequenced family to masterkey
-    masterkey = received.append(sequenced_family, sort = False)
+    masterkey = pd.concat([received, sequenced_family], sort = False)
 
     print('----------------------- Un-split Masterkey -----------------------')
     print(str(masterkey.shape[0]) + ' total')
@@ -391,27 +264,52 @@ def main():
     parser.add_argument('-d', '--dir', required=True, type=str, help='Directory containing raw BAMs and gVCFs from HGSC')
     parser.add_argument('-s', '--sample_key', required=True, type=str,  help='Path to HGSC Sample Key file')
     parser.add_argument('-u', '--unsplit', required=False, action='store_true', help='Will not split the batch into two')
+    parser.add_argument('--sample-history', required=False, type=str, default=None,
+                        help='Sample history file of moved and re-released samples\n' +
+                             '(default: {} at the top of the data tree)'.format(SAMPLE_HISTORY))
+    parser.add_argument('-t', '--tracking-append', required=False, type=str, default=None,
+                        help='Also add the tracking records (one row per order, as in sample_tracking_batch#.tsv) to this\n' +
+                             'cohort file, .tsv or .parquet, replacing any earlier records of the same batch')
+    add_bsi_args(parser)
 
     args = parser.parse_args()
+    configure_bsi(args)
+    configure_rawdata_cache(not args.no_cache)
     batch = args.batch
-    dir = args.dir
     sample_key_path = args.sample_key
     unsplit = args.unsplit
 
     print('\nReading in sample key file and making masterkey file...')
+    received = read_sample_key(sample_key_path)
+
+    # Load the released samples, their families and the orders sent with each batch from BSI once
+    sent_batches = [batch] if unsplit else [batch, batch + 1]
+    model = load_batch(batch, received['DLM_LIS_Number'].tolist(), 'DLM LIS Number', vendor='HGSC',
+                       sent_batches=sent_batches)
+
     # Get masterkey, and information on sequenced/unsequenced family members of received patients
-    masterkey, sequenced_family, unsequenced_family, received = write_masterkey(sample_key_path)
+    masterkey, sequenced_family, unsequenced_family, received = write_masterkey(model, received)
+
+    # Samples moved into this batch from earlier ones, from the sample history of the processed data
+    history = sample_history(LOCUS_DIR, args.sample_history)
+    history.update_model(model)
+    def moved_in(half, name):
+        moved = history.moved(half, name)
+        if len(moved) > 0:
+            print(str(len(moved)) + ' sample(s) moved to ' + name + ' from earlier batches: ' + ', '.join(moved))
+        return(moved, history.moved_rows(moved, name))
     # print(unsequenced_family.columns)
 
     if unsplit:
-        batch_name = 'BATCH' + str(batch)
-        print('Creating files for unsplit ' + batch_name)
+        unsplit_name = 'BATCH' + str(batch)
+        print('Creating files for unsplit ' + unsplit_name)
 
         write_bsi_info(masterkey, None)
-        make_sample_tracking_file(batch, unsequenced_family, masterkey, received, [])
-        write_bam_link_script(masterkey, batch)
+        moved, moved_rows = moved_in(masterkey, unsplit_name)
+        make_sample_tracking_file(model, batch, unsequenced_family, masterkey, received, moved, False)
+        link_previous_bams(masterkey, batch, moved_rows)
 
-        masterkey[['Exome_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received']].to_csv('masterkey_' + batch_name + '.txt', index=False, sep='\t')
+        masterkey[['Exome_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received']].to_csv('masterkey_' + unsplit_name + '.txt', index=False, sep='\t')
 
     else:
         # split the main masterkey in half
@@ -440,19 +338,28 @@ def main():
 
         print("\nGenerating sample tracking files...")
         # Write sample tracking summary for both batches
-        make_sample_tracking_file(batch, unsequenced_family, first_half, received, [])
-        make_sample_tracking_file(batch + 1, unsequenced_family, second_half, received, [])
+        moved_first, moved_rows_first = moved_in(first_half, batch_name_first)
+        moved_second, moved_rows_second = moved_in(second_half, batch_name_second)
+        make_sample_tracking_file(model, batch, unsequenced_family, first_half, received, moved_first, True)
+        make_sample_tracking_file(model, batch + 1, unsequenced_family, second_half, received, moved_second, True)
 
         # Make the link_previous_bams files
-        write_bam_link_script(first_half, batch)
-        write_bam_link_script(second_half, batch + 1)
+        link_previous_bams(first_half, batch, moved_rows_first)
+        link_previous_bams(second_half, batch + 1, moved_rows_second)
 
         # Finally, write out all the masterkeys in desired format
         masterkey[['Exome_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received']].to_csv('masterkey.txt', index=False, sep='\t')
         first_half[['Exome_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received']].to_csv('masterkey_' + 'BATCH' + str(batch) + '.txt', index=False, sep='\t')
         second_half[['Exome_ID', 'Phenotips_ID', 'DLM_LIS_Number', 'Batch_Sent', 'Batch_Received']].to_csv('masterkey_' + 'BATCH' + str(batch + 1) + '.txt', index=False, sep='\t')
 
+    # Tracking records of the batch, one row per order with its classification
+    records = write_tracking_records(tracking_records(model), 'sample_tracking_batch' + str(batch) + '.tsv')
+    if args.tracking_append is not None:
+        write_tracking_records(records, args.tracking_append, append=True)
+        print('Tracking records of batch ' + str(batch) + ' appended to ' + args.tracking_append)
+    history.save()
 
+    report_bsi_stats()
     print('\nAll done!')
 
 
@@ -1,131 +1,29 @@
 import sys
-import os
-import re
 import datetime
 import pandas as pd
-import numpy as np
 import argparse
 from argparse import RawTextHelpFormatter
-from ncbr_huse import send_update, err_out, pause_for_input
-import subprocess
-import json
-import fnmatch
-from ncbr_bsi import read_conf, send_curl, get_bsi_session, get_bsi_name, bsi_query
+from ncbr_huse import err_out
+from ncbr_bsi import report_bsi_stats, add_bsi_args, configure_bsi
+from ncbr_gris import SKIPPED_BATCHES, GRIS_WORKERS, PED_MANIFEST, CHANGED_FAMILIES, parse_batches, run_batches, \
+    batch_name, load_batches, write_seqr_ped, write_genrptlinks, cumulative_needs_full, update_cumulative_ped, \
+    refresh_outputs, write_manifest, add_since_arg, since_manifest
 
+# Output files of one batch
+def batch_outputs(batch, genrptlinks_out):
+    fnames = ['seqr_ped_batch' + str(batch) + '.txt']
+    if genrptlinks_out:
+        fnames.append('genrptlinks_batch' + str(batch) + '.txt')
+    return(fnames)
 
-def generate_genrptlinks_ped(batch):
-    ############ Set up the variables and the log file ############
-    # Set up the log file
+# Write the seqr ped and, for -g, the genrptlinks file of one batch
+def write_outputs(model, genrptlinks_out):
+    fnames = batch_outputs(model.batch, genrptlinks_out)
+    write_seqr_ped(model, fnames[0])
 
-    thedate = str(datetime.datetime.now()).split()[0]
-    thedate = re.sub("-", "", thedate)
-    global log
-    log = open('csi_to_gris' + '.log', 'a')
-    log.write('\n' + str(datetime.datetime.now()) + '\n')
-    log.write(' '.join(sys.argv) + '\n')
-    log.write('csi_to_gris_hgsc.py\n\n')
-    log.flush()
-
-    # Set Batch name (BSI value) and Batch label (output text value)
-    if batch < 10:
-        batch_name = "BATCH0" + str(batch)
-    else:
-        batch_name = "BATCH" + str(batch)
-    batch_label = "Batch " + str(batch)
-
-    # Set up the variables, bsi info
-    cnf = os.path.expanduser('~/.my.cnf.bsi')
-    url_session = 'https://rest.bsisystems.com/api/rest/EBMS/common/logon'
-    url_reports = 'https://rest.bsisystems.com/api/rest/EBMS/reports/list'
-    curl_get = "curl -s -X GET --header 'Accept: application/json' --header 'BSI-SESSION-ID: "
-
-    ## Establish a BSI Connection with user's credentials
-    user, pw = read_conf(cnf)
-    session = get_bsi_session(url_session, user, pw)
-
-    ############ Set up output file names ############
-    fnames = dict({'tracking': 'sample_tracking_summary_batch' + str(batch) + '.txt',
-                   'master_key': 'masterkey_batch' + str(batch) + '.txt',
-                   'ped': 'seqr_ped_batch' + str(batch) + '.txt',
-                   'gen_rpt_links': 'genrptlinks_batch' + str(batch) + '.txt',
-                   'link_bams': 'link_bams_batch' + str(batch) + '.sh'})
-
-    ############ Get all active people received in this batch ############
-    send_update("\nQuerying BSI for all patients received in " + batch_label + '...', log)
-    fields = ['CRIS Order #', 'Phenotips ID', 'Exome ID', 'MRN', 'Phenotips Family ID', 'Batch Sent', 'Batch Received',
-              'Father PhenotipsId', 'Mother PhenotipsId', 'Gender', 'CRIS Order Status', 'Affected Status',
-              'Active Status']
-    received = bsi_query(curl_get, url_reports, session, fields, [batch_name], 'Batch Received')
-
-    # Remove inactive, canceled, or auto-complete orders or orders missing Exome ID
-    received = received[received['Active status'] != 'Inactive']
-    received = received[~received['CRIS_Order_Status'].str.contains('cancel', case=False, na=False)]
-    received = received[~received['CRIS_Order_Status'].str.contains('Auto Complete', case=False, na=False)]
-    received = received[~received['Exome ID'].str.contains('Auto Complete', case=False, na=False)]
-    #received.to_csv('received.csv', index=False)
-
-    ############ Get all family members of those received ############
-    fam_ids = received['Phenotips_Family_ID'].unique()
-    send_update("\nQuerying BSI for family members of patients received in " + batch_label + '...', log)
-
-    # This contains all people received in the batch + all their family members (sequenced/unsequenced)
-    all_fams = bsi_query(curl_get, url_reports, session, fields, fam_ids, 'Phenotips Family ID')
-    all_fams = all_fams[all_fams['Active status'] != 'Inactive']
-
-    # ped_file = all_fams[all_fams['Active status'] == 'Active']
-    # ped_file = ped_file[['Phenotips_Family_ID', 'Phenotips_ID', 'Father_Phenotips_ID', 'Mother_Phenotips_ID', 'Gender', 'Affected']]
-    ped_file = all_fams[['Phenotips_Family_ID', 'Phenotips_ID', 'Father_Phenotips_ID', 'Mother_Phenotips_ID', 'Gender', 'Affected']]
-    genrptlinks = all_fams[['MRN', 'CRIS_Order#', 'Phenotips_Family_ID', 'Phenotips_ID']]
-
-    # fill in missing values for Mother and Father
-    ped_file.Mother_Phenotips_ID.replace('^00$', '0', regex=True, inplace=True)
-    ped_file.Mother_Phenotips_ID.replace(np.NaN, '0', inplace=True)
-    ped_file.Mother_Phenotips_ID.replace("", '0', inplace=True)
-    ped_file.Father_Phenotips_ID.replace(np.NaN, '0', inplace=True)
-    ped_file.Father_Phenotips_ID.replace("", '0', inplace=True)
-
-    ped_file.drop_duplicates(inplace=True)
-
-    return ped_file, genrptlinks, all_fams
-
-
-def write_cumulative_ped():
-
-    # Set up the variables, bsi info
-    cnf = os.path.expanduser('~/.my.cnf.bsi')
-    url_session = 'https://rest.bsisystems.com/api/rest/EBMS/common/logon'
-    url_reports = 'https://rest.bsisystems.com/api/rest/EBMS/reports/list'
-    curl_get = "curl -s -X GET --header 'Accept: application/json' --header 'BSI-SESSION-ID: "
-
-    ## Establish a BSI Connection with user's credentials
-    user, pw = read_conf(cnf)
-    session = get_bsi_session(url_session, user, pw)
-
-    fields = ['CRIS Order #', 'Phenotips ID', 'Phenotips Family ID', 'Batch Sent', 'Batch Received',
-              'Father PhenotipsId', 'Mother PhenotipsId', 'Gender', 'CRIS Order Status', 'Affected Status']
-    all_receivedDF = bsi_query(curl_get, url_reports, session, fields, ['BATCH*'], 'Batch Received', False)
-
-    ped_fields = ['Phenotips_Family_ID',
-                  'Phenotips_ID',
-                  'Father_Phenotips_ID',
-                  'Mother_Phenotips_ID',
-                  'Gender',
-                  'Affected']
-
-    pedDF = all_receivedDF[ped_fields]
-    pedDF.Mother_Phenotips_ID.replace('^00$', '0', regex=True, inplace=True)
-
-    # fill in missing values for Mother and Father
-    pedDF.Mother_Phenotips_ID.replace(np.NaN, '0', inplace=True)
-    pedDF.Mother_Phenotips_ID.replace("", '0', inplace=True)
-    pedDF.Father_Phenotips_ID.replace(np.NaN, '0', inplace=True)
-    pedDF.Father_Phenotips_ID.replace("", '0', inplace=True)
-
-    pedDF.Gender.replace('M', '1', inplace=True)
-    pedDF.Gender.replace('F', '2', inplace=True)
-
-    pedDF = pedDF.drop_duplicates()
-    pedDF.to_csv('cumulative_ped.txt', sep='\t', header=False, index=False)
+    if genrptlinks_out:
+        write_genrptlinks(model, fnames[1])
+    return(fnames)
 
 
 def main():
@@ -135,33 +33,67 @@ def main():
     # Usage statement
     #
     parseStr = 'Generates files needed for GRIS using BSI queries.\n\n\
+    A range or list of batches is pulled from BSI in one load and written in\n\
+    one run; skipped batches ({}) are left out of ranges.\n\n\
+    Each run records a fingerprint of the source rows and files in\n\
+    {}.  With --since, batches whose BSI rows have not changed are hard linked\n\
+    from that earlier directory instead of rewritten, and the families that\n\
+    changed are listed in {}.\n\n\
     Usage:\n\
-        csi_to_gris_bsi.py -b batch \n\n\
+        generate_seqr_ped.py -b batch \n\n\
     Example:\n\
-        csi_to_gris_bsi.py -b 7\n\
-        csi_to_gris_bsi.py -b 7 -p\n'
+        generate_seqr_ped.py -b 7\n\
+        generate_seqr_ped.py -b 7 -g -c\n\
+        generate_seqr_ped.py -b 1-40\n\
+        generate_seqr_ped.py -b 1-40 --since ../20200101\n\
+        generate_seqr_ped.py -b 41 -c --cumulative-ped ../cumulative_ped.txt --verify-full\n'.format(', '.join([str(b) for b in SKIPPED_BATCHES]), PED_MANIFEST, CHANGED_FAMILIES)
 
     parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
-    parser.add_argument('-b', '--batch', required=True, type=int, help='Batch number (integer)')
+    parser.add_argument('-b', '--batch', required=True, type=parse_batches,
+                        help='Batch number, or a range/list of batches such as 1-40 or 1,3,5-7')
     parser.add_argument('-g', '--genrptlinks', required=False, action='store_true', default=False,
                         help='Output genrptlinks file, in addition to seqr_ped')
     parser.add_argument('-c', '--cumulative', required=False, action='store_true', default=False,
                         help='Generate cumulative pedigree file in addition to seqr_ped')
+    parser.add_argument('--cumulative-ped', required=False, type=str, default='cumulative_ped.txt',
+                        help='Cumulative pedigree to update for -c, only families changed since its last batch are pulled')
+    parser.add_argument('--verify-full', required=False, action='store_true', default=False,
+                        help='Also rebuild the cumulative pedigree from every received sample and check the update matches it')
+    parser.add_argument('-w', '--workers', required=False, type=int, default=GRIS_WORKERS,
+                        help='Batches written at once for a batch range (default: {})'.format(GRIS_WORKERS))
+    add_since_arg(parser)
+    add_bsi_args(parser)
 
     args = parser.parse_args()
-    batch = args.batch
-    write_genrptlinks = args.genrptlinks
-    write_cumulative = args.cumulative
+    configure_bsi(args)
+    batches = args.batch
+    genrptlinks_out = args.genrptlinks
+    cumulative_out = args.cumulative
+    since = args.since
+
+    ############ Set up the log file ############
+    log = open('csi_to_gris' + '.log', 'a')
+    log.write('\n' + str(datetime.datetime.now()) + '\n')
+    log.write(' '.join(sys.argv) + '\n')
+    log.write('generate_seqr_ped.py\n\n')
+    log.flush()
+
+    ############ Get everyone received in these batches, their families and, for a -c rebuild, everyone received ############
+    full = cumulative_out and cumulative_needs_full(args.cumulative_ped, args.verify_full)
+    models = load_batches(dict([(b, [batch_name(b)]) for b in batches]), 'Batch Received', sent_batches=[],
+                          cumulative=full, log=log)
 
-    ped_file, genrptlinks, all_fams = generate_genrptlinks_ped(batch)
+    ############ Write out ped files, linking forward the unchanged ones ############
+    previous = since_manifest(since, log)
+    entries = run_batches(lambda b: refresh_outputs(models[b], batch_outputs(b, genrptlinks_out),
+                                                    lambda model: write_outputs(model, genrptlinks_out), previous, since),
+                          batches, args.workers)
+    write_manifest(entries, previous, since, log)
 
-    ############ Write out ped file ############
-    ped_file.to_csv('seqr_ped_batch' + str(batch) + '.txt', header=False, index=False, sep='\t')
+    if cumulative_out and not update_cumulative_ped(models, args.cumulative_ped, args.verify_full, log):
+        err_out("Error: the cumulative pedigree update did not match a full rebuild, {} now holds the full rebuild".format(args.cumulative_ped), log)
 
-    if write_genrptlinks:
-        genrptlinks.to_csv('genrptlinks_batch' + str(batch) + '.txt', header=False, index=False, sep='\t')
-    if write_cumulative:
-        write_cumulative_ped()
+    report_bsi_stats(log)
 
 
 if __name__ == '__main__':
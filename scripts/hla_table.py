@@ -30,14 +30,13 @@ import os
 import re
 import datetime
 import pandas as pd
-import numpy as np
 import argparse
 from argparse import RawTextHelpFormatter
 import datetime
 import time
-import json
-from ncbr_bsi import read_conf, send_curl, return_bsi_info, get_bsi_name
-from ncbr_huse import err_out
+from ncbr_bsi import read_conf, return_bsi_info, get_bsi_session, add_bsi_args, configure_bsi
+from ncbr_bsi import bsi_query as ncbr_bsi_query
+from ncbr_gris import SampleRegistry
 
  # Finds batch number from the current directory 
 dir_renamed = os.getcwd()
@@ -46,89 +45,11 @@ batch_name = "BATCH" + str(batch_number).zfill(2)
 
 logfile = open(dir_renamed + '/hla_log.txt', 'w')
 
-# Get BSI connection session ID
-def get_bsi_session(url, user, pw):
-    curl_string = "curl -s -X POST --header 'Content-Type: application/x-www-form-urlencoded' --header 'Accept: text/plain' -d 'user_name=" + user + "&password=" + pw + "' 'https://rest.bsisystems.com/api/rest/EBMS/common/logon'"
-    sessionID = send_curl(curl_string)
-#    print("Session ID: {}".format(sessionID))
-#    print(sessionID.decode("utf-8"))
-    
-    if sessionID.decode("utf-8").find("Logon failed: The username, password, and database combination is incorrect") != -1:
-            err_out("\n*** Error: login information is incorrect. ***\nQuitting.")
-
-    #curl_string = "curl -s -X POST --header 'Content-Type: application/x-www-form-urlencoded' --header 'Accept: text/plain' -d 'user_name=" + user "' 'https://rest.bsisystems.com/api/rest/EBMS/common/logon' --digest"
-    #sessionID = send_curl(curl_string)
-    return(sessionID)
-
-# Construct a query and send to BSI, return a dataframe
+# Construct a query and send to BSI through the shared ncbr_bsi client, return a dataframe
+#   blank values are reported as 'Missing'
 def bsi_query(curl, url, session, fields, batch_num, search_field, isequal=True, islike=False):
-    
-    fields = [get_bsi_name(f) for f in fields]
-
-    study = "&criteria=subject.study_id%3DNIAID%20Centralized%20Sequencing"
-    ## order status added as per Xi Cheng email 2/20/2019
-    order_status = "&criteria=sample.field_314%3D%22Specimen%20Collected%22"
-    limit = '10'
-    
-    # Construct the curl command
-    curl += session.decode(encoding='UTF-8') + "'"
-    curl += " '" + url + "?display_fields=" + "&display_fields=".join(fields) + study 
-    curl += "&criteria=" + get_bsi_name(search_field) #this is the BSI name for Batch Received found in ncbr_bsi.py
-    #print(curl)
-
-    # add the "!" for not or "=@" for like
-    if not isequal:
-        curl += "!"
-    if not islike:
-        curl += "%3D" + "%3B" + batch_num
-    else:
-        curl += "%3D%40" + "%3B" + batch_num
-
-    curl = curl + "&type=1'"
-    #print(curl)
-
-    # Get the data using the curl command
-    data = send_curl(curl)
-    # print("DATA:\n{}".format(data))
-
-    data = data.decode('utf-8')
-    data = json.loads(data)
-
-    #print(data)
-
-    if 'message' in data:
-        if re.search("Error running report:", data['message']):
-            err_out("\n*** BSI query failed to return valid results ***\nQuitting.")
-
-    if len(data) == 0:
-        err_out("BSI query failed to return valid results")
-        
-    # Convert the data into a dataframe
-    df = pd.DataFrame(data['rows'], columns=data['headers'])
-    # print("Curl results size: {}".format(df.shape))
-
-    # Rename the columns:
-    colnameDict = {'CRIS Order #': 'CRIS_Order#',
-                   'Batch Sent': 'Batch_Sent',
-                   'Batch Received': 'Batch_Received',
-                   'Batch Ready': 'Batch_Ready',
-                   'Phenotips Family ID': 'Phenotips_Family_ID',
-                   'PhenotipsId': 'Phenotips_ID',
-                   'Mother PhenotipsId': 'Mother_Phenotips_ID',
-                   'Father PhenotipsId': 'Father_Phenotips_ID',
-                   'Family Complete Status':  'Family_Complete_Status',
-                   'Affected Status': 'Affected',
-                   'CIDR Exome ID':'CIDR_Exome_ID',
-                   'CRIS Order Status':'CRIS_Order_Status',
-                   'Patient Name':'Patient_Name',
-                   'Date Drawn' : 'Date_Drawn',
-                   'Date Received' : 'Date_Received',
-                   'GRIS Owner' : 'GRIS_Owner',
-                   'Tissue Origin' : 'Tissue',
-                   'Subject ID': 'MRN', 
-                   'Order Date' : 'Order_Date'}
-    df.rename(columns=colnameDict, inplace=True)
-    df = df.replace(r'^\s*$', 'Missing', regex=True)
+    df = ncbr_bsi_query(curl, url, session, fields, [batch_num], search_field, isequal, islike)
+    df = df.astype(object).fillna('Missing')
 
     return(df)
 
@@ -145,42 +66,36 @@ def query_BSI_data(batch_num, bsi_fields):
     return(df)
 
 # Build HLA Table, replace Phenotips ID with CIDR Exome ID
-def build_table(ID_dict, path, id_type):
+#   ID_dict holds the valid rows of the batch, id_col is the ID column written under the id_type header
+def build_table(ID_dict, path, id_col, id_type):
     
     logfile.write('Building ' + id_type + ' HLA Table...\n')
-    hla_tab = pd.DataFrame()
+    rows = []
     cols_set = False
     colnames = []
-    num_rows = ID_dict.shape[0]
  
 #    Loop thru all files
-    for i in range(num_rows):
-        if ID_dict['is_valid_ID'][i]:
-            pheno_id = ID_dict['Phenotips_ID'][i]
-            fname = path + pheno_id + '/hla/R1_bestguess_G.txt'
-            try:    #ID may be missing so test it
-                df = pd.read_csv(fname, delimiter = "\t")
-            except: #Writes out to error log and skips to next iteration
-                logfile.write('Error: Phenotips ID ' + pheno_id + ' is missing from the directory.\n')
-                continue
-            else:   #if no error occurs, append the row 
-                # concatenate ID and alleles to one row and append to HLA Table
-                alleles = df['Allele'].values
-                row = pd.DataFrame(np.concatenate(([ID_dict[id_type][i]], alleles), axis = 0)).T
-                hla_tab = hla_tab.append(row, ignore_index = True)
-                
-                if not cols_set:    #if no column names, grab from first input file
-                    chroms = df['Chromosome']
-                    loci = df['Locus']
-                    allele_cols = ["HLA-{} {}".format(locus, chrom) for chrom, locus in zip(chroms, loci)]
-#                    print([id_type] + colnames)
-                    colnames = [id_type] + allele_cols
-                    cols_set = True
-                
+    for pheno_id, sample_id in zip(ID_dict['Phenotips_ID'].tolist(), ID_dict[id_col].tolist()):
+        fname = path + pheno_id + '/hla/R1_bestguess_G.txt'
+        try:    #ID may be missing so test it
+            df = pd.read_csv(fname, delimiter = "\t")
+        except: #Writes out to error log and skips to next iteration
+            logfile.write('Error: Phenotips ID ' + pheno_id + ' is missing from the directory.\n')
+            continue
+        else:   #if no error occurs, append the row 
+            # concatenate ID and alleles to one row, the table is made from the rows once all are read
+            rows.append([sample_id] + df['Allele'].tolist())
+            
+            if not cols_set:    #if no column names, grab from first input file
+                chroms = df['Chromosome']
+                loci = df['Locus']
+                allele_cols = ["HLA-{} {}".format(locus, chrom) for chrom, locus in zip(chroms, loci)]
+#                print([id_type] + colnames)
+                colnames = [id_type] + allele_cols
+                cols_set = True
+            
         
-    hla_tab.reset_index(drop = True, inplace = True)    #resets row indeces to 0,1,2,3...
-
-    coldict = dict(zip(hla_tab.columns.values.tolist(), colnames))
+    hla_tab = pd.DataFrame(rows)
     hla_tab.columns = colnames
     logfile.write('\n\n')
     return hla_tab
@@ -196,33 +111,32 @@ def main():
     group = parser.add_mutually_exclusive_group()   #Only allowed to pick -c, -p, blank for default option
     group.add_argument('-c', '--cidr', help = 'Output one HLA table with CIDR Exome IDs', action = 'store_true')
     group.add_argument('-p', '--phenotips', help = 'Output one HLA table with Phenotips IDs', action = 'store_true')
-    
+    add_bsi_args(parser)
+
     args = parser.parse_args()
+    configure_bsi(args)
   
      # Generates ID Dictionary to switch between Phenotips ID to CIDR Exome ID
     fname = 'masterkey_batch' + batch_number + '.txt'
-    ID_dict = pd.read_csv(fname, sep = '\t')
+    registry = SampleRegistry.from_masterkey(fname, batch_name)
     
     # Valid ID if (Batch Recieved is blank OR matches BATCH#) AND CIDR Exome ID isn't blank
-    ID_dict = ID_dict.fillna(' ')
-    batch_is_empty = ID_dict['Batch_Received'] == ' '
-    batch_is_equal = ID_dict['Batch_Received'] == batch_name
-    cidr_not_empty = ID_dict['CIDR_Exome_ID'] != ' '
-    ID_dict['is_valid_ID'] = (batch_is_empty | batch_is_equal) & cidr_not_empty    #column contains all usable valid IDs
+    ID_dict = registry.rows.astype(object).fillna(' ')
+    ID_dict = ID_dict[ID_dict['Exome_ID'] != ' ']
 
 #    ID_dict = query_BSI_data(batch_name, bsi_fields) #Used to query BSI for id dictionary
     
     if args.cidr:
-        hla_CIDR = build_table(ID_dict, 'HLA/', 'CIDR_Exome_ID')
+        hla_CIDR = build_table(ID_dict, 'HLA/', 'Exome_ID', 'CIDR_Exome_ID')
         hla_CIDR.to_csv('hla_tab_cidr_batch' + batch_number + '.csv', index = False, header = True)
         print('Successfully wrote CIDR ID HLA table to ' + 'hla_tab_cidr_batch' + batch_number + '.csv')
     elif args.phenotips:
-        hla_Pheno = build_table(ID_dict, 'HLA/', 'Phenotips_ID')
+        hla_Pheno = build_table(ID_dict, 'HLA/', 'Phenotips_ID', 'Phenotips_ID')
         hla_Pheno.to_csv('hla_tab_phenotips_batch' + batch_number + '.csv', index = False, header = True)
         print('Successfully wrote Phenotips ID HLA table to ' + 'hla_tab_phenotips_batch' + batch_number + '.csv')
     else:
-        hla_CIDR = build_table(ID_dict, 'HLA/', 'CIDR_Exome_ID')
-        hla_Pheno = build_table(ID_dict, 'HLA/', 'Phenotips_ID')
+        hla_CIDR = build_table(ID_dict, 'HLA/', 'Exome_ID', 'CIDR_Exome_ID')
+        hla_Pheno = build_table(ID_dict, 'HLA/', 'Phenotips_ID', 'Phenotips_ID')
         hla_CIDR.to_csv('hla_tab_cidr_batch' + batch_number + '.csv', index = False, header = True)
         hla_Pheno.to_csv('hla_tab_phenotips_batch' + batch_number + '.csv', index = False, header = True)
         print('Successfully wrote HLA tables to ' + 'hla_tab_cidr_batch' + batch_number + '.csv and ' + 'hla_tab_phenotips_batch' + batch_number + '.csv')
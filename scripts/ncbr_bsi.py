@@ -4,6 +4,17 @@
 Created on Mon Aug  6 11:07:30 2018
 ncbr_huse.py
     Set of functions supporting the FNL NCBR work
+
+    BSI sessions are shared by every query in a process.  To also share one
+    session between processes (e.g. batch-by-batch pedigree reruns), set
+    BSI_SESSION_CACHE to a file path such as ~/.bsi_session.
+
+    "ncbr_bsi.py sync" keeps a local SQLite mirror of the study's sample and
+    subject fields; scripts given --mirror answer their queries from it.
+
+    Set BSI_URL (or pass --bsi-url) to send every request to another BSI
+    REST server, e.g. the local stand-in started by bsi_standin.py, and
+    BSI_CNF to read the credentials from a file other than ~/.my.cnf.bsi.
     
 """
 
@@ -15,15 +26,33 @@ __copyright__ = 'none'
 import sys
 import os
 import re
-#import datetime
+import time
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import numpy as np
 import urllib
 import json
-# import requests
+import hashlib
+import codecs
+import resource
+import sqlite3
+import datetime
+import argparse
+from argparse import RawTextHelpFormatter
+import requests
+from requests.adapters import HTTPAdapter
 # from requests.auth import HTTPDigestAuth
 from ncbr_huse import send_update, err_out, pause_for_input
 
+# Parquet is used for the query cache when pyarrow is available
+try:
+    import pyarrow
+    HAVE_PARQUET = True
+except ImportError:
+    HAVE_PARQUET = False
+
 ####################################
 # 
 # Functions for connecting to BSI
@@ -42,15 +71,146 @@ def read_conf(cnf):
 
     return(urllib.parse.quote(user, safe=''), urllib.parse.quote(pw, safe=''))
 
+# Base URL of the BSI REST API and the credentials file, overridden by BSI_URL and BSI_CNF
+BSI_URL = os.environ.get('BSI_URL', 'https://rest.bsisystems.com/api/rest/EBMS')
+BSI_CNF = os.environ.get('BSI_CNF', '~/.my.cnf.bsi')
+
+# Point all later BSI requests at another server, e.g. the local stand-in
+def set_bsi_url(url):
+    global BSI_URL
+    BSI_URL = url.rstrip('/')
+
 # Get the BSI credentials, URLs, cnf, etc
 def return_bsi_info():
-    cnf = os.path.expanduser('~/.my.cnf.bsi')
-    url_session = 'https://rest.bsisystems.com/api/rest/EBMS/common/logon'
-    url_reports = 'https://rest.bsisystems.com/api/rest/EBMS/reports/list'
+    cnf = os.path.expanduser(BSI_CNF)
+    url_session = BSI_URL + '/common/logon'
+    url_reports = BSI_URL + '/reports/list'
     curl_get = "curl -s -X GET --header 'Accept: application/json' --header 'BSI-SESSION-ID: "
     return(cnf, url_session, url_reports, curl_get)
 
+####################################
+#
+# Pooled HTTP client shared by every BSI request in the process
+#
+####################################
+# Attempts at a request the BSI server answers with an error (5xx), and seconds before the first retry
+REQUEST_ATTEMPTS = 4
+REQUEST_BACKOFF = 1.0
+
+class BSIClient(object):
+    """Keep-alive connection pool to the BSI REST server.
+
+    One instance is shared by all queries in a process (see get_bsi_client),
+    so the TLS handshake to rest.bsisystems.com is paid once instead of once
+    per report.  Every request is timed and its payload size recorded so
+    the reconciliation scripts can report where the BSI time went.
+    """
+
+    def __init__(self, pool_size=8, timeout=300):
+        self.timeout = timeout
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.stats = []
+        self._lock = threading.Lock()
+
+    # Send one request, record its latency and size, return the response
+    #   server errors (5xx) are tried up to REQUEST_ATTEMPTS times, waiting
+    #   REQUEST_BACKOFF seconds before the first retry and twice as long each time after
+    #   a streamed response is recorded once its body has been read with iter_body,
+    #   error responses are read and recorded here
+    def request(self, method, url, label, stream=False, **kwargs):
+        for attempt in range(REQUEST_ATTEMPTS):
+            start = time.time()
+            try:
+                resp = self.http.request(method, url, timeout=self.timeout, stream=stream, **kwargs)
+            except requests.exceptions.RequestException as e:
+                err_out("Errored out attempting to connect to BSI: {}".format(e))
+            if stream and resp.status_code < 400:
+                resp.bsi_label = label
+                resp.bsi_start = start
+                return(resp)
+            self.record(label, method, resp.status_code, time.time() - start, len(resp.content))
+            if resp.status_code < 500 or attempt == REQUEST_ATTEMPTS - 1:
+                break
+            wait = REQUEST_BACKOFF * 2 ** attempt
+            send_update("BSI answered {} to {}, retrying in {:g} s...".format(resp.status_code, label, wait))
+            time.sleep(wait)
+        return(resp)
+
+    # Yield the body of a streamed response in chunks, recording it when done
+    def iter_body(self, resp, chunk_size=1024 * 1024):
+        nbytes = 0
+        try:
+            for chunk in resp.iter_content(chunk_size):
+                nbytes += len(chunk)
+                yield chunk
+        except requests.exceptions.RequestException as e:
+            err_out("Errored out reading a report from BSI: {}".format(e))
+        finally:
+            resp.close()
+        resp.bsi_record = self.record(resp.bsi_label, resp.request.method, resp.status_code,
+                                      time.time() - resp.bsi_start, nbytes)
+
+    # Add a line to the request statistics
+    def record(self, label, method, status, seconds, nbytes):
+        entry = {'label': label,
+                 'method': method,
+                 'status': status,
+                 'seconds': seconds,
+                 'bytes': nbytes,
+                 'decode': None}
+        with self._lock:
+            self.stats.append(entry)
+        return(entry)
+
+    # POST the user credentials to the logon endpoint
+    def logon(self, url, user, pw):
+        headers = {'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'text/plain'}
+        # user and pw are already url quoted by read_conf
+        data = 'user_name=' + user + '&password=' + pw
+        return(self.request('POST', url, 'logon', headers=headers, data=data))
+
+    # GET a report using an established session ID
+    def get_report(self, url, session, label='report', stream=False):
+        headers = {'Accept': 'application/json', 'BSI-SESSION-ID': session}
+        return(self.request('GET', url, label, stream=stream, headers=headers))
+
+    # Summarize the time and bytes spent talking to BSI
+    def summary(self):
+        if len(self.stats) == 0:
+            return("BSI requests: none")
+
+        lines = ["BSI requests: {}, {:.2f} s, {:,} bytes".format(len(self.stats),
+                    sum([x['seconds'] for x in self.stats]),
+                    sum([x['bytes'] for x in self.stats]))]
+        for x in self.stats:
+            lines.append("    {:<8}{:<24}{:>4}{:>10.2f} s{:>14,} bytes".format(x['method'], x['label'][:23],
+                         x['status'], x['seconds'], x['bytes']))
+            # decode cost of the large reports
+            if x['decode'] is not None:
+                lines.append("        decoded {:,} rows in {:.2f} s, frame {:.1f} MB, process peak RSS {:.1f} MB".format(
+                             x['decode']['rows'], x['decode']['seconds'], x['decode']['frame_mb'], x['decode']['peak_rss_mb']))
+        return("\n".join(lines))
+
+_bsi_client = None
+_bsi_client_lock = threading.Lock()
+
+# Return the process-wide BSI client, creating it on first use
+def get_bsi_client():
+    global _bsi_client
+    with _bsi_client_lock:
+        if _bsi_client is None:
+            _bsi_client = BSIClient()
+    return(_bsi_client)
+
+# Write the per-request BSI timing summary to stdout and the log
+def report_bsi_stats(log=None, quiet=False):
+    send_update(get_bsi_client().summary(), log, quiet)
+
 # Submit the curl string to system to execute
+#   retained for callers outside this module, BSI queries here use BSIClient
 def send_curl(curl_string):
     proc = subprocess.Popen([curl_string], stdout = subprocess.PIPE, shell=True)
     (out, err) = proc.communicate()
@@ -58,166 +218,1178 @@ def send_curl(curl_string):
         err_out("Errored out attempting to establish session with BSI: .{}".format(err))
     return(out)
 
-# Get BSI connection session ID
-def get_bsi_session(url, user, pw):
-    curl_string = "curl -s -X POST --header 'Content-Type: application/x-www-form-urlencoded' --header 'Accept: text/plain' -d 'user_name=" + user + "&password=" + pw + "' 'https://rest.bsisystems.com/api/rest/EBMS/common/logon'"
-    sessionID = send_curl(curl_string)
+# Log on to BSI and return the new session ID
+def bsi_logon(url, user, pw):
+    resp = get_bsi_client().logon(url, user, pw)
+    sessionID = resp.content
 #    print("Session ID: {}".format(sessionID))
 #    print(sessionID.decode("utf-8"))
     
     if sessionID.decode("utf-8").find("Logon failed: The username, password, and database combination is incorrect") != -1:
             err_out("\n*** Error: login information is incorrect. ***\nQuitting.")
+    check_response(resp, 'logon')
 
-    #curl_string = "curl -s -X POST --header 'Content-Type: application/x-www-form-urlencoded' --header 'Accept: text/plain' -d 'user_name=" + user "' 'https://rest.bsisystems.com/api/rest/EBMS/common/logon' --digest"
-    #sessionID = send_curl(curl_string)
     return(sessionID)
 
+# Quit with the status and body of a response BSI answered with an error
+def check_response(resp, label):
+    if resp.status_code >= 400:
+        err_out("\n*** Error: BSI answered {} {} to {}: {} ***\nQuitting.".format(resp.status_code, resp.reason,
+                label, resp.text.strip()[:500]))
+
+####################################
+#
+# Session manager, one BSI logon per process (or per cache file)
+#
+####################################
+# Idle seconds after which a session is assumed to have expired on the BSI side
+SESSION_TTL = 20 * 60
+# Set to a file path (e.g. ~/.bsi_session) to share the session across processes
+SESSION_CACHE_ENV = 'BSI_SESSION_CACHE'
+
+class BSISessionManager(object):
+    """Hands out one valid BSI session ID per process.
+
+    The session is reused until it has been idle for longer than ttl seconds
+    or a request is rejected as unauthorized (see invalidate).  When
+    cache_file is set, the session is also written there with 0600
+    permissions so the next process run by the same user can reuse it.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.session = None
+        self.user = None
+        self.last_used = 0
+        self.retired = set()
+        self.credentials = None
+        self._lock = threading.RLock()
+
+    def _is_fresh(self):
+        return(self.session is not None and time.time() - self.last_used < self.ttl)
+
+    # Load a session another process left in the cache file
+    def _read_cache(self, user):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return()
+        try:
+            with open(self.cache_file, 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return()
+        if cached.get('user') == user and cached.get('session') not in self.retired:
+            self.session = cached['session'].encode('utf-8')
+            self.user = user
+            self.last_used = cached.get('last_used', 0)
+
+    # Save the session to the cache file, readable only by the user
+    def _write_cache(self):
+        if self.cache_file is None or self.session is None:
+            return()
+        tmp = self.cache_file + '.' + str(os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'user': self.user,
+                       'session': self.session.decode('utf-8'),
+                       'last_used': self.last_used}, f)
+        os.replace(tmp, self.cache_file)
+
+    # Return a valid session ID, logging on only if there is none or it expired
+    def get_session(self, url=None, user=None, pw=None):
+        with self._lock:
+            # fall back to the credentials of the last logon, then the cnf file
+            if user is None or pw is None:
+                if self.credentials is not None:
+                    user, pw = self.credentials[1:]
+                else:
+                    cnf, url_session, url_reports, curl_get = return_bsi_info()
+                    user, pw = read_conf(cnf)
+            if url is None:
+                url = self.credentials[0] if self.credentials is not None else return_bsi_info()[1]
+            self.credentials = (url, user, pw)
+
+            if self.user != user:
+                self.session = None
+            if not self._is_fresh():
+                self._read_cache(user)
+            if not self._is_fresh():
+                self.session = bsi_logon(url, user, pw)
+                self.user = user
+            self.touch()
+            return(self.session)
+
+    # Record that the session was just used, BSI expires idle sessions
+    def touch(self):
+        with self._lock:
+            self.last_used = time.time()
+            self._write_cache()
+
+    # Session IDs handed out earlier may have been replaced after an auth failure
+    def current(self, session):
+        with self._lock:
+            if session in self.retired and self.session is not None:
+                return(self.session)
+            return(session)
+
+    # Drop a session BSI refused, the next get_session logs on again
+    def invalidate(self, session):
+        with self._lock:
+            self.retired.add(session.decode('utf-8') if isinstance(session, bytes) else session)
+            self.retired.add(session)
+            if self.session == session:
+                self.session = None
+                self.last_used = 0
+
+_session_manager = None
+
+# Return the process-wide session manager
+def get_session_manager():
+    global _session_manager
+    with _bsi_client_lock:
+        if _session_manager is None:
+            cache_file = os.environ.get(SESSION_CACHE_ENV)
+            if cache_file:
+                cache_file = os.path.expanduser(cache_file)
+            else:
+                cache_file = None
+            _session_manager = BSISessionManager(cache_file=cache_file)
+    return(_session_manager)
+
+# Get BSI connection session ID
+#   reuses the process (or cached) session, only logs on when it has expired
+#   no logon is needed when queries are answered from the local mirror
+def get_bsi_session(url, user, pw):
+    if get_bsi_mirror() is not None:
+        return(b'')
+    return(get_session_manager().get_session(url, user, pw))
+
+####################################
+#
+# BSI field schema
+#
+####################################
+# Value replacements applied to every report as it is decoded
+#   00 means unknown female in BSI, 0 unknown male, seqr needs both to be 0
+PARENT_ID = {'00': '0'}
+#   pedigree (seqr) sex codes
+SEX_CODE = {'M': '1', 'F': '2'}
+
+# One row per BSI field:
+#   name used in queries, BSI table and field code, output column, dtype, value normalizer
+BSI_SCHEMA = [
+    ('CRIS Order #', 'sample.field_274', 'CRIS_Order#', 'object', None),
+    ('Phenotips ID', 'sample.field_252', 'Phenotips_ID', 'object', None),
+    ('Phenotips ID Subject', 'subject_131.field_173', 'Phenotips ID Subject', 'object', None),
+    ('Phenotips Family ID', 'subject_131.field_170', 'Phenotips_Family_ID', 'object', None),
+    ('Seqr ID', 'subject_131.field_254', 'Seqr ID', 'object', None),
+    ('Batch Sent', 'sample.field_323', 'Batch_Sent', 'category', None),
+    ('Batch Sent Subject', 'subject_131.field_194', 'Batch Sent Subject', 'category', None),
+    ('Batch Received', 'sample.field_324', 'Batch_Received', 'category', None),
+    ('Batch Received Subject', 'subject_131.field_195', 'Batch Received Subject', 'category', None),
+    ('Batch Ready', 'sample.field_340', 'Batch_Ready', 'category', None),
+    ('Instructive Case', 'subject_131.field_220', 'Instructive Case', 'object', None),
+    ('Instructive Case Comments', 'subject_131.field_221', 'Instructive Case Comments', 'object', None),
+    ('Vendor', 'sample.field_306', 'Vendor', 'category', None),
+
+    ('Father PhenotipsId', 'subject_131.field_161', 'Father_Phenotips_ID', 'object', PARENT_ID),
+    ('Mother PhenotipsId', 'subject_131.field_167', 'Mother_Phenotips_ID', 'object', PARENT_ID),
+    ('Family Complete Status', 'subject_131.field_188', 'Family_Complete_Status', 'category', None),
+    ('Family MRN', 'subject_131.field_157', 'Family MRN', 'object', None),
+    ('Father MRN', 'subject_131.field_160', 'Father MRN', 'object', None),
+    ('Mother MRN', 'subject_131.field_166', 'Mother MRN', 'object', None),
+
+    ('Adopted', 'subject_131.field_149', 'Adopted', 'category', None),
+    ('Relationship', 'subject_131.field_182', 'Relationship', 'category', None),
+    ('Affected Status', 'subject_131.field_150', 'Affected', 'category', None),
+    ('Active Status', 'subject_131.field_189', 'Active_Status', 'category', None),
+    ('Archive', 'subject_131.field_216', 'Archive', 'object', None),
+    ('CRIS Report Genes', 'subject_131.field_253', 'CRIS Report Genes', 'object', None),
+
+    ('CMA', 'subject_131.field_203', 'CMA', 'object', None),
+    ('Exome ID', 'sample.field_337', 'Exome_ID', 'object', None),
+    ('DLM LIS Number', 'sample.field_336', 'DLM_LIS_Number', 'object', None),
+    ('CRIS Order Status', 'sample.field_314', 'CRIS_Order_Status', 'category', None),
+    ('MRN', 'sample.subject_id', 'MRN', 'object', None),
+    ('Date Drawn', 'sample.date_drawn', 'Date_Drawn', 'object', None),
+    ('GRIS Owner', 'subject_131.field_191', 'GRIS_Owner', 'category', None),
+    ('Patient Name', 'sample.field_322', 'Patient_Name', 'object', None),
+    ('Patient Name Subject', 'subject_131.field_169', 'Patient Name Subject', 'object', None),
+    ('Date Received', 'vial.date_received', 'Date_Received', 'object', None),
+    ('Gender', 'subject_131.field_163', 'Gender', 'category', SEX_CODE),
+    ('Sex', 'sample.sex', 'Sex', 'category', None),
+    ('Race', 'sample.field_326', 'Race', 'category', None),
+    ('Ethnicity', 'subject_131.field_155', 'Ethnicity', 'category', None),
+    ('Age', 'sample.field_208', 'Age', 'object', None),
+    ('Tissue Origin', 'vial.tissue_origin', 'Tissue', 'category', None),
+    ('Proband', 'subject_131.field_171', 'Proband', 'category', None),
+    ('Order Date', 'sample.field_297', 'Order_Date', 'object', None),
+    ('Date of Birth', 'subject_131.field_152', 'Date of Birth', 'object', None),
+
+    ('First drafter', 'subject_131.field_204', 'First drafter', 'object', None),
+    ('Date report drafted', 'subject_131.field_205', 'Date report drafted', 'object', None),
+    ('Date team was notified', 'subject_131.field_208', 'Date team was notified', 'object', None),
+    ('Date documented in CRIMSON', 'subject_131.field_214', 'Date documented in CRIMSON', 'object', None),
+    ('Report Status', 'subject_131.field_206', 'Report Status', 'category', None),
+    ('Discloser', 'subject_131.field_207', 'Discloser', 'object', None),
+    ('Date disclosed to patient', 'subject_131.field_211', 'Date disclosed to patient', 'object', None),
+    ('Date of 1st contact', 'subject_131.field_209', 'Date of 1st contact', 'object', None),
+    ('Date of 2nd contact', 'subject_131.field_210', 'Date of 2nd contact', 'object', None),
+    ('Date of CRIS upload', 'subject_131.field_212', 'Date of CRIS upload', 'object', None),
+    ('Date data in Illumina', 'subject_131.field_259', 'Date data in Illumina', 'object', None),
+    ('Date of Enrollment', 'subject_131.field_196', 'Date of Enrollment', 'object', None),
+    ('Date data returned', 'subject_131.field_257', 'Date data returned', 'object', None),
+    ('Date uploaded to seqr', 'subject_131.field_258', 'Date uploaded to seqr', 'object', None),
+
+    ('Box', 'location.box', 'Box', 'object', None),
+    ('Row', 'vial_location.row', 'Row', 'object', None),
+    ('Col', 'vial_location.col', 'Col', 'object', None)
+    ]
+
+# Other names accepted in queries for the same fields
+BSI_ALIASES = {'Father Phenotips ID': 'Father PhenotipsId',
+               'Mother Phenotips ID': 'Mother PhenotipsId',
+               'Affected': 'Affected Status',
+               'CIDR Exome ID': 'Exome ID'}
+
+# Lookups built once from the schema
+#   name -> code, code -> name, code -> column, code -> dtype, code -> normalizer, column -> code,
+#   and the names (report headers) of the categorical fields
+BSI_FIELDS = dict([(x[0], x[1]) for x in BSI_SCHEMA])
+BSI_FIELDS.update(dict([(alias, BSI_FIELDS[name]) for alias, name in BSI_ALIASES.items()]))
+BSI_NAMES = dict([(x[1], x[0]) for x in BSI_SCHEMA])
+BSI_COLUMNS = dict([(x[1], x[2]) for x in BSI_SCHEMA])
+BSI_DTYPES = dict([(x[1], x[3]) for x in BSI_SCHEMA])
+BSI_NORMALIZERS = dict([(x[1], x[4]) for x in BSI_SCHEMA if x[4] is not None])
+BSI_COLUMN_CODES = dict([(x[2], x[1]) for x in BSI_SCHEMA])
+BSI_CATEGORICAL = set([x[0] for x in BSI_SCHEMA if x[3] == 'category'])
+
 # Get the table and field code names within BSI for query construction
 def get_bsi_name(infield):
-    fieldDict = {'CRIS Order #' : 'sample.field_274',
-        'Phenotips ID' : 'sample.field_252',
-        'Phenotips ID Subject' : 'subject_131.field_173',
-        'Phenotips Family ID' : 'subject_131.field_170',
-        'Seqr ID' : 'subject_131.field_254',
-        'Batch Sent' : 'sample.field_323',
-        'Batch Sent Subject': 'subject_131.field_194',
-        'Batch Received' : 'sample.field_324',
-        'Batch Received Subject' : 'subject_131.field_195',
-        'Batch Ready' : 'sample.field_340',
-        'Instructive Case' : 'subject_131.field_220', 
-        'Instructive Case Comments' : 'subject_131.field_221',
-        'Vendor' : 'sample.field_306',
-        
-        'Father PhenotipsId' : 'subject_131.field_161',
-        'Mother PhenotipsId' : 'subject_131.field_167',
-        'Father Phenotips ID' : 'subject_131.field_161',
-        'Mother Phenotips ID' : 'subject_131.field_167',
-        'Family Complete Status': 'subject_131.field_188',
-        'Family MRN' : 'subject_131.field_157',
-        'Father MRN' : 'subject_131.field_160',
-        'Mother MRN' : 'subject_131.field_166',
-
-        'Adopted' : 'subject_131.field_149',
-        'Relationship' : 'subject_131.field_182',
-        'Affected Status' : 'subject_131.field_150',
-        'Affected' : 'subject_131.field_150',
-        'Active Status' : 'subject_131.field_189',
-        'Archive' : 'subject_131.field_216',
-        'CRIS Report Genes' : 'subject_131.field_253',
-
-        'CMA' : 'subject_131.field_203',
-        'Exome ID' : 'sample.field_337',
-        'CIDR Exome ID' : 'sample.field_337',
-        'DLM LIS Number' : 'sample.field_336',
-        'CRIS Order Status' : 'sample.field_314',
-        'MRN' : 'sample.subject_id',
-        'Date Drawn' : 'sample.date_drawn',
-        'GRIS Owner' : 'subject_131.field_191',
-        'Patient Name' : 'sample.field_322',
-        'Patient Name Subject' : 'subject_131.field_169',
-        'Date Received' : 'vial.date_received',
-        'Gender' : 'subject_131.field_163',
-        'Sex' : 'sample.sex',
-        'Race' : 'sample.field_326',
-        'Ethnicity' : 'subject_131.field_155',
-        'Age' : 'sample.field_208',
-        'Tissue Origin' : 'vial.tissue_origin',
-        'Proband' : 'subject_131.field_171', 
-        'Order Date' : 'sample.field_297',
-        'Date of Birth' : 'subject_131.field_152',
-
-        'First drafter' : 'subject_131.field_204',
-        'Date report drafted' : 'subject_131.field_205',
-        'Date team was notified' : 'subject_131.field_208',
-        'Date documented in CRIMSON' : 'subject_131.field_214',
-        'Report Status' : 'subject_131.field_206',
-        'Discloser' : 'subject_131.field_207',
-        'Date disclosed to patient' : 'subject_131.field_211',
-        'Date of 1st contact' : 'subject_131.field_209',
-        'Date of 2nd contact' : 'subject_131.field_210',
-        'Date of CRIS upload' : 'subject_131.field_212',
-        'Date data in Illumina' : 'subject_131.field_259',
-        'Date of Enrollment' : 'subject_131.field_196',
-        'Date data returned' : 'subject_131.field_257',
-        'Date uploaded to seqr' : 'subject_131.field_258',
-
-        'Box' : 'location.box',
-        'Row' : 'vial_location.row',
-        'Col' : 'vial_location.col'
-        }
-    return(fieldDict[infield])
+    return(BSI_FIELDS[infield])
 
-# Construct a query and send to BSI, return a dataframe
-def bsi_query(curl, url, session, fields, theIDs, search_field, isequal=True, islike=False):
-    fields = [get_bsi_name(f) for f in fields]
+# Name, type and normalize the columns of a report for fields, in one pass
+#   columns are named by position from the schema, so they do not depend on
+#   the header text BSI sends; blank values become NaN
+def apply_bsi_schema(df, fields):
+    codes = [get_bsi_name(f) for f in fields]
+    if df.shape[1] != len(codes):
+        err_out("\n*** BSI returned {} columns for {} fields ***\nQuitting.".format(df.shape[1], len(codes)))
 
-    study = "&criteria=subject.study_id%3DNIAID%20Centralized%20Sequencing"
-    ## order status added as per Xi Cheng email 2/20/2019
-    order_status = "&criteria=sample.field_314%3D%22Specimen%20Collected%22"
-    limit = '10'
-    
+    columns = []
+    for i, code in enumerate(codes):
+        col = df.iloc[:, i]
+        normalizer = BSI_NORMALIZERS.get(code)
+
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            # work on the few distinct values rather than every row
+            cats = col.cat.categories.tolist()
+            col = col.cat.remove_categories([x for x in cats if str(x).strip() == ''])
+            if normalizer is not None:
+                cats = col.cat.categories.tolist()
+                new = [normalizer.get(x, x) for x in cats]
+                if len(set(new)) == len(new):
+                    col = col.cat.rename_categories(new)
+                else:
+                    col = col.astype(object).replace(normalizer)
+        else:
+            col = col.replace(r'^\s*$', np.nan, regex=True)
+            if normalizer is not None:
+                col = col.replace(normalizer)
+
+        if BSI_DTYPES[code] == 'category' and not isinstance(col.dtype, pd.CategoricalDtype):
+            col = col.astype('category')
+        columns.append(col)
+
+    if len(columns) > 0:
+        df = pd.concat(columns, axis=1)
+    df.columns = [BSI_COLUMNS[c] for c in codes]
+    return(df)
+
+# Operators accepted in bsi_query filters, as (isequal, islike)
+FILTER_OPS = {'eq': (True, False),
+              'in': (True, False),
+              'ne': (False, False),
+              'like': (True, True),
+              'notlike': (False, True)}
+
+## order status criterion added as per Xi Cheng email 2/20/2019, pass it in filters to use it
+ORDER_COLLECTED = ('CRIS Order Status', 'eq', 'Specimen Collected')
+
+# Check bsi_query filters and convert them to (search_field, values, isequal, islike) criteria
+#   a filter is (field, op, value or list of values), op is one of FILTER_OPS;
+#   "*" in a value is a wildcard and a like filter matches anywhere in the field
+def filter_criteria(filters):
+    criteria = []
+    for f in (filters or []):
+        if len(f) != 3 or f[1] not in FILTER_OPS:
+            err_out("Error: BSI query filter {} is not (field, op, values) with op one of {}".format(f, list(FILTER_OPS.keys())))
+        field, op, values = f
+        if isinstance(values, str):
+            values = [values]
+        get_bsi_name(field)
+        isequal, islike = FILTER_OPS[op]
+        criteria.append((field, [str(x) for x in values], isequal, islike))
+    return(criteria)
+
+# One criteria= parameter of a report URL
+def report_criterion(search_field, theIDs, isequal=True, islike=False):
     # replace spaces in the IDs with "%20"
     theIDs = [re.sub(" ", "%20", x) for x in theIDs]
 
-    # Construct the curl command
-    curl += session.decode(encoding='UTF-8') + "'"
-    ## order status added as per Xi Cheng email 2/20/2019
-    curl += " '" + url + "?display_fields=" + "&display_fields=".join(fields) + study 
-    #curl += " '" + url + "?display_fields=" + "&display_fields=".join(fields) + study + order_status
-    curl += "&criteria=" + get_bsi_name(search_field)
-    #print(curl)
+    criterion = "&criteria=" + get_bsi_name(search_field)
 
     # add the "!" for not or "=@" for like
     if not isequal:
-        curl += "!"
+        criterion += "!"
     if not islike:
-        curl += "%3D" + "%3B".join(theIDs)
+        criterion += "%3D" + "%3B".join(theIDs)
     else:
-        curl += "%3D%40" + "%3B".join(theIDs)
+        criterion += "%3D%40" + "%3B".join(theIDs)
+    return(criterion)
 
-    curl = curl + "&type=1'"
-#    print(curl)
+# Construct the reports/list URL for a query, filters are extra criteria from filter_criteria
+def build_report_url(url, fields, theIDs, search_field, isequal=True, islike=False, filters=None):
+    fields = [get_bsi_name(f) for f in fields]
 
-    # Get the data using the curl command
-    data = send_curl(curl)
-    # print("DATA:\n{}".format(data))
+    study = "&criteria=subject.study_id%3DNIAID%20Centralized%20Sequencing"
 
-    data = data.decode('utf-8')
-    data = json.loads(data)
+    query = url + "?display_fields=" + "&display_fields=".join(fields) + study 
+    # without a search field the report covers the whole study
+    if search_field is not None:
+        query += report_criterion(search_field, theIDs, isequal, islike)
 
-    #print(data)
+    # every filter must also hold
+    for criterion in (filters or []):
+        query += report_criterion(*criterion)
 
-    if 'message' in data:
-        if re.search("Error running report:", data['message']):
+    query += "&type=1"
+    return(query)
+
+# Is this response BSI rejecting the session rather than the query
+def is_auth_failure(resp):
+    if resp.status_code in (401, 403):
+        return(True)
+    return(resp.status_code >= 400 and re.search('session', resp.text, re.IGNORECASE) is not None)
+
+# GET a report URL as a streamed response, logging on again once if the session was rejected
+def open_report(query, session, label='report'):
+    manager = get_session_manager()
+    session = manager.current(session)
+
+    resp = get_bsi_client().get_report(query, session.decode(encoding='UTF-8'), label, stream=True)
+    if is_auth_failure(resp):
+        send_update("BSI session was rejected, logging on again...")
+        manager.invalidate(session)
+        session = manager.get_session()
+        resp = get_bsi_client().get_report(query, session.decode(encoding='UTF-8'), label, stream=True)
+        if is_auth_failure(resp):
+            err_out("\n*** Error: BSI refused the session after logging on again. ***\nQuitting.")
+    check_response(resp, label)
+    manager.touch()
+
+    return(resp)
+
+####################################
+#
+# Streaming, paged decoding of report payloads
+#
+####################################
+# Rows requested per page, None sends each report as one request
+#   BSI does not document limit/offset, so paging is off unless BSI_PAGE_SIZE or --bsi-page-size sets it
+QUERY_PAGE_SIZE = int(os.environ['BSI_PAGE_SIZE']) if os.environ.get('BSI_PAGE_SIZE', '') not in ('', '0') else None
+# Reports with at least this many rows get their decode time and memory reported
+QUERY_LARGE_ROWS = 10000
+
+# Set to False the first time BSI is seen ignoring the paging parameters
+_paging_supported = True
+
+class ReportStreamParser(object):
+    """Incremental parser for the reports/list JSON payload.
+
+    Reads the body a chunk at a time and yields the top level members,
+    except that each element of "rows" is yielded as soon as it has
+    arrived, so the full payload is never held as one string or one
+    decoded object.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    # Append the next chunk of text to the buffer, False at the end of the body
+    def _more(self):
+        while not self.eof:
+            try:
+                text = self.decoder.decode(next(self.chunks))
+            except StopIteration:
+                text = self.decoder.decode(b'', final=True)
+                self.eof = True
+            if text != '':
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return(True)
+        return(False)
+
+    # Return the next non-blank character without consuming it, None at the end
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return(self.buf[self.pos])
+            if not self._more():
+                return(None)
+
+    # Decode the next JSON value, reading more of the body until it is complete
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return(value)
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self._more():
+                value, self.pos = self.json.raw_decode(self.buf, self.pos)
+                return(value)
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("Malformed BSI report: expected '{}'".format(char))
+        self.pos += 1
+
+    # Yield ('row', row) for every row and (key, value) for every other member
+    def __iter__(self):
+        self._expect('{')
+        while True:
+            c = self._peek()
+            if c == '}' or c is None:
+                # read the rest of the body so the response is complete
+                while self._more():
+                    pass
+                return
+            if c == ',':
+                self.pos += 1
+                continue
+            key = self._value()
+            self._expect(':')
+            if key != 'rows':
+                yield (key, self._value())
+                continue
+
+            self._expect('[')
+            while True:
+                c = self._peek()
+                if c == ']':
+                    self.pos += 1
+                    break
+                if c == ',':
+                    self.pos += 1
+                    continue
+                yield ('row', self._value())
+
+# Decode a streamed report into a typed dataframe, calling on_rows(n) as rows arrive
+def decode_report(resp, on_rows=None):
+    start = time.time()
+    members = {}
+    columns = None
+    nrows = 0
+
+    for key, value in ReportStreamParser(get_bsi_client().iter_body(resp)):
+        if key != 'row':
+            members[key] = value
+            continue
+        if columns is None:
+            columns = [[] for x in value]
+        for col, x in zip(columns, value):
+            col.append(x)
+        nrows += 1
+        if on_rows is not None:
+            on_rows(nrows)
+
+    if 'message' in members:
+        if re.search("Error running report:", members['message']):
             err_out("\n*** BSI query failed to return valid results ***\nQuitting.")
 
-    if len(data) == 0:
+    if 'headers' not in members:
         err_out("BSI query failed to return valid results")
-        
-    # Convert the data into a dataframe
-    df = pd.DataFrame(data['rows'], columns=data['headers'])
+
+    # Build each column once, low cardinality columns straight to categoricals
+    headers = members['headers']
+    if columns is None:
+        columns = [[] for x in headers]
+    data = dict()
+    for i, (header, col) in enumerate(zip(headers, columns)):
+        if header in BSI_CATEGORICAL:
+            data[i] = pd.Categorical(col)
+        else:
+            data[i] = pd.Series(col, dtype=object)
+    columns = None
+    df = pd.DataFrame(data)
+    df.columns = headers
     # print("Curl results size: {}".format(df.shape))
 
-    # Rename the columns:
-    colnameDict = {'CRIS Order #': 'CRIS_Order#',
-                   'Batch Sent': 'Batch_Sent',
-                   'Batch Received': 'Batch_Received',
-                   'Batch Ready': 'Batch_Ready',
-                   'Phenotips Family ID': 'Phenotips_Family_ID',
-                   'PhenotipsId': 'Phenotips_ID',
-                   'Mother PhenotipsId': 'Mother_Phenotips_ID',
-                   'Father PhenotipsId': 'Father_Phenotips_ID',
-                   'Family Complete Status':  'Family_Complete_Status',
-                   'Affected Status': 'Affected',
-                   'CIDR Exome ID':'CIDR_Exome_ID',
-                   'CRIS Order Status':'CRIS_Order_Status',
-                   'Patient Name':'Patient_Name',
-                   'Date Drawn' : 'Date_Drawn',
-                   'Date Received' : 'Date_Received',
-                   'GRIS Owner' : 'GRIS_Owner',
-                   'Tissue Origin' : 'Tissue',
-                   'Subject ID': 'MRN', 
-                   'Order Date' : 'Order_Date'}
-    df.rename(columns=colnameDict, inplace=True)
-
-    return(df)
\ No newline at end of file
+    if nrows >= QUERY_LARGE_ROWS:
+        resp.bsi_record['decode'] = {'rows': nrows,
+                                     'seconds': time.time() - start,
+                                     'frame_mb': df.memory_usage(deep=True).sum() / 1024.0 / 1024.0,
+                                     'peak_rss_mb': peak_rss_mb()}
+    return(df)
+
+# Peak resident memory of this process so far, in MB
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    if sys.platform == 'darwin':
+        return(rss / 1024.0 / 1024.0)
+    return(rss / 1024.0)
+
+# Add the paging parameters to a report URL
+def page_url(query, offset, page_size):
+    return(query + "&limit={}&offset={}".format(page_size, offset))
+
+# Close the responses of prefetched pages that will not be read
+def close_prefetched(nxt):
+    for offset, f in nxt:
+        f.result().close()
+
+# Fetch one report a page at a time, each page decoded as it streams in
+#   the next page starts at the rows received so far and paging ends on an empty page,
+#   so a server that caps limit below page_size still returns every row
+def fetch_paged(query, session, label):
+    global _paging_supported
+    page_size = QUERY_PAGE_SIZE
+
+    if page_size is None or not _paging_supported:
+        return(decode_report(open_report(query, session, label)))
+
+    frames = []
+    offset = 0
+    resp = open_report(page_url(query, offset, page_size), session, label)
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        while True:
+            # once this page is half full, another full page is likely, start requesting it
+            nxt = []
+            def on_rows(n):
+                if n == page_size // 2 + 1 and len(nxt) == 0:
+                    nxt.append((offset + page_size, prefetcher.submit(open_report, page_url(query, offset + page_size, page_size), session, label)))
+
+            df = decode_report(resp, on_rows)
+
+            if len(frames) == 0 and df.shape[0] > page_size:
+                # BSI ignored limit and sent the whole report
+                send_update("BSI did not page the report, paging is off for this run")
+                _paging_supported = False
+                close_prefetched(nxt)
+                return(df)
+
+            if len(frames) > 0 and df.shape[0] > 0 and df.equals(frames[0]):
+                # BSI kept to limit but ignored offset, only one request for the whole report gets every row
+                send_update("BSI did not page the report, fetching it whole...")
+                _paging_supported = False
+                close_prefetched(nxt)
+                return(decode_report(open_report(query, session, label)))
+
+            if df.shape[0] == 0:
+                close_prefetched(nxt)
+                if len(frames) == 0:
+                    return(df)
+                break
+
+            frames.append(df)
+            offset += df.shape[0]
+            if len(nxt) > 0 and nxt[0][0] == offset:
+                resp = nxt[0][1].result()
+            else:
+                close_prefetched(nxt)
+                resp = open_report(page_url(query, offset, page_size), session, label)
+
+    if len(frames) == 1:
+        return(frames[0])
+    return(type_report_columns(pd.concat(frames, ignore_index=True)))
+
+# Make sure the low cardinality report columns are categoricals after concatenation
+def type_report_columns(df):
+    for header in df.columns:
+        if header in BSI_CATEGORICAL and not isinstance(df[header].dtype, pd.CategoricalDtype):
+            df[header] = df[header].astype('category')
+    return(df)
+
+####################################
+#
+# On-disk cache of report results
+#
+####################################
+# Default cache location, lifetime (seconds) and size limit (bytes)
+QUERY_CACHE_DIR = os.path.expanduser('~/.cache/ncbr_bsi')
+QUERY_CACHE_TTL = 30 * 60
+QUERY_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+class BSIQueryCache(object):
+    """Time limited, size bounded cache of BSI report results.
+
+    Each result is stored as one Parquet file (pickle when pyarrow is not
+    installed) named by a hash of the normalized query.  The file mtime is
+    the time the report was pulled and is used for the ttl; the atime is
+    set on every hit and is used to evict the least recently used entries
+    once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir=QUERY_CACHE_DIR, ttl=QUERY_CACHE_TTL, max_bytes=QUERY_CACHE_MAX_BYTES,
+                 enabled=True, refresh=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        self.ext = '.parquet' if HAVE_PARQUET else '.pkl'
+        self._lock = threading.Lock()
+
+    # Key on everything that changes the rows BSI returns, but not on ID order or repeats
+    def make_key(self, url, fields, theIDs, search_field, isequal, islike, filters=None):
+        key = {'url': url,
+               'fields': [get_bsi_name(f) for f in fields],
+               'search_field': get_bsi_name(search_field),
+               'operator': ('' if isequal else '!') + ('=@' if islike else '='),
+               'ids': sorted(set([str(x) for x in theIDs]))}
+        # older entries have no filters key, keep their keys unchanged
+        if filters:
+            key['filters'] = sorted([[get_bsi_name(f), sorted(set(v)), e, l] for f, v, e, l in filters])
+        key = json.dumps(key, sort_keys=True)
+        return(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _path(self, key):
+        return(os.path.join(self.cache_dir, key + self.ext))
+
+    # Return the cached frame, or None if missing, expired or refreshing
+    def get(self, key):
+        if not self.enabled or self.refresh:
+            return(None)
+
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return(None)
+        if time.time() - st.st_mtime > self.ttl:
+            return(None)
+
+        try:
+            if HAVE_PARQUET:
+                df = pd.read_parquet(path)
+            else:
+                df = pd.read_pickle(path)
+        except Exception:
+            return(None)
+
+        # atime records the last use, mtime stays the time the report was pulled
+        os.utime(path, (time.time(), st.st_mtime))
+        return(df)
+
+    # Store a frame and trim the cache back to max_bytes
+    def put(self, key, df):
+        if not self.enabled:
+            return()
+
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        path = self._path(key)
+        tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        if HAVE_PARQUET:
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_pickle(tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+    # Remove expired entries, then least recently used ones until under max_bytes
+    def evict(self):
+        with self._lock:
+            entries = []
+            now = time.time()
+            for fname in os.listdir(self.cache_dir):
+                if not fname.endswith(self.ext):
+                    continue
+                path = os.path.join(self.cache_dir, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if now - st.st_mtime > self.ttl:
+                    os.remove(path)
+                else:
+                    entries.append((st.st_atime, st.st_size, path))
+
+            total = sum([x[1] for x in entries])
+            for atime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                os.remove(path)
+                total -= size
+
+_query_cache = BSIQueryCache()
+
+# Return the process-wide query cache
+def get_query_cache():
+    return(_query_cache)
+
+# Replace the query cache settings for all later queries
+def configure_bsi_cache(enabled=True, refresh=False, ttl=QUERY_CACHE_TTL, cache_dir=QUERY_CACHE_DIR,
+                        max_bytes=QUERY_CACHE_MAX_BYTES):
+    global _query_cache
+    _query_cache = BSIQueryCache(cache_dir, ttl, max_bytes, enabled, refresh)
+
+# Add the shared BSI command line options to a script's argument parser
+def add_bsi_args(parser):
+    group = parser.add_argument_group('BSI query options')
+    group.add_argument('--no-cache', required=False, action='store_true', default=False,
+                       help='Do not read or write the local BSI query cache')
+    group.add_argument('--refresh', required=False, action='store_true', default=False,
+                       help='Re-pull every BSI report and update the local cache')
+    group.add_argument('--cache-ttl', required=False, type=int, default=QUERY_CACHE_TTL,
+                       help='Seconds a cached BSI report stays valid (default: {})'.format(QUERY_CACHE_TTL))
+    group.add_argument('--bsi-chunk-size', required=False, type=int, default=QUERY_CHUNK_SIZE,
+                       help='Most IDs per BSI request (default: {})'.format(QUERY_CHUNK_SIZE))
+    group.add_argument('--bsi-workers', required=False, type=int, default=QUERY_WORKERS,
+                       help='Most concurrent BSI requests per query (default: {})'.format(QUERY_WORKERS))
+    group.add_argument('--bsi-page-size', required=False, type=int, default=None,
+                       help='Request reports this many rows at a time, 0 for whole reports\n(default: $BSI_PAGE_SIZE, or whole reports)')
+    group.add_argument('--mirror', required=False, nargs='?', type=str, default=None, const=MIRROR_DEFAULT,
+                       help='Answer BSI queries from the local mirror built by "ncbr_bsi.py sync"\n(default path: {})\n\
+Order status, batch, family, parent, sex and affected fields are as of the last sync,\n\
+other fields at most {} days older than that'.format(MIRROR_DEFAULT, MIRROR_FULL_DAYS))
+    group.add_argument('--bsi-url', required=False, type=str, default=None,
+                       help='Base URL of the BSI REST API (default: $BSI_URL or {})'.format(BSI_URL))
+    return(group)
+
+# Apply the options added by add_bsi_args
+def configure_bsi(args):
+    configure_bsi_cache(enabled=not args.no_cache, refresh=args.refresh, ttl=args.cache_ttl)
+    set_query_chunking(args.bsi_chunk_size, args.bsi_workers, args.bsi_page_size)
+    if args.bsi_url is not None:
+        set_bsi_url(args.bsi_url)
+    if args.mirror is not None:
+        use_bsi_mirror(args.mirror)
+
+####################################
+#
+# Splitting long ID lists across several concurrent requests
+#
+####################################
+# Most IDs sent in one report request
+QUERY_CHUNK_SIZE = 200
+# Most characters of encoded IDs in one request URL, keeps URLs well under server limits
+QUERY_MAX_ID_CHARS = 4000
+# Most report requests in flight at once for one bsi_query
+QUERY_WORKERS = 4
+
+# Change the default chunk size, parallelism and page size for all later queries
+#   a page size of 0 turns paging off
+def set_query_chunking(chunk_size=None, workers=None, page_size=None):
+    global QUERY_CHUNK_SIZE, QUERY_WORKERS, QUERY_PAGE_SIZE
+    if chunk_size is not None:
+        QUERY_CHUNK_SIZE = max(1, int(chunk_size))
+    if workers is not None:
+        QUERY_WORKERS = max(1, int(workers))
+    if page_size is not None:
+        QUERY_PAGE_SIZE = int(page_size) if int(page_size) > 0 else None
+
+# Split IDs into lists that each fit in one request URL, dropping repeated IDs
+def chunk_ids(theIDs, chunk_size=None, max_chars=QUERY_MAX_ID_CHARS):
+    if chunk_size is None:
+        chunk_size = QUERY_CHUNK_SIZE
+
+    chunks = []
+    chunk = []
+    chunk_chars = 0
+    seen = set()
+    for x in theIDs:
+        if x in seen:
+            continue
+        seen.add(x)
+
+        # each ID is sent url quoted with a %3B separator
+        x_chars = len(urllib.parse.quote(str(x))) + 3
+        if len(chunk) > 0 and (len(chunk) >= chunk_size or chunk_chars + x_chars > max_chars):
+            chunks.append(chunk)
+            chunk = []
+            chunk_chars = 0
+        chunk.append(x)
+        chunk_chars += x_chars
+
+    if len(chunk) > 0 or len(chunks) == 0:
+        chunks.append(chunk)
+    return(chunks)
+
+# Concatenate the chunk results, a row returned by more than one chunk is kept
+#   only as many times as the most any single chunk returned it
+def combine_chunks(frames):
+    if len(frames) == 1:
+        return(frames[0])
+
+    cols = frames[0].columns.tolist()
+    tagged = []
+    for df in frames:
+        df = df.copy()
+        df['_occurrence'] = df.groupby(cols, sort=False, dropna=False).cumcount()
+        tagged.append(df)
+    df = pd.concat(tagged, ignore_index=True)
+    df = df.drop_duplicates().drop(columns='_occurrence').reset_index(drop=True)
+    return(type_report_columns(df))
+
+# Send the chunked report requests to BSI, return the combined dataframe
+def fetch_query(url, session, fields, chunks, search_field, isequal, islike, max_workers, filters=None):
+    queries = [build_report_url(url, fields, ids, search_field, isequal, islike, filters) for ids in chunks]
+#    print(queries)
+
+    label = search_field if search_field is not None else 'whole study'
+
+    # Get the data through the shared, pooled BSI client
+    if len(queries) == 1:
+        frames = [fetch_paged(queries[0], session, label)]
+    else:
+        label = "{} ({} chunks)".format(label, len(queries))
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as pool:
+            frames = list(pool.map(lambda q: fetch_paged(q, session, label), queries))
+
+    return(combine_chunks(frames))
+
+# Construct a query and send to BSI, return a dataframe
+#   curl is no longer used to send the request, it is kept so existing callers
+#   that pass the return_bsi_info() curl string continue to work
+#   long ID lists are split into chunks of chunk_size IDs fetched by up to max_workers threads
+#   filters are extra (field, op, values) conditions applied by BSI, see filter_criteria, e.g.
+#       filters=[('Active Status', 'ne', 'Inactive'), ('CRIS Order Status', 'notlike', ['Cancel', 'Auto Complete'])]
+def bsi_query(curl, url, session, fields, theIDs, search_field, isequal=True, islike=False,
+              filters=None, chunk_size=None, max_workers=None):
+    if max_workers is None:
+        max_workers = QUERY_WORKERS
+
+    theIDs = list(theIDs)
+    filters = filter_criteria(filters)
+
+    # a "not equal" list has to be sent whole, each chunk alone would match the other chunks' IDs
+    if isequal:
+        chunks = chunk_ids(theIDs, chunk_size)
+    else:
+        chunks = [theIDs]
+
+    # Answer from the local mirror if one is in use, else reuse a recent identical report
+    mirror = get_bsi_mirror()
+    cache = get_query_cache()
+    if mirror is not None:
+        start = time.time()
+        df = mirror.query(fields, theIDs, search_field, isequal, islike, filters)
+        get_bsi_client().record(str(search_field), 'MIRROR', 'ok', time.time() - start, 0)
+    else:
+        cache_key = cache.make_key(url, fields, theIDs, search_field, isequal, islike, filters)
+        df = cache.get(cache_key)
+        if df is not None:
+            get_bsi_client().record(str(search_field), 'CACHE', 'hit', 0, 0)
+        else:
+            df = fetch_query(url, session, fields, chunks, search_field, isequal, islike, max_workers, filters)
+            cache.put(cache_key, df)
+
+    # Name, type and normalize the columns
+    df = apply_bsi_schema(df, fields)
+
+    return(df)
+
+# Run several independent queries at once over one session, return the dataframes in order
+#   each spec is a dict of bsi_query arguments: fields, theIDs, search_field and
+#   optionally isequal, islike and filters; an err_out in any query ends the run as it would serially
+def bsi_query_many(curl, url, session, specs, max_workers=None):
+    if max_workers is None:
+        max_workers = QUERY_WORKERS
+
+    def run(spec):
+        return(bsi_query(curl, url, session, spec['fields'], spec['theIDs'], spec['search_field'],
+                         spec.get('isequal', True), spec.get('islike', False), spec.get('filters')))
+
+    if len(specs) <= 1:
+        return([run(spec) for spec in specs])
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(specs))) as pool:
+        return(list(pool.map(run, specs)))
+
+
+####################################
+#
+# Local mirror of the study's sample and subject fields
+#
+####################################
+MIRROR_DEFAULT = os.path.join(QUERY_CACHE_DIR, 'bsi_mirror.sqlite')
+# Fields that get an index in the mirror, these are the ones queries search on
+MIRROR_INDEXED = ['CRIS Order #', 'Phenotips ID', 'Phenotips Family ID', 'Batch Sent', 'Batch Received',
+                  'Exome ID', 'DLM LIS Number', 'MRN']
+# Fields that change after enrollment, pulled for the whole study on every sync
+#   includes every pedigree column (family, parents, sex, affected status) so peds from the mirror are current
+MIRROR_VOLATILE = ['CRIS Order #', 'Phenotips ID', 'Phenotips Family ID', 'Father PhenotipsId', 'Mother PhenotipsId',
+                   'Gender', 'Affected Status', 'Batch Sent', 'Batch Received', 'Batch Ready', 'CRIS Order Status',
+                   'Active Status', 'Exome ID']
+# Days after which a sync pulls every mirrored field again
+MIRROR_FULL_DAYS = 7
+
+class BSIMirror(object):
+    """SQLite copy of every sample and subject field in BSI_FIELDS.
+
+    Vial and location fields are left out, they would repeat each sample
+    once per vial.  Columns are named by BSI code, the report header BSI
+    returned for each code is kept so query() returns the same column
+    names as a live report.
+
+    Every sync pulls the MIRROR_VOLATILE fields (order status, batches,
+    family, parents, sex and affected status) for the whole study, and
+    replaces every row of each family with an order whose values changed,
+    appeared or went away.  The other fields are only refreshed with those families, or
+    for the whole study once the last full pull is MIRROR_FULL_DAYS old.
+    """
+
+    def __init__(self, path=MIRROR_DEFAULT):
+        self.path = path
+        self.codes = []
+        for code in BSI_FIELDS.values():
+            if code.split('.')[0] in ('sample', 'subject_131') and code not in self.codes:
+                self.codes.append(code)
+        self._local = threading.local()
+
+    # One connection per thread, sqlite connections can't be shared
+    def connect(self):
+        con = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path)
+            self._local.con = con
+        return(con)
+
+    def exists(self):
+        return(os.path.isfile(self.path))
+
+    def create(self):
+        dirname = os.path.dirname(self.path)
+        if dirname != '':
+            os.makedirs(dirname, mode=0o700, exist_ok=True)
+        con = self.connect()
+        cols = ", ".join(['"{}" TEXT'.format(c) for c in self.codes])
+        con.execute('CREATE TABLE IF NOT EXISTS bsi ({})'.format(cols))
+        con.execute('CREATE TABLE IF NOT EXISTS headers (code TEXT PRIMARY KEY, header TEXT)')
+        con.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)')
+        for f in MIRROR_INDEXED:
+            code = get_bsi_name(f)
+            con.execute('CREATE INDEX IF NOT EXISTS "idx_{}" ON bsi ("{}")'.format(code, code))
+        con.commit()
+
+    def get_state(self, key, default=None):
+        row = self.connect().execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return(default if row is None else row[0])
+
+    def set_state(self, key, value):
+        self.connect().execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (key, str(value)))
+
+    # Replace the rows of the families (or orders with no family) in df, a frame with BSI code columns
+    def replace_rows(self, df, headers):
+        con = self.connect()
+        fam = get_bsi_name('Phenotips Family ID')
+        order = get_bsi_name('CRIS Order #')
+
+        fam_ids = [x for x in df[fam].dropna().unique().tolist() if x != '']
+        no_fam = df[df[fam].isna() | (df[fam] == '')]
+        self.delete_rows(fam, fam_ids)
+        self.delete_rows(order, no_fam[order].dropna().unique().tolist())
+
+        cols = ", ".join(['"{}"'.format(c) for c in self.codes])
+        con.executemany('INSERT INTO bsi ({}) VALUES ({})'.format(cols, ",".join("?" * len(self.codes))),
+                        df[self.codes].itertuples(index=False, name=None))
+        con.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?)', headers.items())
+
+    # Delete the rows whose code column holds one of ids
+    def delete_rows(self, code, ids):
+        con = self.connect()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            con.execute('DELETE FROM bsi WHERE "{}" IN ({})'.format(code, ",".join("?" * len(chunk))), chunk)
+
+    # Pull a report of the mirrored fields (default all of them) from BSI, columns named by code
+    def pull(self, url, session, theIDs, search_field, islike=False, fields=None):
+        fields = self.field_names() if fields is None else fields
+        codes = [get_bsi_name(f) for f in fields]
+        if search_field is None:
+            chunks = [[]]
+        else:
+            chunks = chunk_ids(theIDs)
+        df = fetch_query(url, session, fields, chunks, search_field, True, islike, QUERY_WORKERS)
+        headers = dict(zip(codes, df.columns.tolist()))
+        df.columns = codes
+        return(df, headers)
+
+    # One display name per mirrored code, in code order
+    def field_names(self):
+        return([BSI_NAMES[code] for code in self.codes])
+
+    # Bring the mirror up to date: refresh the families whose volatile fields changed,
+    #   or pull everything when full, on the first sync or once the last full pull is MIRROR_FULL_DAYS old
+    def sync(self, url, session, full=False, log=None):
+        self.create()
+        con = self.connect()
+        started = datetime.datetime.now()
+        last_full = self.get_state('last_full')
+        if last_full is not None and started - datetime.datetime.strptime(last_full, '%Y-%m-%d %H:%M:%S') >= datetime.timedelta(days=MIRROR_FULL_DAYS):
+            send_update("Last full pull of the BSI mirror was {}, pulling everything again".format(last_full), log)
+            full = True
+
+        if full or last_full is None:
+            send_update("Pulling all {} mirrored fields for the whole study from BSI...".format(len(self.codes)), log)
+            df, headers = self.pull(url, session, [], None)
+            con.execute('DELETE FROM bsi')
+            self.replace_rows(df, headers)
+            self.set_state('last_full', started.strftime('%Y-%m-%d %H:%M:%S'))
+        else:
+            # volatile fields of the whole study, compared row by row with the mirror
+            send_update("Pulling {} volatile fields for the whole study from BSI...".format(len(MIRROR_VOLATILE)), log)
+            codes = [get_bsi_name(f) for f in MIRROR_VOLATILE]
+            remote, headers = self.pull(url, session, [], None, fields=MIRROR_VOLATILE)
+            local = pd.read_sql_query('SELECT {} FROM bsi'.format(", ".join(['"{}"'.format(c) for c in codes])), con)
+
+            def as_rows(df):
+                return(set(df.astype(object).where(df.notna(), '').astype(str).itertuples(index=False, name=None)))
+            touched = pd.DataFrame(list(as_rows(remote) ^ as_rows(local)), columns=codes)
+
+            fam = get_bsi_name('Phenotips Family ID')
+            order = get_bsi_name('CRIS Order #')
+            fam_ids = [x for x in touched[fam].unique().tolist() if x != '']
+            order_ids = [x for x in touched.loc[touched[fam] == '', order].unique().tolist() if x != '']
+            send_update("Refreshing {} families and {} orders without a family from BSI...".format(len(fam_ids), len(order_ids)), log)
+
+            # orders that moved family or went away leave their old rows behind, drop them first
+            self.delete_rows(order, [x for x in touched[order].unique().tolist() if x != ''])
+            pulled = []
+            if len(fam_ids) > 0:
+                df, headers = self.pull(url, session, fam_ids, 'Phenotips Family ID')
+                pulled.append(df)
+            if len(order_ids) > 0:
+                df, headers = self.pull(url, session, order_ids, 'CRIS Order #')
+                pulled.append(df)
+            if len(pulled) > 0:
+                self.replace_rows(pd.concat(pulled, ignore_index=True).drop_duplicates(), headers)
+
+        self.set_state('last_sync', started.strftime('%Y-%m-%d %H:%M:%S'))
+        con.commit()
+
+        nrows = con.execute('SELECT COUNT(*) FROM bsi').fetchone()[0]
+        send_update("BSI mirror {} holds {} rows, synced {}".format(self.path, nrows, self.get_state('last_sync')), log)
+
+    # Answer a bsi_query from the mirror, same columns as the live report
+    #   filters are criteria from filter_criteria
+    def query(self, fields, theIDs, search_field, isequal=True, islike=False, filters=None):
+        if not self.exists():
+            err_out("Error: BSI mirror {} does not exist, run 'ncbr_bsi.py sync' first.".format(self.path))
+
+        codes = [get_bsi_name(f) for f in fields]
+        searched = [f[0] for f in (filters or [])] + ([search_field] if search_field is not None else [])
+        missing = [f for f in fields + searched if get_bsi_name(f) not in self.codes]
+        if len(missing) > 0:
+            err_out("Error: fields {} are not kept in the BSI mirror.".format(missing))
+
+        headers = dict(self.connect().execute('SELECT code, header FROM headers').fetchall())
+        sql = 'SELECT {} FROM bsi'.format(", ".join(['"{}"'.format(c) for c in codes]))
+        clauses = []
+        params = []
+        for criterion in [(search_field, theIDs, isequal, islike)] + list(filters or []):
+            clause, values = mirror_criteria(*criterion)
+            if clause != '':
+                clauses.append(clause)
+                params.extend(values)
+        where = '' if len(clauses) == 0 else ' WHERE ' + ' AND '.join(clauses)
+        df = pd.read_sql_query(sql + where, self.connect(), params=params)
+        df.columns = [headers.get(c, c) for c in codes]
+        return(type_report_columns(df))
+
+# Translate a bsi_query criterion into an SQL condition and its parameters
+#   "*" in an ID is a wildcard, like BSI; a like search matches anywhere in the value
+def mirror_criteria(search_field, theIDs, isequal, islike):
+    if search_field is None:
+        return('', [])
+
+    col = '"{}"'.format(get_bsi_name(search_field))
+    terms = []
+    params = []
+    for x in theIDs:
+        x = str(x)
+        if islike:
+            terms.append(col + " LIKE ?")
+            params.append('%' + x.replace('*', '%') + '%')
+        elif '*' in x:
+            terms.append(col + " LIKE ?")
+            params.append(x.replace('*', '%'))
+        else:
+            terms.append(col + " = ?")
+            params.append(x)
+
+    if len(terms) == 0:
+        clause = '0'
+    else:
+        clause = "(" + " OR ".join(terms) + ")"
+    if not isequal:
+        clause = "(NOT " + clause + " OR " + col + " IS NULL)"
+    return(clause, params)
+
+_bsi_mirror = None
+
+# Answer all later bsi_query calls from the mirror at path
+def use_bsi_mirror(path=MIRROR_DEFAULT):
+    global _bsi_mirror
+    _bsi_mirror = BSIMirror(os.path.expanduser(path))
+    if not _bsi_mirror.exists():
+        err_out("Error: BSI mirror {} does not exist, run 'ncbr_bsi.py sync' first.".format(path))
+
+# Return the mirror in use, or None when queries go to BSI
+def get_bsi_mirror():
+    return(_bsi_mirror)
+
+
+####################################
+#
+# Main: maintain the local BSI mirror
+#
+####################################
+def main():
+    parseStr = 'Maintains a local mirror of the NIAID Centralized Sequencing sample and subject fields in BSI.\n\n\
+    Usage:\n\
+        ncbr_bsi.py sync [-m mirror.sqlite] [--full]\n\n\
+    Example:\n\
+        ncbr_bsi.py sync\n\
+        csi_to_gris_hg38.py -b 30 --mirror\n'
+
+    parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    sync_parser = subparsers.add_parser('sync', help='Create or refresh the local BSI mirror')
+    sync_parser.add_argument('-m', '--mirror', required=False, type=str, default=MIRROR_DEFAULT,
+                             help='Mirror file (default: {})'.format(MIRROR_DEFAULT))
+    sync_parser.add_argument('--full', required=False, action='store_true', default=False,
+                             help='Re-pull the whole study instead of only what changed')
+    sync_parser.add_argument('--bsi-url', required=False, type=str, default=None,
+                             help='Base URL of the BSI REST API (default: $BSI_URL or {})'.format(BSI_URL))
+
+    args = parser.parse_args()
+    if args.command != 'sync':
+        parser.print_help()
+        sys.exit(1)
+    if args.bsi_url is not None:
+        set_bsi_url(args.bsi_url)
+
+    cnf, url_session, url_reports, curl_get = return_bsi_info()
+    user, pw = read_conf(cnf)
+    session = get_bsi_session(url_session, user, pw)
+
+    mirror = BSIMirror(os.path.expanduser(args.mirror))
+    mirror.sync(url_reports, session, args.full)
+    report_bsi_stats()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ncbr_cytoband.py
+    Cytoband lookup for any script that annotates genomic intervals
+
+    The UCSC cytoBand table is indexed once per process: bands are sorted by
+    start within each chromosome, and whole arrays of positions are assigned
+    their band with one searchsorted per chromosome.  A position's band is
+    the last band of its chromosome starting at or before it, and an
+    interval is labeled from its start band to its end band, e.g.
+    chr1p36.33-p35.
+
+    Each reference has a text table in CYTOBAND_FILES and a binary form of
+    the index next to it (cytoBand.npz for cytoBand.txt), which is read
+    instead of the text whenever it is at least as new.  Build the binary
+    form after installing or updating a table:
+        ncbr_cytoband.py build hg19 hg38
+"""
+
+__author__ = 'Susan Huse'
+__version__ = '1.0.0'
+__copyright__ = 'none'
+
+import sys
+import os
+import argparse
+from argparse import RawTextHelpFormatter
+import pandas as pd
+import numpy as np
+from ncbr_huse import send_update, err_out
+
+# UCSC cytoBand tables of each reference, chrom, start, end, band, stain
+CYTOBAND_FILES = {'hg19': '/hpcdata/dir/SCRIPTS/cytoBand.txt',
+                  'hg38': '/hpcdata/dir/SCRIPTS/cytoBand_hg38.txt'}
+CYTOBAND_COLUMNS = ['chrom', 'start', 'end', 'cytoband', 'geistain']
+# Label of positions without a band
+NO_BAND = 'unk'
+
+# Indexes already loaded by this process, by file name
+_loaded = dict()
+
+####################################
+#
+# Cytoband index
+#
+####################################
+class CytobandIndex(object):
+    """Bands of one reference sorted by start within each chromosome.
+
+    chroms, starts, ends, names and stains hold the bands in that order,
+    and spans[chrom] the slice of a chromosome's bands.  When bands of a
+    chromosome overlap, a position takes the band listed last in the
+    original table among those starting at or before it; picks holds that
+    band for each sorted position.
+    """
+
+    def __init__(self, chroms, starts, ends, names, stains, picks):
+        self.chroms = chroms
+        self.starts = starts
+        self.ends = ends
+        self.names = names
+        self.stains = stains
+        self.picks = picks
+        self.spans = dict()
+        if len(chroms) == 0:
+            return
+        bounds = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        for lo, hi in zip(np.append(0, bounds), np.append(bounds, len(chroms))):
+            self.spans[str(chroms[lo])] = (lo, hi)
+
+    # Index of a cytoBand table, in the table's own order
+    @classmethod
+    def from_table(cls, table):
+        chroms = table['chrom'].astype(str).to_numpy(dtype=str)
+        starts = table['start'].to_numpy(dtype=np.int64)
+        chrom_codes, chrom_names = pd.factorize(chroms)
+        order = np.lexsort((starts, chrom_codes))
+
+        # band picked at each sorted band: the latest table row so far within its chromosome, by its sorted position
+        latest = pd.Series(order).groupby(chrom_codes[order]).cummax().to_numpy(dtype=np.int64)
+        picks = np.argsort(order)[latest]
+
+        return(cls(chroms[order], starts[order], table['end'].to_numpy(dtype=np.int64)[order],
+                   table['cytoband'].astype(str).to_numpy(dtype=str)[order], table['geistain'].astype(str).to_numpy(dtype=str)[order], picks))
+
+    # Index from a binary form written by save()
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname, allow_pickle=False) as data:
+            return(cls(data['chroms'], data['starts'], data['ends'], data['names'], data['stains'], data['picks']))
+
+    # Writes the binary form
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            np.savez_compressed(f, chroms=self.chroms, starts=self.starts, ends=self.ends,
+                                names=self.names, stains=self.stains, picks=self.picks)
+
+    # Position of the band of each (chrom, position) in the sorted arrays, -1 where there is none
+    #   chroms are named as in the table (chr1, ...), positions may be missing
+    def band_rows(self, chroms, positions):
+        chroms = np.asarray(chroms, dtype=object).astype(str)
+        positions = pd.to_numeric(pd.Series(positions), errors='coerce').to_numpy(dtype=float)
+        found = np.full(len(chroms), -1, dtype=np.int64)
+
+        codes, names = pd.factorize(chroms)
+        for code, chrom in enumerate(names):
+            if chrom not in self.spans:
+                continue
+            lo, hi = self.spans[chrom]
+            rows = np.flatnonzero(codes == code)
+            hit = np.searchsorted(self.starts[lo:hi], positions[rows], side='right')
+            ok = (hit > 0) & ~np.isnan(positions[rows])
+            found[rows[ok]] = self.picks[lo + hit[ok] - 1]
+        return(found)
+
+    # Band name of each position (e.g. p36.33), None where there is none
+    def bands(self, chroms, positions):
+        found = self.band_rows(chroms, positions)
+        names = self.names[np.maximum(found, 0)].astype(object)
+        names[found < 0] = None
+        return(names)
+
+    # Label of each position or interval: chr1p36.33, or chr1p36.33-p35 when the end is in another band
+    #   NO_BAND where the start has no band
+    def label(self, chroms, starts, ends=None):
+        chroms = np.asarray(chroms, dtype=object).astype(str)
+        start_bands = self.bands(chroms, starts)
+        labels = np.full(len(chroms), NO_BAND, dtype=object)
+        known = np.array([b is not None for b in start_bands], dtype=bool)
+        labels[known] = [c + b for c, b in zip(chroms[known], start_bands[known])]
+
+        if ends is not None:
+            end_bands = self.bands(chroms, ends)
+            spanning = known & np.array([e is not None for e in end_bands], dtype=bool) & (end_bands != start_bands)
+            labels[spanning] = [l + '-' + e for l, e in zip(labels[spanning], end_bands[spanning])]
+        return(labels)
+
+# Binary form of a cytoBand text table
+def binary_fname(fname):
+    return(os.path.splitext(fname)[0] + '.npz')
+
+# Cytoband index of a reference (hg19, hg38) or a cytoBand file, loaded once per process
+#   the binary form is used when it is at least as new as the text table
+def load_cytobands(reference='hg19'):
+    fname = CYTOBAND_FILES.get(reference, reference)
+    if fname in _loaded:
+        return(_loaded[fname])
+
+    binary = fname if fname.endswith('.npz') else binary_fname(fname)
+    if os.path.isfile(binary) and (not os.path.isfile(fname) or os.path.getmtime(binary) >= os.path.getmtime(fname)):
+        index = CytobandIndex.load(binary)
+    elif os.path.isfile(fname):
+        index = CytobandIndex.from_table(read_cytoband_table(fname))
+    else:
+        err_out("Error: cytoband table {} not found".format(fname))
+
+    _loaded[fname] = index
+    return(index)
+
+# UCSC cytoBand text table
+def read_cytoband_table(fname):
+    return(pd.read_csv(fname, delimiter='\t', names=CYTOBAND_COLUMNS))
+
+def main():
+    #
+    # Usage statement
+    #
+    parseStr = 'Builds the binary cytoband index read by the CNV scripts from UCSC cytoBand tables.\n\n\
+    References are {}, or give cytoBand text files; each index is written\n\
+    next to its table as <table>.npz unless -o is given.\n\n\
+    Usage:\n\
+        ncbr_cytoband.py build reference [reference ...] [-o output.npz]\n\n\
+    Example:\n\
+        ncbr_cytoband.py build hg19 hg38\n\
+        ncbr_cytoband.py build cytoBand.txt -o cytoBand.npz\n'.format(', '.join(CYTOBAND_FILES.keys()))
+
+    parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='Write the binary index of cytoBand tables')
+    build_parser.add_argument('references', type=str, nargs='+', help='Reference names or cytoBand text files')
+    build_parser.add_argument('-o', '--output', required=False, type=str, default=None,
+                              help='Output file, only with a single reference (default: next to the table)')
+
+    args = parser.parse_args()
+    if args.command != 'build':
+        parser.print_help()
+        sys.exit(1)
+    if args.output is not None and len(args.references) > 1:
+        err_out("Error: -o takes a single reference, {} given".format(len(args.references)))
+
+    for reference in args.references:
+        fname = CYTOBAND_FILES.get(reference, reference)
+        if not os.path.isfile(fname):
+            err_out("Error: cytoband table {} not found".format(fname))
+        index = CytobandIndex.from_table(read_cytoband_table(fname))
+        outfname = args.output if args.output is not None else binary_fname(fname)
+        index.save(outfname)
+        send_update("{} bands on {} chromosomes from {} written to {}".format(len(index.names), len(index.spans), fname, outfname))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1834 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ncbr_gris.py
+    Reconciliation engine shared by the GRIS hand-off scripts
+    (csi_to_gris.py, csi_to_gris_hg38.py, csi_to_gris_hgsc.py and
+    generate_seqr_ped.py).
+
+    load_batch() logs on to BSI once and pulls everything a released batch
+    needs in a single load: the orders sent with the batch, the orders the
+    vendor released, every member of their families and, when asked for,
+    every sample received in any batch.  The frames are kept on a
+    BatchModel, and the masterkey, seqr ped, genrptlinks, tracking summary,
+    cumulative ped and BAM links are all rendered from that model without
+    going back to BSI.  link_bams() finds earlier samples' BAMs through a
+    BamIndex of the data trees and verifies them before linking, and a
+    SampleHistory of every earlier masterkey picks out the samples moved
+    into a batch so their data is linked rather than processed again.
+
+    The CIDR front-ends and generate_seqr_ped.py take a batch range or list
+    as well as a single batch (-b 1-40, -b 1,3,5-7).  load_batches() pulls the whole range over one
+    session in one load and splits it into a BatchModel per batch, and the
+    per-batch files are written by a pool of run_batches() threads.  Prompts
+    are answered 'y' for a range, as the old "yes |" rerun loops did.
+
+    The cumulative ped is kept up to date incrementally by
+    update_cumulative_ped(): the family and parent links of every received
+    sample are compared with it, and only the families whose members or
+    links changed (or that moved samples left) are pulled and rewritten.
+
+    Each ped writing run records a fingerprint of every batch's source rows
+    and files in seqr_peds.json; refresh_outputs() hard links a batch's ped
+    files forward from an earlier run (--since) when neither has changed.
+
+    The CIDR rawdata readers (Subject Sample Mapping, Master Sample Key and
+    Pedigree files) live here as well, so each script is a thin front-end.
+"""
+
+__author__ = 'Susan Huse'
+__version__ = '1.0.0'
+__copyright__ = 'none'
+
+import sys
+import os
+import re
+import glob
+import fnmatch
+import json
+import shutil
+import hashlib
+import argparse
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from ncbr_huse import send_update, err_out, pause_for_input, test_file
+from ncbr_bsi import read_conf, get_bsi_session, get_bsi_name, bsi_query, bsi_query_many, return_bsi_info, \
+    BSI_COLUMNS, HAVE_PARQUET
+
+####################################
+#
+# Fields and columns
+#
+####################################
+# Order statuses that are never counted as sent or sequenced
+DROPPED_STATUSES = ['Cancel', 'Auto Complete']
+
+# Orders sent with a batch and orders released by the vendor
+SENT_FIELDS = ['CRIS Order #', 'Phenotips ID', 'Phenotips Family ID', 'Batch Sent', 'Batch Received',
+               'CRIS Order Status', 'Active Status']
+RECEIVED_FIELDS = ['CRIS Order #', 'Phenotips ID', 'Phenotips Family ID', 'Batch Sent', 'Batch Received',
+                   'CRIS Order Status']
+
+# Every field any output needs about a family member
+FAMILY_FIELDS = ['CRIS Order #', 'Batch Sent', 'Batch Received', 'Phenotips Family ID', 'Phenotips ID',
+                 'Father PhenotipsId', 'Mother PhenotipsId', 'Gender', 'Affected Status', 'Exome ID', 'MRN',
+                 'CRIS Order Status', 'Active Status', 'DLM LIS Number', 'Date of Enrollment', 'Vendor', 'Archive']
+
+# Every sample received in any batch, for the cumulative ped
+CUMULATIVE_FIELDS = ['CRIS Order #', 'Phenotips ID', 'Phenotips Family ID', 'Batch Sent', 'Batch Received',
+                     'Father PhenotipsId', 'Mother PhenotipsId', 'Gender', 'CRIS Order Status', 'Affected Status']
+
+# Output columns
+TRACKING_COLUMNS = ['CRIS_Order#', 'Phenotips_ID', 'Phenotips_Family_ID', 'Batch_Sent', 'Batch_Received',
+                    'CRIS_Order_Status']
+RELEASE_SENT_COLUMNS = ['Phenotips_ID', 'CRIS_Order#', 'Batch_Sent', 'Batch_Received', 'CRIS_Order_Status',
+                        'Active_Status']
+FAMILY_COLUMNS = ['CRIS_Order#', 'Phenotips_ID', 'Phenotips_Family_ID', 'Batch_Sent', 'Batch_Received']
+MASTER_COLUMNS = ['CRIS_Order#', 'Phenotips_ID', 'Exome_ID', 'Batch_Sent', 'Batch_Received']
+GENRPTLINKS_COLUMNS = ['MRN', 'CRIS_Order#', 'Phenotips_Family_ID', 'Phenotips_ID']
+PED_COLUMNS = ['Phenotips_Family_ID', 'Phenotips_ID', 'Father_Phenotips_ID', 'Mother_Phenotips_ID', 'Gender',
+               'Affected']
+
+# Sample tracking group labels, see BatchModel.classify()
+#   sent rows are sent_and_received or sent_not_received, received rows sent_and_received or received_from_other,
+#   family rows released (with this batch), sequenced_family, unsequenced_family or excluded (dropped duplicates)
+TRACKING_GROUPS = ['sent_and_received', 'sent_not_received', 'received_from_other', 'released',
+                   'sequenced_family', 'unsequenced_family', 'excluded']
+
+# Data trees of the CIDR batches (renamed to Phenotips IDs) and of the HGSC batches
+CIDR_DATA_RENAMED = '/hpcdata/dir/CIDR_DATA_RENAMED'
+CSI_DATA_PROCESSED = '/hpcdata/dir/CSI_DATA_PROCESSED'
+
+####################################
+#
+# Batch ranges
+#
+####################################
+# Batches left out of a batch range, the batch-by-batch rerun scripts always skipped these
+SKIPPED_BATCHES = [8]
+# Threads reading inputs and writing outputs for a batch range
+GRIS_WORKERS = 8
+# Answer every confirmation prompt with 'y', set for batch ranges
+ASSUME_YES = False
+# Never prompt: set by --non-interactive once every batch has passed validate_batches()
+NON_INTERACTIVE = False
+
+# argparse type for -b: a batch, a range "1-40" or a list "1,3,5-7", returns the sorted batches
+#   ranges leave out SKIPPED_BATCHES, a batch named on its own is always kept
+def parse_batches(text):
+    batches = []
+    for part in str(text).split(','):
+        part = part.strip()
+        m = re.match(r'^(\d+)-(\d+)$', part)
+        if m is not None:
+            first, last = int(m.group(1)), int(m.group(2))
+            if first > last:
+                raise argparse.ArgumentTypeError("batch range {} runs backwards".format(part))
+            batches.extend([b for b in range(first, last + 1) if b not in SKIPPED_BATCHES])
+        elif re.match(r'^\d+$', part):
+            batches.append(int(part))
+        else:
+            raise argparse.ArgumentTypeError("'{}' is not a batch number or range such as 1-40".format(part))
+    return(sorted(set(batches)))
+
+# Directory for one batch, a {batch} in the path is replaced by the batch number
+#   e.g. /data/NCBR/projects/csi_test_batch/old_peds/BATCH{batch}
+def batch_dir(path, batch):
+    return(path.replace('{batch}', str(batch)))
+
+def set_assume_yes(flag=True):
+    global ASSUME_YES
+    ASSUME_YES = flag
+
+def set_non_interactive(flag=True):
+    global NON_INTERACTIVE
+    NON_INTERACTIVE = flag
+
+# Ask the user to continue (y) or quit (q), or just log the question when ASSUME_YES is set
+#   check names the validation check behind the question; with NON_INTERACTIVE a question about
+#   a failed check exits with that check's code instead of waiting for an answer
+def confirm(txt, log=None, check=None):
+    if NON_INTERACTIVE:
+        if check is not None:
+            send_update(txt + "q (non-interactive)", log)
+            sys.exit(VALIDATION_EXIT_CODES[check])
+        send_update(txt + "y (non-interactive)", log)
+        return('y')
+    if ASSUME_YES:
+        send_update(txt + "y (assumed for a batch range)", log)
+        return('y')
+    return(pause_for_input(txt, 'y', 'q', log))
+
+# Run func(batch) for each batch, on a thread pool when there is more than one
+#   returns {batch: result}; an err_out in any batch ends the run as it would serially
+def run_batches(func, batches, workers=None):
+    if workers is None:
+        workers = GRIS_WORKERS
+
+    if len(batches) <= 1:
+        return(dict([(b, func(b)) for b in batches]))
+    with ThreadPoolExecutor(max_workers=min(max(1, workers), len(batches))) as pool:
+        return(dict(zip(batches, pool.map(func, batches))))
+
+# Label for a list of batches in messages, e.g. "Batches 1-7, 9-40"
+def batches_label(batches):
+    if len(batches) == 1:
+        return("Batch " + str(batches[0]))
+
+    runs = []
+    for b in batches:
+        if len(runs) > 0 and runs[-1][1] == b - 1:
+            runs[-1][1] = b
+        else:
+            runs.append([b, b])
+    return("Batches " + ", ".join([str(x) if x == y else "{}-{}".format(x, y) for x, y in runs]))
+
+# BSI batch name, zero padded below 10
+def batch_name(batch):
+    if batch < 10:
+        return("BATCH0" + str(batch))
+    return("BATCH" + str(batch))
+
+# Batch numbers of a column of batch names as a float array, NaN where there is no BATCHnn name
+def batch_numbers(col):
+    numbers = col.astype(object).str.extract(r'^BATCH(\d+)', expand=False)
+    return(pd.to_numeric(numbers, errors='coerce').to_numpy(dtype=float))
+
+# Rows whose order was canceled or auto completed
+def dropped_orders(df):
+    return(df['CRIS_Order_Status'].str.contains('|'.join(DROPPED_STATUSES), case=False, na=False))
+
+# Rows of df as tab separated text over columns, blanks for missing values
+def row_lines(df, columns):
+    text = df[columns].astype(object)
+    text = text.where(text.notna(), '').astype(str)
+    lines = text[columns[0]]
+    for col in columns[1:]:
+        lines = lines + '\t' + text[col]
+    return(lines)
+
+# Fingerprint each family's rows over columns, returns {family ID: sha1}
+#   rows are compared as text in sorted order, so row order and dtypes do not change a fingerprint
+def family_fingerprints(df, columns, family_column='Phenotips_Family_ID'):
+    lines = row_lines(df, columns)
+
+    prints = dict()
+    for fam, rows in lines.groupby(row_lines(df, [family_column]).values, sort=False):
+        prints[fam] = hashlib.sha1('\n'.join(sorted(rows.tolist())).encode('utf-8')).hexdigest()
+    return(prints)
+
+# sha1 of a file's contents
+def file_sha1(fname):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return(digest.hexdigest())
+
+####################################
+#
+# Rawdata manifest and parsed file cache
+#
+####################################
+# CIDR input files located by create_config: config key, file name patterns in order of preference, description
+RAWDATA_FILES = [('mapping', ['Holland*SubjectSampleMappingFile.csv'], 'Subject Sample Mapping file: "*SubjectSampleMappingFile.csv"'),
+                 ('samplekey', ['Holland*MasterSampleKey*.csv'], 'Master Sample Key file: "*MasterSampleKey.csv"'),
+                 ('pedigree', ['Holland*Pedigree*.csv', 'Holland*Pedigree*.xlsx', 'Holland*Pedigree*.xls'],
+                  'Pedigree file: "*Pedigree*.csv" or "*Pedigree*.xlsx"')]
+
+# Columns each reader needs, every value is parsed as text
+#   the Subject Sample Mapping is read by position, its first two columns are the subject and exome IDs
+RAWDATA_COLUMNS = {'mapping': [0, 1],
+                   'samplekey': ['Subject_ID', 'LIMS_SampleId'],
+                   'pedigree': ['Subject_ID', 'Investigator Column 1', 'Investigator Column 3'],
+                   'hgsc_samplekey': ['INDEX ID', 'COLLABORATOR SAMPLE ID', 'FLOWCELL ID', 'LANE NUM']}
+
+# Default location of the parsed file cache
+RAWDATA_CACHE_DIR = os.path.expanduser('~/.cache/ncbr_gris')
+
+class RawdataCache(object):
+    """Parsed CIDR and HGSC input files, kept as typed frames between runs.
+
+    Every file read is fingerprinted by size, mtime and a sha1 of its
+    contents, and index.json remembers the fingerprint of each path.  While
+    a file's size and mtime still match, its frame is read back without
+    hashing the file again; when they moved, the hash decides.  Frames are
+    stored as Parquet (pickle when pyarrow is not installed) named by the
+    content hash and the reader, so reruns over old_peds and copies of the
+    same file share one entry, and an Excel file is only parsed once.
+    """
+
+    def __init__(self, cache_dir=RAWDATA_CACHE_DIR, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.ext = '.parquet' if HAVE_PARQUET else '.pkl'
+        self.index = None
+        self._lock = threading.Lock()
+
+    def _index_fname(self):
+        return(os.path.join(self.cache_dir, 'index.json'))
+
+    # Fingerprints of the paths read before, loaded once per run
+    def _load_index(self):
+        if self.index is None:
+            try:
+                with open(self._index_fname(), 'r') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = dict()
+        return(self.index)
+
+    # Content hash of a file, from the index while its size and mtime are unchanged
+    def fingerprint(self, path):
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        with self._lock:
+            known = self._load_index().get(path)
+        if known is not None and known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+            return(known['sha1'])
+
+        sha1 = file_sha1(path)
+        with self._lock:
+            self._load_index()[path] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha1': sha1}
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            tmp = self._index_fname() + '.' + str(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self._index_fname())
+        return(sha1)
+
+    # Frame of one input file for a reader, parsed with parse() the first time its contents are seen
+    def read(self, path, kind, parse):
+        if not self.enabled:
+            return(parse())
+
+        spec = hashlib.sha1(json.dumps(RAWDATA_COLUMNS[kind]).encode('utf-8')).hexdigest()[:8]
+        entry = os.path.join(self.cache_dir, '{}-{}-{}{}'.format(self.fingerprint(path), kind, spec, self.ext))
+        if os.path.isfile(entry):
+            try:
+                return(pd.read_parquet(entry) if HAVE_PARQUET else pd.read_pickle(entry))
+            except Exception:
+                pass
+
+        df = parse()
+        tmp = entry + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        if HAVE_PARQUET:
+            df.to_parquet(tmp, index=False)
+        else:
+            df.to_pickle(tmp)
+        os.replace(tmp, entry)
+        return(df)
+
+_rawdata_cache = RawdataCache()
+
+# Replace the parsed file cache settings, e.g. disabled along with the BSI cache by --no-cache;
+#   the BAM index is kept in the same directory, and not kept at all when the cache is disabled
+def configure_rawdata_cache(enabled=True, cache_dir=RAWDATA_CACHE_DIR):
+    global _rawdata_cache
+    _rawdata_cache = RawdataCache(cache_dir, enabled)
+
+# Parse one input file with only the columns its reader needs, csv or Excel
+def parse_rawdata(path, kind):
+    if bool(re.search('.xlsx*$', path)):
+        return(pd.read_excel(path, usecols=RAWDATA_COLUMNS[kind], dtype=str))
+    return(pd.read_csv(path, usecols=RAWDATA_COLUMNS[kind], dtype=str, encoding='utf-8'))
+
+# Read one input file through the parsed file cache
+def read_rawdata(path, kind):
+    return(_rawdata_cache.read(path, kind, lambda: parse_rawdata(path, kind)))
+
+####################################
+#
+# Functions for importing the CIDR rawdata files
+#
+####################################
+# Locate the input files of a rawdata directory, listed once
+#   returns {config key: path} and the descriptions of the inputs that were not found
+def find_rawdata(dir_info):
+    found = dict()
+    missing = []
+    names = os.listdir(dir_info) if os.path.isdir(dir_info) else []
+    for key, patterns, description in RAWDATA_FILES:
+        matches = [f for pattern in patterns for f in fnmatch.filter(names, pattern)]
+        if len(matches) < 1:
+            missing.append(description)
+        else:
+            found[key] = os.path.join(dir_info, matches[0])
+    return(found, missing)
+
+# Create config dictionary of input files
+#   each input is the first match of its patterns
+def create_config(dir_info, batch, log=None):
+    config, missing = find_rawdata(dir_info)
+    if len(missing) > 0:
+        err_out('Error: unable to locate input ' + missing[0] + '\n', log)
+
+    foundfilestext = ""
+    for key in config:
+        foundfilestext += "\t" + key + ": " + config[key] + "\n"
+
+    foundfilestext = "Successfully located {} input files:\n{}\n".format(str(len(config)), foundfilestext)
+
+    # add to the config variables
+    config['rootdir'] = CIDR_DATA_RENAMED
+    config['family_errors'] = 'family_errors.txt'
+
+    # output file names
+    config['tracking'] = 'sample_tracking_summary_batch' + str(batch) + '.txt'
+    config['tracking_records'] = 'sample_tracking_batch' + str(batch) + '.tsv'
+    config['masterkey'] = 'masterkey_batch' + str(batch) + '.txt'
+    config['newpedigree'] = 'seqr_ped_batch' + str(batch) + '.txt'
+    config['batchinfo'] = 'genrptlinks_batch' + str(batch) + '.txt'
+    config['linkscript_fname'] = 'link_bams_batch' + str(batch) + '.sh'
+    config['collaborators'] = 'collaborator_masterkey_batch' + str(batch) + '.txt'
+
+    return(config, foundfilestext)
+
+# Compare indices of two data series, return missing values
+#   pandas Index differences, no Python sets are built
+def compare_keys(x, y):
+    missing_in_x = y.index.unique().difference(x.index.unique()).tolist()
+    missing_in_y = x.index.unique().difference(y.index.unique()).tolist()
+
+    return(missing_in_x, missing_in_y)
+
+# Duplicate IDs of a pedigree ("ped") or manifest file, found two ways
+#   returns (IDs marked duplicate, IDs longer than 9 characters), they should agree for a pedigree
+def duplicate_candidates(df, fformat):
+    if fformat == "ped":
+        # find the duplicate using the comments column with the word "duplicate"
+        dupestr = df[df['Investigator Column 1'].str.contains('Duplicate', case=False, na=False)]['Subject_ID']
+        # find the duplicate because it is the only subject ID > 9 characters
+        dupelen = df.loc[df['Subject_ID'].str.len() > 9]['Subject_ID']
+
+        # removes any collaborator data
+        dupelen = dupelen[dupelen.str.startswith('002')]
+
+    elif fformat == "manifest":
+        # find the duplicate because it is the only subject ID > 9 characters
+        dupestr = df.loc[(df['Subject_ID'].str.len() > 9) & (df['Subject_ID'] != "CONTROL_ID")]['Subject_ID']
+        dupelen = dupestr
+
+    return(dupestr, dupelen)
+
+# Find the duplicate ID from the pedigree file
+def find_the_duplicate(df, fformat, log=None):
+    dupestr, dupelen = duplicate_candidates(df, fformat)
+    if fformat == "ped":
+        # If the two methods aren't the same answer, error out
+        if not dupestr.equals(dupelen):
+            err_out(("Warning: unable to ascertain duplicate sample identifier.\n" + \
+                     "{} was identified in the pedigree file as a duplicate in 'Investigator Column 1',\n" + \
+                     "{} has Subject_ID length > 9 characters.\n" + \
+                     "Exiting").format(dupestr, dupelen), log)
+
+    if dupestr.size > 1:
+        send_update("Warning: found more than one duplicate sample identifier: {}.".format(dupestr.tolist()), log)
+    elif dupestr.size < 1:
+        send_update("Warning: no duplicate sample identifier was found in the {} file.".format(fformat), log)
+        return(None)
+    else:
+        send_update("Duplicate sample identifier: {}".format(dupestr.tolist()), log)
+
+    return(dupestr.tolist())
+
+# Control IDs among the sample mapping identifiers: anything starting NA or HG
+def control_candidates(ids):
+    regexNA = re.compile('^NA')
+    regexHG = re.compile('^HG')
+    ctrl = [i for i in ids if regexNA.match(i)]
+    ctrlHG = [i for i in ids if regexHG.match(i)]
+    ctrl.extend(ctrlHG)
+    return(ctrl)
+
+# Find the control ID from the sample mapping identifiers
+def find_the_control(x, log=None):
+    # search the indices for anything with NA or with HG
+    ctrl = control_candidates(x.index.tolist())
+
+    send_update("Control sample identifier: {}".format(set(ctrl)), log)
+
+    if len(ctrl) != 1:
+        error_text = "\nError: found {} control sample identifier(s), expected only one.\n{}".format(str(len(ctrl)), ctrl)
+        error_text = error_text + '\nPlease enter "y" to continue or "q" to quit.\n'
+        confirm(error_text, log, 'control')
+        ctrl = None
+
+    else:
+        ctrl = ctrl[0]
+
+    return(ctrl)
+
+# Import pedigree information from csv or Excel file
+def import_pedigree(f, log=None):
+    test_file(f, log)
+
+    # import the data
+    # but some are csv and some are excel!
+    if not bool(re.search('.csv$', f)) and not bool(re.search('.xlsx*$', f)):
+        err_out("Error: Confused by pedigree file name {}, expecting *.csv or *.xlsx.\nExiting.".format(f), log)
+    peds = read_rawdata(f, 'pedigree')
+
+    peds = peds[peds['Subject_ID'] != ""]
+
+    ## Each set has a sequencing duplicate that should be removed
+    theDupe = find_the_duplicate(peds, "ped", log)
+
+    # create a series of batch information with Subject as the index
+    peds = peds[['Subject_ID', 'Investigator Column 3']]
+    peds = peds[peds.Subject_ID.notnull()].set_index('Subject_ID')
+    peds = peds['Investigator Column 3'].str.replace("_.*$", "", regex=True)
+
+    if theDupe != None:
+        peds = peds.drop(theDupe, errors='ignore')
+
+    return(peds, theDupe)
+
+# Import sample mapping information from csv file
+#   collaborator IDs that don't match the usual format are written to collab_fname, unless it is None
+def import_samplemapping(f, dupe=None, findControl=True, collab_fname=None, log=None):
+    test_file(f, log)
+    collaborators = None
+
+    # import and create series with index
+    mapping = read_rawdata(f, 'mapping')
+    mapping.columns.values[0] = "Subject_ID"
+    mapping.columns.values[1] = "Exome_ID"
+
+    # Export collaborator IDs that don't match usual format to another masterkey file
+    if collab_fname is not None:
+        collaborators = mapping[~mapping['Subject_ID'].str.startswith("002")]
+        collaborators = collaborators[~collaborators['Subject_ID'].str.contains("NA12878")]
+        if not collaborators.empty:
+            collaborators = collaborators.drop(['SAMPLE_SOURCE', 'SOURCE_SAMPLE_ID'], axis=1, errors='ignore')
+            collaborators.to_csv(collab_fname, sep='\t', header=True, index=False)
+
+    mapping = mapping.set_index('Subject_ID')['Exome_ID']
+
+    # find the Control, and then remove it and the dupe
+    # Will read old ones too and you don't want to change the control
+    if findControl:
+        ctrl = find_the_control(mapping, log)
+        if ctrl is not None:
+            mapping = mapping.drop([ctrl])
+    else:
+        ctrl = None
+
+    if dupe != None:
+        mapping = mapping.drop(dupe, errors='ignore') #if it isn't there, don't worry
+
+    return(mapping, ctrl, collaborators)
+
+# Import sample key information from csv file, without the duplicate and control
+def import_samplekey(f, dupe=None, ctrl=None, log=None):
+    test_file(f, log)
+
+    # import and convert to series
+    samplekey = read_rawdata(f, 'samplekey')
+    samplekey = samplekey.set_index('Subject_ID')
+    samplekey = samplekey['LIMS_SampleId']
+
+    # remove the duplicate and control
+    if dupe != None:
+        samplekey = samplekey.drop(dupe)
+    if ctrl != None:
+        samplekey = samplekey.drop([ctrl])
+
+    return(samplekey)
+
+####################################
+#
+# Input validation for unattended runs
+#
+####################################
+# Exit code of a --non-interactive run for each failed check, in the order they are reported;
+# 1 is still any other error and 2 a command line error
+VALIDATION_EXIT_CODES = {'files': 3, 'control': 4, 'duplicate': 5, 'order_ids': 6}
+VALIDATION_REPORT = 'gris_validation.json'
+
+# Add --non-interactive and --validation-report to a CIDR front-end's argument parser
+def add_validation_args(parser):
+    codes = ', '.join(["{} ({})".format(code, check) for check, code in VALIDATION_EXIT_CODES.items()])
+    parser.add_argument('--non-interactive', required=False, action='store_true', default=False,
+                        help='Check every batch\'s inputs first and never prompt, safe for Snakemake and cron;\n' +
+                             'a failed check exits with ' + codes)
+    parser.add_argument('--validation-report', required=False, type=str, default=VALIDATION_REPORT,
+                        help='JSON validation report written by --non-interactive (default: {})'.format(VALIDATION_REPORT))
+
+# Check one batch's rawdata without prompting: file discovery, a single control, the duplicate
+# (pedigree runs only) and matching order IDs across the files; returns a list of check results
+#   {'batch', 'check', 'status': ok, warning or failed, 'message', 'details'}
+def validate_inputs(batch, dir_info, pedigree=True):
+    results = []
+    def record(check, status, message, details=None):
+        results.append({'batch': batch, 'check': check, 'status': status, 'message': message,
+                        'details': details if details is not None else dict()})
+
+    found, missing = find_rawdata(dir_info)
+    if len(missing) > 0:
+        record('files', 'failed', 'unable to locate input ' + ', '.join(missing), {'directory': dir_info, 'found': found})
+        return(results)
+    record('files', 'ok', 'found every input file', {'directory': dir_info, 'found': found})
+
+    # the sequencing duplicate, from the pedigree
+    dupe = []
+    peds = None
+    if pedigree:
+        peds = read_rawdata(found['pedigree'], 'pedigree')
+        peds = peds[peds['Subject_ID'] != ""]
+        dupestr, dupelen = duplicate_candidates(peds, "ped")
+        details = {'marked_duplicate': dupestr.tolist(), 'long_subject_ids': dupelen.tolist()}
+        if not dupestr.equals(dupelen):
+            record('duplicate', 'failed', 'duplicate marked in Investigator Column 1 is not the long Subject_ID', details)
+        elif dupestr.size > 1:
+            record('duplicate', 'failed', 'found more than one duplicate sample identifier', details)
+        elif dupestr.size < 1:
+            record('duplicate', 'warning', 'no duplicate sample identifier was found in the pedigree file', details)
+        else:
+            record('duplicate', 'ok', 'duplicate sample identifier ' + dupestr.iloc[0], details)
+        dupe = dupestr.tolist()
+        peds = peds[peds['Subject_ID'].notnull()].set_index('Subject_ID')
+
+    # the control, from the sample mapping
+    mapping = read_rawdata(found['mapping'], 'mapping')
+    mapping = mapping.set_index(mapping.columns[0])
+    ctrl = control_candidates(mapping.index.dropna().tolist())
+    if len(ctrl) != 1:
+        record('control', 'failed', 'found {} control sample identifier(s), expected only one'.format(len(ctrl)), {'controls': ctrl})
+    else:
+        record('control', 'ok', 'control sample identifier ' + ctrl[0], {'controls': ctrl})
+
+    # the same order IDs in every file, without the duplicate and control
+    samplekey = read_rawdata(found['samplekey'], 'samplekey').set_index('Subject_ID')
+    samplekey = samplekey.drop(dupe + ctrl, errors='ignore')
+    mapping = mapping.drop(dupe + ctrl, errors='ignore')
+    details = dict()
+    mapping_not_key, key_not_mapping = compare_keys(samplekey, mapping)
+    details['mapping_not_samplekey'] = mapping_not_key
+    details['samplekey_not_mapping'] = key_not_mapping
+    if peds is not None:
+        ped_not_key, key_not_ped = compare_keys(samplekey, peds.drop(dupe, errors='ignore'))
+        details['pedigree_not_samplekey'] = ped_not_key
+        details['samplekey_not_pedigree'] = key_not_ped
+    if sum([len(x) for x in details.values()]) > 0:
+        record('order_ids', 'failed', 'Subject_IDs in the input files are inconsistent', details)
+    else:
+        record('order_ids', 'ok', 'Subject_IDs in the input files are consistent', details)
+    return(results)
+
+# Exit code for a set of check results, the code of the first failed check in VALIDATION_EXIT_CODES order
+def validation_exit_code(results):
+    failed = set([r['check'] for r in results if r['status'] == 'failed'])
+    for check, code in VALIDATION_EXIT_CODES.items():
+        if check in failed:
+            return(code)
+    return(0)
+
+# Validate every batch up front for a --non-interactive run and write the JSON report;
+# exits with the check's code if any batch failed, otherwise turns off every prompt
+def validate_batches(batches, dir_info, pedigree=True, fname=VALIDATION_REPORT, workers=None, log=None):
+    send_update("\nValidating the inputs of {}...".format(batches_label(batches)), log)
+    checks = run_batches(lambda b: validate_inputs(b, batch_dir(dir_info, b), pedigree), batches, workers)
+    results = [r for b in batches for r in checks[b]]
+    code = validation_exit_code(results)
+
+    with open(fname, 'w') as f:
+        json.dump({'created': str(datetime.datetime.now()), 'batches': batches, 'exit_code': code,
+                   'ok': code == 0, 'checks': results}, f, indent=1, default=str)
+
+    for r in results:
+        if r['status'] != 'ok':
+            send_update("Batch {} {} {}: {}".format(r['batch'], r['check'], r['status'], r['message']), log)
+    if code != 0:
+        send_update("Validation failed, see {}".format(fname), log)
+        sys.exit(code)
+
+    send_update("Every input passed validation, see {}".format(fname), log)
+    set_non_interactive(True)
+    return(results)
+
+####################################
+#
+# Sample registry
+#
+####################################
+# Identity columns a SampleRegistry indexes, by the name used to look them up
+REGISTRY_COLUMNS = {'order': 'CRIS_Order#',
+                    'phenotips': 'Phenotips_ID',
+                    'exome': 'Exome_ID',
+                    'family': 'Phenotips_Family_ID',
+                    'batch': 'Batch_Received'}
+
+class SampleRegistry(object):
+    """Sample rows from BSI or a masterkey, indexed on every identity column.
+
+    rows     the sample rows, renumbered from 0
+    keys     {kind: pd.Index of the distinct values of that column}, pandas
+             keeps the hash table of an Index once it is built, so every
+             membership test after the first costs one probe per value
+    groups   {kind: {value: row positions}}, for single ID and family lookups
+
+    Kinds are the keys of REGISTRY_COLUMNS, each is indexed the first time it
+    is asked for.  Kinds whose column is not in the rows cannot be asked for.
+    """
+
+    def __init__(self, df):
+        self.rows = df.reset_index(drop=True)
+        self.keys = dict()
+        self.groups = dict()
+
+    # Registry of a masterkey file, older masterkeys name the exome column CIDR_Exome_ID
+    #   batch keeps only that batch's samples: received with it or not given a batch yet
+    @classmethod
+    def from_masterkey(cls, fname, batch=None):
+        df = pd.read_csv(fname, sep='\t', header=0)
+        if 'Exome_ID' not in df.columns and 'CIDR_Exome_ID' in df.columns:
+            df = df.rename(columns={'CIDR_Exome_ID': 'Exome_ID'})
+        if batch is not None:
+            df = df[df['Batch_Received'].isin([batch, '']) | df['Batch_Received'].isna()]
+        return(cls(df))
+
+    # Distinct values of one kind
+    def _keys(self, kind):
+        if kind not in self.keys:
+            col = self.rows[REGISTRY_COLUMNS[kind]].astype(object)
+            self.keys[kind] = pd.Index(pd.unique(col.to_numpy()), dtype=object)
+        return(self.keys[kind])
+
+    # Row positions of each value of one kind
+    def _groups(self, kind):
+        if kind not in self.groups:
+            self.groups[kind] = self.rows.groupby(REGISTRY_COLUMNS[kind], sort=False).indices
+        return(self.groups[kind])
+
+    # Is one ID in the registry
+    def has(self, kind, value):
+        return(value in self._keys(kind))
+
+    # Boolean array, is each of values in the registry
+    def isin(self, kind, values):
+        return(self._keys(kind).get_indexer(pd.Index(np.asarray(values, dtype=object), dtype=object)) >= 0)
+
+    # Distinct IDs of one kind, in the order they first appear
+    def ids(self, kind):
+        return(self._keys(kind).tolist())
+
+    # IDs of one kind found in both this registry and other
+    def shared(self, kind, other):
+        keys = self._keys(kind)
+        return(keys[other.isin(kind, keys)].tolist())
+
+    # Rows of one ID
+    def rows_for(self, kind, value):
+        return(self.rows.iloc[self._groups(kind).get(value, [])])
+
+    # Rows whose kind column is any of values
+    def select(self, kind, values):
+        wanted = pd.Index(pd.unique(np.asarray(values, dtype=object)), dtype=object)
+        return(self.rows[wanted.get_indexer(self.rows[REGISTRY_COLUMNS[kind]].astype(object)) >= 0])
+
+    # Every row of the families of the given IDs
+    def family(self, kind, values):
+        fams = self.select(kind, values)['Phenotips_Family_ID'].dropna()
+        return(self.select('family', fams))
+
+    # Dictionary from one kind to a column, the last row of a repeated ID wins as with dict(zip())
+    def mapping(self, kind, column):
+        return(dict(zip(self.rows[REGISTRY_COLUMNS[kind]].tolist(), self.rows[column].tolist())))
+
+####################################
+#
+# Batch model, loaded from BSI once per run
+#
+####################################
+class BatchModel(object):
+    """Everything BSI knows about one released batch.
+
+    sent          orders sent to the vendor with the batch (and any other
+                  batches in sent_batches), canceled and auto completed
+                  orders left out
+    received      the orders the vendor released with the batch
+    family        every BSI row of the families of the received orders,
+                  the received orders themselves included
+    all_received  every sample received in any batch, None unless the
+                  cumulative ped was asked for
+
+    The sample tracking classification is worked out from these frames the
+    first time an output needs it, see classify().
+    """
+
+    def __init__(self, batch, vendor='CIDR'):
+        self.batch = batch
+        self.batch_name = batch_name(batch)
+        self.batch_label = "Batch " + str(batch)
+        self.vendor = vendor
+        self.sent = None
+        self.received = None
+        self.family = None
+        self.all_received = None
+        self.registries = dict()
+        self.classified = False
+
+    # Sent orders of one batch, by default this one
+    def sent_in(self, name=None):
+        if name is None:
+            name = self.batch_name
+        return(self.sent[self.sent['Batch_Sent'] == name])
+
+    # SampleRegistry of this batch's received or sent orders, built once
+    def registry(self, frame='received'):
+        if frame not in self.registries:
+            self.registries[frame] = SampleRegistry(self.received if frame == 'received' else self.sent_in())
+        return(self.registries[frame])
+
+    # Family rows of the orders released with this batch
+    def received_rows(self):
+        return(self.family[self.registry().isin('order', self.family['CRIS_Order#'])])
+
+    # Active family members of the active, not canceled orders released with this batch
+    #   this is the set of people in the seqr ped and genrptlinks files
+    def ped_family(self):
+        received = self.received_rows()
+        received = received[(received['Active_Status'] != 'Inactive') & ~dropped_orders(received)]
+        received = received[~received['Exome_ID'].str.contains('Auto Complete', case=False, na=False)]
+
+        fams = self.family[self.family['Phenotips_Family_ID'].isin(received['Phenotips_Family_ID'].dropna())]
+        return(fams[fams['Active_Status'] != 'Inactive'])
+
+    # Split the orders into the sample tracking groups in one pass
+    #   every row of the sent, received and family frames gets exactly one TRACKING_GROUPS label,
+    #   kept in sent_groups, received_groups and family_groups, and the report sections are cut from them:
+    #   sent_not_received    sent with this batch, not released with it or any earlier batch
+    #   received_not_sent    released with this batch but sent with another
+    #   sequenced_family     family members released in earlier batches
+    #   unsequenced_family   family members not yet released, as ped rows
+    def classify(self):
+        if self.classified:
+            return()
+        sent = self.sent_in()
+        received = self.received
+        family = self.family
+        received_ids = self.registry('received')
+        sent_ids = self.registry('sent')
+
+        # Batch numbers and order status, parsed once per frame
+        sent_received_num = batch_numbers(sent['Batch_Received'])
+        family_received_num = batch_numbers(family['Batch_Received'])
+        family_dropped = (dropped_orders(family) | family['Exome_ID'].str.contains('Cancel', case=False, na=True)).to_numpy()
+
+        # Sent orders released with this batch or an earlier one
+        has_received = sent['Batch_Received'].notna().to_numpy()
+        released_orders = sent['CRIS_Order#'].to_numpy()[has_received & (sent_received_num <= self.batch)]
+        sent_done = received_ids.isin('order', sent['CRIS_Order#']) | sent['CRIS_Order#'].isin(released_orders).to_numpy()
+        self.sent_groups = pd.Categorical(np.where(sent_done, 'sent_and_received', 'sent_not_received'),
+                                          categories=TRACKING_GROUPS)
+
+        received_sent = sent_ids.isin('order', received['CRIS_Order#'])
+        self.received_groups = pd.Categorical(np.where(received_sent, 'sent_and_received', 'received_from_other'),
+                                              categories=TRACKING_GROUPS)
+
+        # Family members released earlier with an exome and an order that was not dropped, and everyone else
+        # in the family not released with this batch, once per person
+        family_released = received_ids.isin('order', family['CRIS_Order#'])
+        family_sequenced = ~family_released & ~family_dropped & (family_received_num < self.batch)
+        known = family['Phenotips_ID'].isin(family['Phenotips_ID'].to_numpy()[family_sequenced]).to_numpy() | \
+            received_ids.isin('phenotips', family['Phenotips_ID'])
+        family_unsequenced = ~family_released & ~known
+        self.family_groups = pd.Categorical(np.select([family_released, family_sequenced, family_unsequenced],
+                                                      ['released', 'sequenced_family', 'unsequenced_family'], 'excluded'),
+                                            categories=TRACKING_GROUPS)
+
+        self.sent_released = sent[has_received]
+        self.sent_not_received = sent[self.sent_groups == 'sent_not_received']
+        self.received_not_sent = received[self.received_groups == 'received_from_other']
+        self.sequenced_family = family[self.family_groups == 'sequenced_family']
+        self.unsequenced_family = family[self.family_groups == 'unsequenced_family'][PED_COLUMNS].drop_duplicates()
+
+        self.classified = True
+        return()
+
+    # Orders released with this batch plus the previously sequenced family members
+    #   received orders BSI does not have a Batch Received for yet are given this batch
+    def sequenced_rows(self):
+        self.classify()
+        receivedDF = self.received_rows().copy()
+        receivedDF['Batch_Received'] = receivedDF['Batch_Received'].astype(object).fillna(self.batch_name)
+        return(pd.concat([receivedDF, self.sequenced_family]))
+
+# Pull everything a batch needs from BSI over one session
+#   received_ids are searched in received_field, e.g. the CRIS orders of a CIDR sample key,
+#   the DLM LIS numbers of an HGSC sample key or [batch name] in 'Batch Received'
+#   sent_batches are the batches whose sent orders are loaded, default just this one, [] for none
+#   cumulative also loads every sample received in any batch for the cumulative ped
+def load_batch(batch, received_ids, received_field='CRIS Order #', vendor='CIDR', sent_batches=None,
+               cumulative=False, log=None):
+    models = load_batches({batch: received_ids}, received_field, vendor, sent_batches, cumulative, log)
+    return(models[batch])
+
+# Pull everything a range of batches needs from BSI in one load and split it by batch
+#   received_ids is {batch: IDs released with that batch}, sent_batches defaults to every batch;
+#   returns {batch: BatchModel}, the sent orders and cumulative samples are shared by the models
+def load_batches(received_ids, received_field='CRIS Order #', vendor='CIDR', sent_batches=None,
+                 cumulative=False, log=None):
+    batches = sorted(received_ids.keys())
+    if sent_batches is None:
+        sent_batches = batches
+    received_column = BSI_COLUMNS[get_bsi_name(received_field)]
+    received_fields = RECEIVED_FIELDS
+    if received_field not in received_fields:
+        received_fields = received_fields + [received_field]
+
+    all_ids = []
+    for b in batches:
+        all_ids.extend(received_ids[b])
+
+    send_update("\nPulling sample data for {} from BSI...".format(batches_label(batches)), log)
+    cnf, url_session, url_reports, curl_get = return_bsi_info()
+    user, pw = read_conf(cnf)
+    session = get_bsi_session(url_session, user, pw)
+
+    ## Query BSI at once for the orders sent with the batches, the orders released with
+    ## the batches and, for the cumulative ped, the data returned in ANY batch
+    specs = [{'fields': received_fields, 'theIDs': all_ids, 'search_field': received_field}]
+    if len(sent_batches) > 0:
+        specs.append({'fields': SENT_FIELDS, 'theIDs': [batch_name(b) for b in sent_batches],
+                      'search_field': 'Batch Sent',
+                      'filters': [('CRIS Order Status', 'notlike', DROPPED_STATUSES)]})
+    if cumulative:
+        specs.append({'fields': CUMULATIVE_FIELDS, 'theIDs': ['BATCH*'], 'search_field': 'Batch Received',
+                      'isequal': False})
+    frames = bsi_query_many(curl_get, url_reports, session, specs)
+
+    received = frames.pop(0)
+    sent = frames.pop(0) if len(sent_batches) > 0 else None
+    all_received = frames.pop(0) if cumulative else None
+
+    # Pull data for all family members of the released orders
+    fam_ids = received['Phenotips_Family_ID'].dropna().unique()
+    family = bsi_query(curl_get, url_reports, session, FAMILY_FIELDS, fam_ids, 'Phenotips Family ID')
+
+    # Split into one model per batch
+    models = dict()
+    for b in batches:
+        model = BatchModel(b, vendor)
+        model.received = received[received[received_column].isin(received_ids[b])]
+        model.family = family[family['Phenotips_Family_ID'].isin(model.received['Phenotips_Family_ID'].dropna())]
+        model.sent = sent
+        model.all_received = all_received
+        models[b] = model
+
+    send_update("{} order(s) released, {} family row(s)".format(received.shape[0], family.shape[0]), log)
+    return(models)
+
+######################################
+#
+# Functions for writing output files
+#
+######################################
+# Masterkey: orders released with the batch plus previously sequenced family members
+def write_masterkey(model, fname):
+    masterkey = model.sequenced_rows()[MASTER_COLUMNS]
+    masterkey.to_csv(fname, sep='\t', header=True, index=False)
+    return(masterkey)
+
+# SEQR pedigree of the active members of the released families
+#   Mother 00 (unknown female in BSI) is already 0 and Gender is 1/2, see ncbr_bsi.BSI_SCHEMA
+def seqr_ped(model):
+    ped = model.ped_family()[PED_COLUMNS]
+
+    # fill in missing values for Mother and Father
+    ped = ped.fillna({'Mother_Phenotips_ID': '0', 'Father_Phenotips_ID': '0'})
+    return(ped.drop_duplicates())
+
+def write_seqr_ped(model, fname):
+    ped = seqr_ped(model)
+    ped.to_csv(fname, sep='\t', header=False, index=False)
+    return(ped)
+
+# Report links of the active members of the released families
+def write_genrptlinks(model, fname):
+    genrptlinks = model.ped_family()[GENRPTLINKS_COLUMNS]
+    genrptlinks.to_csv(fname, sep='\t', header=False, index=False)
+    return(genrptlinks)
+
+# Create Sample Tracking file (old README file) from the tracking classification
+def write_tracking(model, fname):
+    model.classify()
+    batch_label = model.batch_label
+    vendor = model.vendor
+    sent = model.sent_in()
+
+    # Header
+    stars = "******************************************"
+    trackingtxt = "\n".join([stars, "*", "* Notes for samples released with " + batch_label, "*", stars, "", ""])
+
+    # Sent
+    trackingtxt += "Total number of samples sent to {} with {}: {}\n\n".format(vendor, batch_label, str(sent.shape[0]))
+
+    # Received
+    trackingtxt += "Total number of samples released from {} with {}: {}\n\n".format(vendor, batch_label, str(model.received.shape[0]))
+
+    # Sent and Received
+    received_current = model.received.loc[model.received['Batch_Sent'] == model.batch_name].shape[0]
+    trackingtxt += "{} sample(s) sent to {} in {} were released with {}.\n\n".format(str(received_current), vendor, batch_label, batch_label)
+
+    # Print Sent not Received
+    if model.sent_released.empty:
+        trackingtxt += "All non-canceled samples sent to {} in {} have been released in {}:\n\n".format(vendor, batch_label, batch_label)
+    else:
+        trackingtxt += "{} sample(s) sent to {} in {} have not been released in {}:\n{}\n\n".format(str(model.sent_not_received.shape[0]), vendor, batch_label, batch_label, model.sent_not_received[TRACKING_COLUMNS].to_string(index=False))
+
+    # Print Received from other batches (not sent from current batch)
+    trackingtxt += "{} sample(s) sent to {} in other batches were released with {}:\n{}\n\n".format(str(model.received_not_sent.shape[0]), vendor, batch_label, model.received_not_sent[TRACKING_COLUMNS].to_string(index=False))
+
+    seq_family_members = model.sequenced_family
+    if seq_family_members.empty:
+        trackingtxt += "No sample(s) released in previous batches are family members of sample(s) released with {}.\n\n".format(batch_label)
+    else:
+        trackingtxt += "{} sample(s) released in previous batches are family members of sample(s) released with {}.\n{}\n\n".format(str(seq_family_members.shape[0]), batch_label, seq_family_members[FAMILY_COLUMNS].to_string(index=False))
+
+    trackingtxt += "{} family members have been consented but not yet released.\n{}\n\n".format(str(model.unsequenced_family.shape[0]), model.unsequenced_family.to_string(index=False))
+
+    f = open(fname, 'w')
+    send_update(trackingtxt, f, True)
+    f.close()
+    return()
+
+# Sample tracking summary for one masterkey, as written for hg38 and HGSC releases
+#   name is the batch the masterkey is for (a split HGSC release has two)
+#   released_total is the number of new samples in the vendor's sample key
+#   unreleased are the consented family members without data, as the rows to print
+#   moved_samples are Phenotips IDs moved into this batch from earlier ones
+def write_release_tracking(model, fname, name, masterkey, released_total, unreleased, moved_samples=[], split=False):
+    vendor = model.vendor
+    batch_num = int(re.sub('^BATCH', '', name))
+    batch_name_lower = 'Batch ' + str(batch_num)
+
+    # only active orders that were not canceled or auto completed
+    sent = model.sent_in(name)
+    sent = sent[sent['Active_Status'].str.match('Active', case=False, na=False)][RELEASE_SENT_COLUMNS]
+    sent = sent.drop_duplicates(keep='first')
+    num_sent = len(sent['CRIS_Order#'].unique())
+
+    f = open(fname, 'w')
+    f.write('******************************************\n*\n* Notes for samples released with ' + batch_name_lower + '\n' +
+            '*\n******************************************\n\n')
+
+    f.write('Total number of samples sent to ' + vendor + ' with ' + batch_name_lower + ': ' + str(num_sent) + '\n')
+    f.write('Total number of new samples in latest ' + vendor + ' release' + (' (before split)' if split else '') + ': ' + str(released_total) + '\n\n')
+
+    num_released = masterkey[masterkey['Batch_Received'].str.match(name, na=False)].shape[0]
+    f.write('Number of new samples released from ' + vendor + ' in ' + batch_name_lower + ': ' + str(num_released) + '\n\n')
+
+    f.write('Total number of samples in the masterkey file: ' + str(masterkey.shape[0]) + "\n")
+    f.write("Here's the breakdown: \n")
+    f.write('---------------------------------------------------------------------------------------------\n\n')
+
+    masterkey_ids = SampleRegistry(masterkey)
+    num_released_from_sent = masterkey_ids.isin('order', sent['CRIS_Order#']).sum()
+    f.write(str(num_released_from_sent) + ' sample(s) sent to ' + vendor + ' in ' + batch_name_lower + ' were released with ' + batch_name_lower + '.\n\n')
+
+    ##### Special Case: remove samples that are being added/moved from other batches into current batch from previous batches.
+    # We'll make a separate section to outline those samples
+    sent_in_other_and_released = masterkey[~masterkey['Batch_Sent'].str.match(name, na=False)]
+    sent_in_other_and_released = sent_in_other_and_released[sent_in_other_and_released['Batch_Received'].str.match(name, na=False)]
+    sent_in_other_and_released = sent_in_other_and_released[~sent_in_other_and_released['Phenotips_ID'].isin(moved_samples)]
+    f.write(str(sent_in_other_and_released.shape[0]) + ' sample(s) sent to ' + vendor + ' in other batches were released with ' + batch_name_lower + ':\n')
+    f.write(sent_in_other_and_released.to_string(index=False) + '\n\n')
+
+    # This section outlines samples moved to current batch:
+    if len(moved_samples) > 0:
+        f.write(str(len(moved_samples)) + ' sample(s) released in previous batches were moved to ' + batch_name_lower + ':\n')
+        f.write(masterkey_ids.select('phenotips', moved_samples).to_string(index=False) + '\n\n')
+
+    # all family members in the masterkey file (they're sequenced and have data on file)
+    fam_members_released = masterkey[~masterkey['Batch_Received'].str.match(name, na=False)]
+    fam_members_released = fam_members_released[~fam_members_released['Phenotips_ID'].isin(moved_samples)]
+    if fam_members_released.empty:
+        f.write('No sample(s) released in previous batches are family members of sample(s) released with ' + batch_name_lower + '.\n\n')
+    else:
+        f.write(str(fam_members_released.shape[0]) + ' sample(s) released in previous batches are family members of sample(s) released in ' + batch_name_lower + ':\n')
+        f.write(fam_members_released.to_string(index=False) + '\n\n')
+
+    f.write('---------------------------------------------------------------------------------------------\n\n')
+
+    if unreleased.empty:
+        f.write('There are no unreleased family members of sample(s) released in ' + batch_name_lower + ' on file.\n\n')
+    else:
+        f.write(str(unreleased.shape[0]) + ' family members have been consented but not yet released.\n')
+        f.write(unreleased.to_string(index=False))
+        f.write('\n\n')
+
+    sent_not_released = sent[~masterkey_ids.isin('order', sent['CRIS_Order#'])]
+    if sent_not_released.empty:
+        f.write('All non-canceled samples sent to ' + vendor + ' in ' + batch_name_lower + ' have been released in ' + batch_name_lower + '\n\n')
+    else:
+        f.write(str(sent_not_released.shape[0]) + ' sample(s) sent to ' + vendor + ' in ' + batch_name_lower + ' were not released in ' + batch_name_lower + ':\n')
+        f.write(sent_not_released.to_string(index=False) + '\n\n')
+
+    f.close()
+    return()
+
+####################################
+#
+# Tracking records, the tracking classification as a table
+#
+####################################
+# One row per order (or per person without an order) and tracked batch, typed when read back
+TRACKING_RECORD_COLUMNS = ['Batch', 'Vendor', 'CRIS_Order#', 'Phenotips_ID', 'Phenotips_Family_ID',
+                           'Father_Phenotips_ID', 'Mother_Phenotips_ID', 'Classification', 'Batch_Sent',
+                           'Batch_Received', 'Batch_Sent_Number', 'Batch_Received_Number', 'CRIS_Order_Status',
+                           'Active_Status']
+TRACKING_RECORD_NUMBERS = ['Batch_Sent_Number', 'Batch_Received_Number']
+
+# Tracking records of one batch: every sent, received and family row with its TRACKING_GROUPS label
+#   an order in more than one frame keeps its sent label, then its received label, then its family label
+def tracking_records(model):
+    model.classify()
+    frames = [(model.sent_in(), model.sent_groups), (model.received, model.received_groups),
+              (model.family, model.family_groups)]
+    records = pd.concat([df.assign(Classification=np.asarray(groups)) for df, groups in frames], sort=False)
+    records = records.drop_duplicates(subset=['CRIS_Order#', 'Phenotips_ID'], keep='first')
+
+    # parents from the family rows, the sent and received frames do not carry them
+    linkage = model.family.drop_duplicates(subset=['Phenotips_ID']).set_index('Phenotips_ID')
+    for column in ['Father_Phenotips_ID', 'Mother_Phenotips_ID', 'Active_Status']:
+        known = records['Phenotips_ID'].map(linkage[column]) if column in linkage.columns else np.nan
+        records[column] = records[column].fillna(known) if column in records.columns else known
+
+    records['Batch'] = model.batch_name
+    records['Vendor'] = model.vendor
+    records['Batch_Sent_Number'] = batch_numbers(records['Batch_Sent'])
+    records['Batch_Received_Number'] = batch_numbers(records['Batch_Received'])
+    return(typed_tracking_records(records.reindex(columns=TRACKING_RECORD_COLUMNS)))
+
+# Tracking record columns as their types: text, nullable batch numbers and the classification categories
+def typed_tracking_records(records):
+    records = records.copy()
+    for column in TRACKING_RECORD_COLUMNS:
+        if column in TRACKING_RECORD_NUMBERS:
+            records[column] = pd.to_numeric(records[column]).astype('Int64')
+        elif column == 'Classification':
+            records[column] = pd.Categorical(records[column], categories=TRACKING_GROUPS)
+        else:
+            records[column] = records[column].astype(object).where(records[column].notna(), None)
+    return(records.reset_index(drop=True))
+
+# Read tracking records written by write_tracking_records(), Parquet or tab separated by the file name
+def read_tracking_records(fname):
+    if fname.endswith('.parquet'):
+        records = pd.read_parquet(fname)
+    else:
+        records = pd.read_csv(fname, sep='\t', dtype=str, keep_default_na=False, na_values=[''])
+    return(typed_tracking_records(records.reindex(columns=TRACKING_RECORD_COLUMNS)))
+
+# Write tracking records as Parquet (*.parquet) or tab separated text, through a temporary file
+#   with append, the records replace those of the same batches in an existing file and the rest are kept,
+#   so one cohort file collects every batch and a rerun of a batch does not repeat it
+def write_tracking_records(records, fname, append=False, log=None):
+    if fname.endswith('.parquet') and not HAVE_PARQUET:
+        err_out("Error: writing {} needs pyarrow, use a .tsv file name instead".format(fname), log)
+
+    if append and os.path.isfile(fname):
+        previous = read_tracking_records(fname)
+        previous = previous[~previous['Batch'].isin(records['Batch'].unique())]
+        records = typed_tracking_records(pd.concat([previous, records], sort=False))
+        order = np.lexsort((records['CRIS_Order#'].fillna('').to_numpy(), batch_numbers(records['Batch'])))
+        records = records.iloc[order].reset_index(drop=True)
+
+    tmp = fname + '.' + str(os.getpid())
+    if fname.endswith('.parquet'):
+        records.to_parquet(tmp, index=False)
+    else:
+        records.to_csv(tmp, sep='\t', index=False, na_rep='')
+    os.replace(tmp, fname)
+    return(records)
+
+# Orders sent with a batch that no tracked batch has seen released, from the latest record of each order
+def outstanding_orders(records, name):
+    latest = records.iloc[np.argsort(batch_numbers(records['Batch']), kind='stable')]
+    latest = latest[latest['CRIS_Order#'].notna()].drop_duplicates(subset=['CRIS_Order#'], keep='last')
+    return(latest[(latest['Batch_Sent'] == name) & latest['Batch_Received'].isna() &
+                  (latest['Classification'] != 'excluded') & ~dropped_orders(latest)])
+
+####################################
+#
+# Sample history, every sample's batches over time
+#
+####################################
+# History file kept at the top of a data tree, and the masterkeys under it that feed it
+SAMPLE_HISTORY = 'sample_history.tsv'
+HISTORY_MASTERKEYS = ['BATCH*/masterkey_batch*.txt', 'BATCH*/masterkey_BATCH*.txt']
+HISTORY_COLUMNS = ['Phenotips_ID', 'CRIS_Order#', 'Exome_ID', 'Batch', 'Batch_Sent', 'Batch_Received', 'Source']
+
+# State file kept next to a sample history, the size and mtime of each masterkey read into it
+def history_state_fname(fname):
+    return(os.path.splitext(fname)[0] + '.state.json')
+
+class SampleHistory(object):
+    """Batch membership of every sample over time.
+
+    One row per sample per masterkey file or BSI load it was seen in: the
+    batch whose masterkey (or load) it is, and the sample's Batch Sent and
+    Batch Received there.  Masterkeys are read again only when their size
+    or mtime moved, as recorded in the state file next to the history, and
+    a batch's BSI rows replace that batch's earlier ones.
+
+    A sample received with a batch that was already received with an
+    earlier one was moved when the Exome ID is the same (its data exists),
+    and re-released when it is new.
+    """
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.rows = pd.DataFrame(columns=HISTORY_COLUMNS)
+        self.sources = dict()
+        self.changed = False
+
+    # History and state from disk, empty when there is none yet
+    @classmethod
+    def load(cls, fname):
+        history = cls(fname)
+        if fname is not None and os.path.isfile(fname):
+            history.rows = pd.read_csv(fname, sep='\t', dtype=str, keep_default_na=False, na_values=[''])
+            history.rows = history.rows.reindex(columns=HISTORY_COLUMNS)
+            try:
+                with open(history_state_fname(fname), 'r') as f:
+                    history.sources = json.load(f)['sources']
+            except (OSError, ValueError, KeyError):
+                history.sources = dict()
+        return(history)
+
+    # Replace the rows of one source
+    def _replace(self, source, df, batch):
+        df = df.reindex(columns=HISTORY_COLUMNS).astype(object)
+        df['Batch'] = batch
+        df['Source'] = source
+        self.rows = pd.concat([self.rows[self.rows['Source'] != source], df], sort=False, ignore_index=True)
+        self.changed = True
+
+    # Read the masterkeys that are new or changed since the last update, returns how many were read
+    def update_masterkeys(self, fnames):
+        read = 0
+        for fname in fnames:
+            m = re.search(r'masterkey_batch(\d+)', os.path.basename(fname), re.IGNORECASE)
+            if m is None:
+                continue
+            st = os.stat(fname)
+            source = os.path.abspath(fname)
+            if self.sources.get(source) == [st.st_size, st.st_mtime_ns]:
+                continue
+            df = pd.read_csv(fname, sep='\t', header=0, dtype=str)
+            df = df.rename(columns={'CIDR_Exome_ID': 'Exome_ID'})
+            self._replace(source, df, batch_name(int(m.group(1))))
+            self.sources[source] = [st.st_size, st.st_mtime_ns]
+            read += 1
+        return(read)
+
+    # Record what BSI says about a loaded batch: its released orders and their sequenced families
+    def update_model(self, model):
+        source = 'BSI ' + model.batch_name
+        self._replace(source, model.sequenced_rows(), model.batch_name)
+
+    # Write the history and its state, through a temporary file
+    def save(self):
+        if self.fname is None or not self.changed:
+            return()
+        order = np.lexsort((self.rows['Source'].to_numpy(dtype=str), self.rows['Phenotips_ID'].fillna('').to_numpy(dtype=str),
+                            batch_numbers(self.rows['Batch'])))
+        tmp = self.fname + '.' + str(os.getpid())
+        self.rows.iloc[order].to_csv(tmp, sep='\t', index=False, na_rep='')
+        os.replace(tmp, self.fname)
+        with open(history_state_fname(self.fname), 'w') as f:
+            json.dump({'sources': self.sources}, f, sort_keys=True)
+        self.changed = False
+        return()
+
+    # Receipts of these samples with batches before name, earliest first
+    def earlier_receipts(self, pids, name):
+        number = batch_numbers(pd.Series([name]))[0]
+        rows = self.rows[self.rows['Phenotips_ID'].isin(pids)]
+        received = batch_numbers(rows['Batch_Received'])
+        rows = rows[received < number].assign(Received_Number=received[received < number])
+        return(rows.sort_values('Received_Number', kind='stable').drop(columns='Received_Number'))
+
+    # Samples received with name that were received with an earlier batch with the same Exome ID
+    #   df has the Phenotips_ID, Exome_ID and Batch_Received of the batch, e.g. its masterkey
+    def moved(self, df, name):
+        return(self._earlier(df, name, True))
+
+    # Samples received with name that were received with an earlier batch under another Exome ID
+    def re_released(self, df, name):
+        return(self._earlier(df, name, False))
+
+    def _earlier(self, df, name, same_exome):
+        number = batch_numbers(pd.Series([name]))[0]
+        current = df[batch_numbers(df['Batch_Received']) == number]
+        earlier = self.earlier_receipts(current['Phenotips_ID'], name)
+        if earlier.empty:
+            return([])
+        pairs = current[['Phenotips_ID', 'Exome_ID']].merge(earlier[['Phenotips_ID', 'Exome_ID']], on='Phenotips_ID',
+                                                            suffixes=('', '_earlier'))
+        same = (pairs['Exome_ID'] == pairs['Exome_ID_earlier']) | pairs['Exome_ID'].isna() | pairs['Exome_ID_earlier'].isna()
+        moved = pairs.loc[same, 'Phenotips_ID'].unique().tolist()
+        if same_exome:
+            return(moved)
+        return([pid for pid in pairs['Phenotips_ID'].unique().tolist() if pid not in moved])
+
+    # Rows for linking the earlier data of moved samples: each one's latest earlier receipt
+    def moved_rows(self, pids, name):
+        rows = self.earlier_receipts(pids, name)
+        return(rows.drop_duplicates(subset=['Phenotips_ID'], keep='last')[['Phenotips_ID', 'Exome_ID', 'Batch_Sent', 'Batch_Received']])
+
+# Samples of a batch's masterkey moved from earlier batches, and the rows whose BAMs are linked into the batch:
+# the previously sequenced family members plus each moved sample's earlier receipt
+def moved_samples(history, model, masterkey, log=None):
+    moved = history.moved(masterkey, model.batch_name)
+    if len(moved) > 0:
+        send_update("{} sample(s) moved to {} from earlier batches: {}".format(len(moved), model.batch_label, ', '.join(moved)), log)
+    return(moved, pd.concat([model.sequenced_family, history.moved_rows(moved, model.batch_name)], sort=False))
+
+# The history of a data tree, brought up to date with its masterkeys and saved
+#   an absent tree (a test run away from the cluster) gives an empty history that is not saved
+def sample_history(root, fname=None, log=None):
+    if fname is None:
+        if not os.path.isdir(root):
+            send_update("No {} here, samples moved from earlier batches are not looked up".format(root), log)
+            return(SampleHistory())
+        fname = os.path.join(root, SAMPLE_HISTORY)
+
+    history = SampleHistory.load(fname)
+    masterkeys = sorted(set([f for pattern in HISTORY_MASTERKEYS for f in glob.glob(os.path.join(root, pattern))]))
+    read = history.update_masterkeys(masterkeys)
+    send_update("Sample history {}: {} rows, {} of {} masterkeys read".format(fname, history.rows.shape[0], read, len(masterkeys)), log)
+    return(history)
+
+####################################
+#
+# Cumulative pedigree
+#
+####################################
+# The cumulative ped is one block of rows per family, blocks in family ID order and rows sorted in
+# each block, so the same BSI rows always give the same bytes.  Next to it a state file records the
+# last batch included and a sha1 of every row, by family.  An update pulls the family and parent
+# links (CUMULATIVE_LINK_FIELDS) of every received sample and compares them with the existing
+# blocks: families whose members or parent links changed, and the families loaded for this run,
+# are pulled whole and just their blocks rewritten, along with the earlier family of any sample
+# that moved; every other block is copied from the existing file.  Samples without a Phenotips
+# family ID only change in a full rebuild.
+
+# Family and parent link fields pulled for every received sample on each update, and their columns,
+# the first four cumulative ped columns
+CUMULATIVE_LINK_FIELDS = ['Phenotips Family ID', 'Phenotips ID', 'Father PhenotipsId', 'Mother PhenotipsId']
+CUMULATIVE_LINK_COLUMNS = PED_COLUMNS[:4]
+
+# Cumulative ped lines of the rows, as {family ID: sorted lines}
+def cumulative_blocks(df):
+    ped = df[PED_COLUMNS].fillna({'Mother_Phenotips_ID': '0', 'Father_Phenotips_ID': '0'})
+    lines = row_lines(ped, PED_COLUMNS)
+
+    blocks = dict()
+    for fam, rows in lines.groupby(row_lines(ped, ['Phenotips_Family_ID']).values, sort=False):
+        blocks[fam] = sorted(set(rows.tolist()))
+    return(blocks)
+
+# Family and parent links of the rows in each block, as {family ID: set of link lines}
+def block_links(blocks):
+    return(dict([(fam, set(['\t'.join(line.split('\t')[:len(CUMULATIVE_LINK_COLUMNS)]) for line in lines]))
+                 for fam, lines in blocks.items()]))
+
+# Families of each Phenotips ID in the blocks, as {Phenotips ID: set of family IDs}
+def block_members(blocks):
+    members = dict()
+    for fam, lines in blocks.items():
+        for line in lines:
+            members.setdefault(line.split('\t')[1], set()).add(fam)
+    return(members)
+
+# Text of the cumulative ped made of these blocks
+def cumulative_text(blocks):
+    return(''.join([''.join([line + '\n' for line in blocks[fam]]) for fam in sorted(blocks.keys())]))
+
+# Row fingerprints of each block, as stored in the state file
+def block_prints(blocks):
+    return(dict([(fam, [hashlib.sha1(line.encode('utf-8')).hexdigest() for line in lines]) for fam, lines in blocks.items()]))
+
+# State file kept next to a cumulative ped
+def cumulative_state_fname(fname):
+    return(os.path.splitext(fname)[0] + '.state.json')
+
+# Does updating this cumulative ped need every received sample, pass it as load_batches(cumulative=)
+def cumulative_needs_full(fname, verify_full=False):
+    return(verify_full or not os.path.isfile(fname) or not os.path.isfile(cumulative_state_fname(fname)))
+
+# Blocks of an existing cumulative ped and its last batch, None if it has no state
+#   or no longer matches the row fingerprints in its state
+def read_cumulative_ped(fname, log=None):
+    state_fname = cumulative_state_fname(fname)
+    if not os.path.isfile(fname) or not os.path.isfile(state_fname):
+        return(None, None)
+    with open(state_fname, 'r') as f:
+        state = json.load(f)
+
+    blocks = dict()
+    with open(fname, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            blocks.setdefault(line.split('\t')[0], []).append(line)
+
+    if block_prints(blocks) != state['rows']:
+        send_update("Warning: {} does not match {}, rebuilding it from BSI".format(fname, state_fname), log)
+        return(None, None)
+    return(blocks, state['last_batch'])
+
+# Write the cumulative ped and its state, through a temporary file so readers never see half a file
+def write_cumulative_blocks(blocks, fname, last_batch):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(cumulative_text(blocks))
+    os.replace(tmp, fname)
+
+    with open(cumulative_state_fname(fname), 'w') as f:
+        json.dump({'last_batch': last_batch, 'rows': block_prints(blocks)}, f, sort_keys=True)
+    return()
+
+# Every sample received in any batch, the rows the cumulative ped is made from
+def query_all_received(curl_get, url_reports, session):
+    return(bsi_query(curl_get, url_reports, session, CUMULATIVE_FIELDS, ['BATCH*'], 'Batch Received', False))
+
+# Family and parent links of every received sample, as {family ID: set of link lines} like block_links
+def query_received_links(curl_get, url_reports, session):
+    df = bsi_query(curl_get, url_reports, session, CUMULATIVE_LINK_FIELDS, ['BATCH*'], 'Batch Received', False)
+    links = df[CUMULATIVE_LINK_COLUMNS].fillna({'Mother_Phenotips_ID': '0', 'Father_Phenotips_ID': '0'})
+    lines = row_lines(links, CUMULATIVE_LINK_COLUMNS)
+    return(dict([(fam, set(rows.tolist())) for fam, rows in lines.groupby(row_lines(links, ['Phenotips_Family_ID']).values, sort=False)]))
+
+# The same rows for just these families
+def query_family_received(curl_get, url_reports, session, families):
+    return(bsi_query(curl_get, url_reports, session, CUMULATIVE_FIELDS, families, 'Phenotips Family ID',
+                     filters=[('Batch Received', 'ne', ['BATCH*'])]))
+
+# Bring the cumulative ped up to date with the loaded batches
+#   without a usable state file this is a full rebuild from every received sample;
+#   verify_full also does the full rebuild and compares it with the update, returns False
+#   (and keeps the full rebuild) if they differ
+def update_cumulative_ped(models, fname='cumulative_ped.txt', verify_full=False, log=None):
+    last_batch = max(models.keys())
+    blocks, prev_batch = read_cumulative_ped(fname, log)
+
+    cnf, url_session, url_reports, curl_get = return_bsi_info()
+    user, pw = read_conf(cnf)
+    session = get_bsi_session(url_session, user, pw)
+
+    full = None
+    if blocks is None or verify_full:
+        all_received = [m.all_received for m in models.values() if m.all_received is not None]
+        full = cumulative_blocks(all_received[0] if len(all_received) > 0 else
+                                 query_all_received(curl_get, url_reports, session))
+
+    if blocks is None:
+        send_update("Writing the cumulative ped from every received sample ({} families)".format(len(full)), log)
+        write_cumulative_blocks(full, fname, last_batch)
+        return(True)
+
+    # Families of this run's batches, and every family whose members or parent links differ from the
+    # existing blocks, which covers the samples received since the last update
+    families = set()
+    for model in models.values():
+        families.update(model.family['Phenotips_Family_ID'].dropna().astype(str))
+    old_links = block_links(blocks)
+    new_links = query_received_links(curl_get, url_reports, session)
+    families.update([fam for fam in set(old_links.keys()) | set(new_links.keys()) if old_links.get(fam) != new_links.get(fam)])
+    families.discard('')
+
+    # Pull the families, then the earlier families of any sample in them that moved, until none is left
+    members = block_members(blocks)
+    frames = []
+    pending = families
+    while len(pending) > 0:
+        df = query_family_received(curl_get, url_reports, session, sorted(pending))
+        frames.append(df)
+        moved_from = set()
+        for pid in df['Phenotips_ID'].dropna().astype(str):
+            moved_from.update(members.get(pid, set()))
+        pending = moved_from - families - set([''])
+        families.update(pending)
+
+    changed = cumulative_blocks(pd.concat(frames, ignore_index=True))
+    affected = [fam for fam in families if blocks.get(fam) != changed.get(fam)]
+    for fam in affected:
+        if fam in changed:
+            blocks[fam] = changed[fam]
+        else:
+            del blocks[fam]
+    write_cumulative_blocks(blocks, fname, max(prev_batch, last_batch))
+    send_update("Cumulative ped: {} families checked, {} family blocks rewritten".format(len(families), len(affected)), log)
+
+    if verify_full:
+        differ = sorted([fam for fam in set(blocks.keys()) | set(full.keys()) if blocks.get(fam) != full.get(fam)])
+        if len(differ) > 0:
+            send_update("Warning: the updated cumulative ped differs from a full rebuild in {} families: {}".format(
+                len(differ), ', '.join(differ[:20])), log)
+            write_cumulative_blocks(full, fname, max(prev_batch, last_batch))
+            return(False)
+        send_update("Cumulative ped is identical to a full rebuild", log)
+    return(True)
+
+####################################
+#
+# Ped outputs refreshed from an earlier directory
+#
+####################################
+# Written next to the ped files, records what each batch's files were made from
+PED_MANIFEST = 'seqr_peds.json'
+# Families whose source rows differ from the --since directory
+CHANGED_FAMILIES = 'changed_families.txt'
+# BSI columns the seqr ped and genrptlinks files are made from
+PED_SOURCE_COLUMNS = PED_COLUMNS + [c for c in GENRPTLINKS_COLUMNS if c not in PED_COLUMNS]
+
+# Batch manifest entries of an earlier output directory, keyed by batch number as text
+def read_manifest(dirname, log=None):
+    fname = os.path.join(dirname, PED_MANIFEST)
+    if not os.path.isfile(fname):
+        send_update("Warning: no {} in {}, every batch will be rewritten".format(PED_MANIFEST, dirname), log)
+        return(dict())
+    with open(fname, 'r') as f:
+        return(json.load(f)['batches'])
+
+# Hard link a file forward into the current directory, copy it if a link is not possible
+def link_forward(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+    return()
+
+# Source fingerprints of one batch, returns (batch hash, {family ID: hash})
+def batch_fingerprint(model):
+    families = family_fingerprints(model.ped_family(), PED_SOURCE_COLUMNS)
+    lines = sorted([fam + '\t' + h for fam, h in families.items()])
+    return(hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest(), families)
+
+# Link a batch's files forward from since if its source rows and files are unchanged,
+# otherwise write them with write(model), which writes fnames; returns the batch's manifest entry
+def refresh_outputs(model, fnames, write, previous, since):
+    source, families = batch_fingerprint(model)
+    prev = previous.get(str(model.batch))
+
+    unchanged = prev is not None and prev['source'] == source and sorted(prev['files'].keys()) == sorted(fnames)
+    if unchanged:
+        for fname in fnames:
+            src = os.path.join(since, fname)
+            if not os.path.isfile(src) or file_sha1(src) != prev['files'][fname]:
+                unchanged = False
+                break
+
+    if unchanged:
+        if not os.path.exists(fnames[0]) or not os.path.samefile(os.path.join(since, fnames[0]), fnames[0]):
+            for fname in fnames:
+                link_forward(os.path.join(since, fname), fname)
+        files = prev['files']
+        status = 'linked'
+    else:
+        # an existing file may be a link into an earlier directory, never write through it
+        for fname in fnames:
+            if os.path.lexists(fname):
+                os.remove(fname)
+        write(model)
+        files = dict([(fname, file_sha1(fname)) for fname in fnames])
+        status = 'written'
+
+    return({'source': source, 'families': families, 'files': files, 'status': status})
+
+# Families added, changed or removed in each batch since the previous manifest
+def changed_families(previous, entries):
+    rows = []
+    for batch in sorted(entries.keys(), key=int):
+        old = previous.get(batch, {'families': dict()})['families']
+        new = entries[batch]['families']
+        for fam in sorted(set(old.keys()) | set(new.keys())):
+            if fam not in old:
+                rows.append([batch, fam, 'added'])
+            elif fam not in new:
+                rows.append([batch, fam, 'removed'])
+            elif old[fam] != new[fam]:
+                rows.append([batch, fam, 'changed'])
+    return(pd.DataFrame(rows, columns=['Batch', 'Phenotips_Family_ID', 'Change']))
+
+# Write the manifest of this directory's batches, {batch: entry}, and, for a refresh, the changed families
+def write_manifest(entries, previous, since, log=None):
+    entries = dict([(str(b), e) for b, e in entries.items()])
+    with open(PED_MANIFEST, 'w') as f:
+        json.dump({'created': str(datetime.datetime.now()), 'since': since, 'batches': entries}, f, indent=1, sort_keys=True)
+
+    linked = [b for b in entries if entries[b]['status'] == 'linked']
+    send_update("{} batches written, {} linked forward unchanged".format(len(entries) - len(linked), len(linked)), log)
+
+    if since is not None:
+        changes = changed_families(previous, entries)
+        changes.to_csv(CHANGED_FAMILIES, sep='\t', index=False)
+        send_update("{} families changed since {}, listed in {}".format(changes.shape[0], since, CHANGED_FAMILIES), log)
+    return()
+
+# Add the --since option of the ped writers
+def add_since_arg(parser):
+    parser.add_argument('-s', '--since', required=False, type=str, default=None,
+                        help='Earlier output directory, batches whose BSI rows are unchanged are hard linked from it\n' +
+                             'instead of rewritten, and the changed families are listed in {}'.format(CHANGED_FAMILIES))
+    return()
+
+# Manifest entries of the --since directory, empty without one
+def since_manifest(since, log=None):
+    if since is None:
+        return(dict())
+    if not os.path.isdir(since):
+        err_out("Error: --since directory {} not found".format(since), log)
+    return(read_manifest(since, log))
+
+####################################
+#
+# BAM location index and family BAM links
+#
+####################################
+# Sequence files and the index files that go with them, longest suffix first
+BAM_SUFFIXES = {'.bam': ['.bam.bai', '.bai'], '.cram': ['.cram.crai', '.crai']}
+BAM_INDEX_SUFFIXES = ['.bam.bai', '.cram.crai', '.bai', '.crai']
+
+# Directory levels below a root that are walked, <batch>/BAM/ plus one spare level
+BAM_INDEX_DEPTH = 3
+
+# Data trees of both vendors, indexed together so a family member's BAM is found whichever sequenced it
+BAM_ROOTS = [CIDR_DATA_RENAMED, CSI_DATA_PROCESSED]
+
+class BamIndex(object):
+    """Every BAM, CRAM and index file under the data trees, located by sample ID.
+
+    The trees (CIDR_DATA_RENAMED for CIDR batches renamed to Phenotips IDs,
+    CSI_DATA_PROCESSED for HGSC batches) are laid out as
+    <root>/<batch>/BAM/<Phenotips ID>.bam, and are walked on a thread pool, one worker per top level batch
+    directory.  bam_index.json in the cache directory keeps each directory's
+    mtime with its subdirectories and sequence file names, one file per set
+    of roots, so a refresh
+    stats every directory but only lists the ones whose mtime moved.
+    Symbolic links are not indexed: the links made for earlier batches
+    never stand in for the files they point at.
+    """
+
+    def __init__(self, roots, cache_dir=RAWDATA_CACHE_DIR, enabled=True):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.roots = sorted([os.path.abspath(r) for r in roots])
+        self.dirs = dict()
+        self.samples = dict()
+        self.listed = 0
+
+    def _fname(self):
+        tag = hashlib.sha1('\n'.join(self.roots).encode('utf-8')).hexdigest()[:8]
+        return(os.path.join(self.cache_dir, 'bam_index-{}.json'.format(tag)))
+
+    # Walk one directory, reusing its listing from the old index while its mtime is unchanged
+    def _walk(self, path, depth, old, dirs):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return(0)
+
+        listed = 0
+        known = old.get(path)
+        if known is None or known['mtime'] != mtime:
+            subdirs = []
+            files = []
+            try:
+                with os.scandir(path) as entries:
+                    for e in entries:
+                        if e.is_symlink():
+                            continue
+                        if e.is_dir():
+                            subdirs.append(e.name)
+                        elif e.name.endswith(tuple(BAM_SUFFIXES.keys()) + tuple(BAM_INDEX_SUFFIXES)):
+                            files.append(e.name)
+            except OSError:
+                return(0)
+            known = {'mtime': mtime, 'subdirs': sorted(subdirs), 'files': sorted(files)}
+            listed = 1
+        dirs[path] = known
+
+        if depth < BAM_INDEX_DEPTH:
+            for sub in known['subdirs']:
+                listed += self._walk(os.path.join(path, sub), depth + 1, old, dirs)
+        return(listed)
+
+    # Bring the index up to date with the trees, a full walk the first time
+    def refresh(self, workers=None):
+        old = dict()
+        if self.enabled:
+            try:
+                with open(self._fname(), 'r') as f:
+                    old = json.load(f)
+            except (OSError, ValueError):
+                old = dict()
+
+        # the roots themselves first, then their batch directories on the pool
+        dirs = dict()
+        self.listed = 0
+        tops = []
+        for root in self.roots:
+            self.listed += self._walk(root, BAM_INDEX_DEPTH, old, dirs)
+            if root in dirs:
+                tops.extend([os.path.join(root, sub) for sub in dirs[root]['subdirs']])
+
+        def walk_top(path):
+            found = dict()
+            return(self._walk(path, 1, old, found), found)
+
+        with ThreadPoolExecutor(max_workers=max(1, GRIS_WORKERS if workers is None else workers)) as pool:
+            for listed, found in pool.map(walk_top, tops):
+                self.listed += listed
+                dirs.update(found)
+        self.dirs = dirs
+
+        if self.enabled and dirs != old:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            tmp = self._fname() + '.' + str(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(dirs, f)
+            os.replace(tmp, self._fname())
+
+        # sample ID -> directories holding its sequence files
+        samples = dict()
+        for path, known in dirs.items():
+            for name in known['files']:
+                for suffix in BAM_SUFFIXES:
+                    if name.endswith(suffix):
+                        samples.setdefault(name[:-len(suffix)], []).append(path)
+        self.samples = samples
+        return(self)
+
+    # Batch directory (the first level below its root) of an indexed directory
+    def batch_of(self, path):
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                return(os.path.relpath(path, root).split(os.sep)[0])
+        return(None)
+
+    # Sequence file and index of one sample in any of the trees, preferring the batch it was
+    # received in, then any other batch; (None, None) when it has no sequence file
+    def locate(self, pid, batch=None):
+        paths = self.samples.get(pid, [])
+        if batch is not None:
+            expected = [p for p in paths if self.batch_of(p) == batch]
+            if len(expected) > 0:
+                paths = expected
+        for path in sorted(paths):
+            files = self.dirs[path]['files']
+            for suffix, index_suffixes in BAM_SUFFIXES.items():
+                if pid + suffix in files:
+                    index = [pid + s for s in index_suffixes if pid + s in files]
+                    return(os.path.join(path, pid + suffix), os.path.join(path, index[0]) if len(index) > 0 else None)
+        return(None, None)
+
+_bam_indexes = dict()
+_bam_index_lock = threading.Lock()
+
+# The BAM index of every data tree (BAM_ROOTS, plus root when it is another tree), refreshed once per run on first use
+def bam_index(root=None, log=None):
+    roots = BAM_ROOTS + ([root] if root is not None and root not in BAM_ROOTS else [])
+    key = tuple(sorted(roots))
+    with _bam_index_lock:
+        if key not in _bam_indexes:
+            index = BamIndex(roots, _rawdata_cache.cache_dir, _rawdata_cache.enabled).refresh()
+            send_update("BAM index of {}: {} sequenced samples in {} directories, {} listed".format(
+                ', '.join(roots), len(index.samples), len(index.dirs), index.listed), log)
+            _bam_indexes[key] = index
+        return(_bam_indexes[key])
+
+# Check one sample's files for linking: the sequence file is there and its index is at least as new
+#   returns the problem, or None if the pair can be linked
+def verify_bam(bam, index):
+    if bam is None:
+        return('no BAM or CRAM found')
+    try:
+        bam_mtime = os.stat(bam).st_mtime
+    except OSError:
+        return('missing ' + bam)
+    if index is None:
+        return('no index for ' + bam)
+    try:
+        index_mtime = os.stat(index).st_mtime
+    except OSError:
+        return('missing ' + index)
+    if index_mtime < bam_mtime:
+        return('index older than ' + bam)
+    return(None)
+
+# Point a symbolic link at source, replacing an old link, never a real file
+def make_link(source, dest):
+    if os.path.islink(dest):
+        if os.readlink(dest) == source:
+            return()
+        tmp = dest + '.' + str(os.getpid())
+        os.symlink(source, tmp)
+        os.replace(tmp, dest)
+    elif not os.path.exists(dest):
+        os.symlink(source, dest)
+    return()
+
+# Link the BAM (or CRAM) and index of every previously released sample in df into
+# <rootdir>/<target>/BAM/, locating each through the BAM index and verifying it first
+#   the verified links are also written to the shell script fname, and the samples that
+#   cannot be linked are listed there and logged; returns {Phenotips ID: problem}
+#   as with make_link, only absent destinations and symlinks are (re)linked, a sample
+#   whose destination is a real file is a problem and the file is left alone
+def link_bams(df, fname, rootdir, target, log=None):
+    index = bam_index(rootdir, log)
+    dest_dir = os.path.join(rootdir, target, 'BAM')
+    create = os.path.isdir(dest_dir)
+
+    links = []
+    problems = dict()
+    for pbatchdir, pid in zip(df['Batch_Received'].tolist(), df['Phenotips_ID'].tolist()):
+        bam, bai = index.locate(pid, pbatchdir.replace('BATCH0', 'BATCH'))
+        problem = verify_bam(bam, bai)
+        if problem is not None:
+            problems[pid] = problem
+            continue
+        pairs = [(source, os.path.join(dest_dir, os.path.basename(source))) for source in (bam, bai)]
+        blocked = [dest for source, dest in pairs if os.path.lexists(dest) and not os.path.islink(dest)]
+        if len(blocked) > 0:
+            problems[pid] = '{} exists and is not a link'.format(', '.join(blocked))
+            continue
+        for source, dest in pairs:
+            if os.path.islink(dest) and os.readlink(dest) == source:
+                continue
+            if create:
+                try:
+                    make_link(source, dest)
+                except OSError as e:
+                    problems[pid] = 'unable to link {}: {}'.format(dest, e)
+                    continue
+            links.append((source, dest))
+
+    with open(fname, 'w') as script:
+        script.write("#!/bin/sh\nset -e\n\n")
+        for pid, problem in problems.items():
+            script.write("# {}: {}\n".format(pid, problem))
+        if len(problems) > 0:
+            script.write("\n")
+        for source, dest in links:
+            # replace an older link, never a file
+            script.write("[ ! -L {0} ] || rm {0}\n".format(dest))
+            script.write("ln -s {} {}\n".format(source, dest))
+
+    if not create:
+        send_update("{} does not exist yet, run {} once it does".format(dest_dir, fname), log)
+    if len(problems) > 0:
+        send_update("Warning: {} previously sequenced sample(s) cannot be linked into {}:\n\t{}".format(
+            len(problems), target, '\n\t'.join(["{}: {}".format(pid, p) for pid, p in problems.items()])), log)
+    else:
+        send_update("{} BAM and index links verified for {}, {} new".format(2 * len(df), target, len(links)), log)
+    return(problems)
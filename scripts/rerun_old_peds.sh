@@ -3,31 +3,23 @@ set -e
 
 module load python
 
-if [ $# -ne 1 ]; then
+if [ $# -lt 1 ] || [ $# -gt 2 ]; then
     echo " " 
-    echo "Requires a single integer argument: batch number"
+    echo "Requires an integer argument: batch number"
+    echo "and optionally the previous pedigrees_updated directory to refresh from"
     echo " " 
     exit
 else
     echo "Running batches 1 to $1"
 fi
 
-# The first set of batches were not consistent, and don't use the rawdata subdirectory
-#echo "Running batches 1-4"
-for ((i=1;i<=4;i++)); 
-do
-    echo "Running Batch $i"
-    yes | csi_to_gris.py -b $i -p -d /data/NCBR/projects/csi_test_batch/old_peds/BATCH${i}
-done
-
-#echo "Running batches 5-${1}"
-for ((i=5;i<=$1;i++)); 
-do
-    if [[ $i == 8 ]]; then 
-        echo "Skipping Batch $i"
-        continue
-    else
-        echo "Running Batch $i"
-        yes | csi_to_gris.py -b $i -p -d /data/NCBR/projects/csi_test_batch/old_peds/BATCH${i}
-    fi
-done
+# The first set of batches were not consistent, and don't use the rawdata subdirectory,
+# each batch reads its files from old_peds/BATCH<n>.  One run for the whole range:
+# one BSI load, batch 8 is skipped and prompts are answered by csi_to_gris.py
+# with a previous directory only the batches whose BSI rows changed are rewritten,
+# the rest are hard linked forward and the changed families are listed in changed_families.txt
+if [ -n "$2" ]; then
+    csi_to_gris.py -b 1-$1 -p -d '/data/NCBR/projects/csi_test_batch/old_peds/BATCH{batch}' --since "$2"
+else
+    csi_to_gris.py -b 1-$1 -p -d '/data/NCBR/projects/csi_test_batch/old_peds/BATCH{batch}'
+fi
@@ -3,22 +3,21 @@ set -e
 
 module load python/3.7.3-foss-2016b
 
-if [ $# -ne 1 ]; then
+if [ $# -lt 1 ] || [ $# -gt 2 ]; then
     echo " " 
-    echo "Requires a single integer argument: batch number"
+    echo "Requires an integer argument: batch number"
+    echo "and optionally the previous pedigrees_updated directory to refresh from"
     echo " " 
     exit
 else
     echo "Running batches 1 to $1"
 fi
 
-for ((i=1;i<=$1;i++)); 
-do
-    if [[ $i == 8 ]]; then 
-        echo "Skipping Batch $i"
-        continue
-    else
-        echo "Running Batch $i"
-        python /hpcdata/dir/SCRIPTS/generate_seqr_ped.py -b $i
-    fi
-done
+# One run for the whole range: one BSI load, batch 8 is skipped by generate_seqr_ped.py
+# with a previous directory only the batches whose BSI rows changed are rewritten,
+# the rest are hard linked forward and the changed families are listed in changed_families.txt
+if [ -n "$2" ]; then
+    python /hpcdata/dir/SCRIPTS/generate_seqr_ped.py -b 1-$1 --since "$2"
+else
+    python /hpcdata/dir/SCRIPTS/generate_seqr_ped.py -b 1-$1
+fi
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tracking_status.py
+    Answers cohort status questions from the tracking records written by
+    csi_to_gris.py, csi_to_gris_hg38.py and csi_to_gris_hgsc.py, without
+    going back to BSI.
+
+    The records are one row per order and tracked batch, with the order's
+    sample tracking classification, batch sent, batch received and family.
+    Read either per-batch sample_tracking_batch#.tsv files or a cohort file
+    collected with --tracking-append; when an order was tracked with more
+    than one batch its latest record wins.
+
+    Usage:
+        tracking_status.py -r records [records ...] -b batch [-g group] [-o output.tsv]
+
+    Example:
+        tracking_status.py -r cohort_tracking.tsv -b 30
+        tracking_status.py -r sample_tracking_batch*.tsv -b 30 -g unsequenced_family
+"""
+
+__author__ = 'Susan Huse'
+__version__ = '1.0.0'
+__copyright__ = 'none'
+
+import argparse
+from argparse import RawTextHelpFormatter
+import pandas as pd
+from ncbr_huse import send_update, err_out, test_file
+from ncbr_gris import TRACKING_GROUPS, batch_name, read_tracking_records, typed_tracking_records, outstanding_orders
+
+def main():
+    #
+    # Usage statement
+    #
+    parseStr = 'Answers cohort status questions from local tracking records, without BSI.\n\n\
+    Without -g, lists the orders sent with the batch that no tracked batch has released yet.\n\
+    With -g, lists the records of the batch in that tracking group.\n\n\
+    Usage:\n\
+        tracking_status.py -r records [records ...] -b batch [-g group] [-o output.tsv]\n\n\
+    Example:\n\
+        tracking_status.py -r cohort_tracking.tsv -b 30\n\
+        tracking_status.py -r sample_tracking_batch*.tsv -b 30 -g unsequenced_family\n'
+
+    parser = argparse.ArgumentParser(description=parseStr, formatter_class=RawTextHelpFormatter)
+    parser.add_argument('-r', '--records', required=True, type=str, nargs='+', help='Tracking record files, .tsv or .parquet')
+    parser.add_argument('-b', '--batch', required=True, type=int, help='Batch number (integer)')
+    parser.add_argument('-g', '--group', required=False, type=str, default=None, choices=TRACKING_GROUPS,
+                        help='Tracking group to list instead of the outstanding orders')
+    parser.add_argument('-o', '--output', required=False, type=str, default=None, help='Write the rows to this tab separated file')
+
+    args = parser.parse_args()
+    for fname in args.records:
+        test_file(fname)
+
+    records = typed_tracking_records(pd.concat([read_tracking_records(fname) for fname in args.records], sort=False))
+    name = batch_name(args.batch)
+
+    if args.group is None:
+        rows = outstanding_orders(records, name)
+        title = "{} order(s) sent with {} are still outstanding".format(rows.shape[0], name)
+    else:
+        rows = records[(records['Batch'] == name) & (records['Classification'] == args.group)]
+        title = "{} record(s) of {} are {}".format(rows.shape[0], name, args.group)
+        if not (records['Batch'] == name).any():
+            err_out("Error: {} has no tracking records in {}".format(name, ', '.join(args.records)))
+
+    send_update(title + (":\n" + rows.to_string(index=False) if not rows.empty else "."))
+    if args.output is not None:
+        rows.to_csv(args.output, sep='\t', index=False, na_rep='')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+conftest.py
+    Shared fixtures: a local BSI stand-in (scripts/bsi_standin.py) with a logged on session
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import ncbr_bsi
+import bsi_standin
+
+# Samples in the stand-in fixture
+STANDIN_SAMPLES = 50
+
+# Stand-in server answering from a small fixture, with a logged on session
+@pytest.fixture
+def standin(tmp_path, monkeypatch):
+    cnf = tmp_path / 'cnf'
+    cnf.write_text('user\npassword\n')
+    monkeypatch.setattr(ncbr_bsi, 'BSI_CNF', str(cnf))
+    monkeypatch.setattr(ncbr_bsi, 'REQUEST_BACKOFF', 0.01)
+    monkeypatch.delenv(ncbr_bsi.SESSION_CACHE_ENV, raising=False)
+    ncbr_bsi.configure_bsi_cache(enabled=False)
+
+    server = bsi_standin.start_standin(bsi_standin.make_fixture(STANDIN_SAMPLES))
+    ncbr_bsi.set_bsi_url(server.base_url())
+    cnf, url_session, url_reports, curl_get = ncbr_bsi.return_bsi_info()
+    session = ncbr_bsi.get_bsi_session(url_session, *ncbr_bsi.read_conf(cnf))
+    yield server, url_reports, session
+    server.shutdown()
+    server.server_close()
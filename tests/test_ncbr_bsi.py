@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+test_ncbr_bsi.py
+    BSI error handling against the local stand-in (scripts/bsi_standin.py)
+
+    Usage:
+        python -m pytest tests
+"""
+
+import pytest
+
+import ncbr_bsi
+import bsi_standin
+from conftest import STANDIN_SAMPLES
+
+def fetch_all(url_reports, session):
+    return(ncbr_bsi.fetch_query(url_reports, session, ['CRIS Order #', 'Batch Sent'], [[]], None, True, False, 1))
+
+# Every request is answered 503: retried REQUEST_ATTEMPTS times, then quits with the status and body
+def test_server_errors_quit_with_status(standin):
+    server, url_reports, session = standin
+    server.error_rate = 1.0
+    nrequests = len(ncbr_bsi.get_bsi_client().stats)
+
+    with pytest.raises(SystemExit) as e:
+        fetch_all(url_reports, session)
+    assert '503' in str(e.value.code)
+    assert 'injected error' in str(e.value.code)
+    assert len(ncbr_bsi.get_bsi_client().stats) - nrequests == ncbr_bsi.REQUEST_ATTEMPTS
+
+# A server error that clears up is retried and the whole report returned
+def test_transient_server_error_recovers(standin, monkeypatch):
+    server, url_reports, session = standin
+    failures = [2]
+
+    def flaky(handler):
+        if failures[0] > 0:
+            failures[0] -= 1
+            handler.send_text(503, 'Service temporarily unavailable (injected error)')
+            return(True)
+        return(False)
+    monkeypatch.setattr(bsi_standin.StandinHandler, 'delay_and_inject', flaky)
+
+    df = fetch_all(url_reports, session)
+    assert failures[0] == 0
+    assert len(df) == STANDIN_SAMPLES
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+test_ncbr_gris.py
+    Incremental cumulative ped updates against the local stand-in (scripts/bsi_standin.py)
+
+    Usage:
+        python -m pytest tests
+"""
+
+import pandas as pd
+
+import ncbr_bsi
+import ncbr_gris
+
+# Stand-in for a loaded BatchModel, only the families update_cumulative_ped refreshes for the run
+class LoadedBatch(object):
+    def __init__(self, families):
+        self.family = pd.DataFrame({'Phenotips_Family_ID': families})
+        self.all_received = None
+
+# Fixture rows of a Phenotips ID
+def sample_rows(fixture, pid):
+    return(fixture[ncbr_bsi.get_bsi_name('Phenotips ID')] == pid)
+
+# Cumulative ped lines of a Phenotips ID
+def ped_lines(fname, pid):
+    with open(fname, 'r') as f:
+        return([line for line in f if line.split('\t')[1] == pid])
+
+# A sample that moves to another family leaves its old block, and the update matches a full rebuild
+def test_moved_sample_leaves_old_family(standin, tmp_path):
+    server, url_reports, session = standin
+    fname = str(tmp_path / 'cumulative_ped.txt')
+    assert ncbr_gris.update_cumulative_ped({1: LoadedBatch([])}, fname)
+    assert ped_lines(fname, 'P0000004')[0].startswith('FAM000001\t')
+
+    # P0000004 moves from FAM000001 to FAM000002, the run only loads FAM000002
+    server.fixture.loc[sample_rows(server.fixture, 'P0000004'), ncbr_bsi.get_bsi_name('Phenotips Family ID')] = 'FAM000002'
+    assert ncbr_gris.update_cumulative_ped({1: LoadedBatch(['FAM000002'])}, fname, verify_full=True)
+
+    lines = ped_lines(fname, 'P0000004')
+    assert len(lines) == 1
+    assert lines[0].startswith('FAM000002\t')
+
+# A parent link edited in a family the run does not load is still picked up
+def test_parent_link_change_elsewhere(standin, tmp_path):
+    server, url_reports, session = standin
+    fname = str(tmp_path / 'cumulative_ped.txt')
+    assert ncbr_gris.update_cumulative_ped({1: LoadedBatch([])}, fname)
+
+    server.fixture.loc[sample_rows(server.fixture, 'P0000004'), ncbr_bsi.get_bsi_name('Father PhenotipsId')] = '0'
+    assert ncbr_gris.update_cumulative_ped({1: LoadedBatch(['FAM000002'])}, fname, verify_full=True)
+    assert ped_lines(fname, 'P0000004')[0].split('\t')[2] == '0'